@@ -1,31 +1,3852 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # 启动时间线的起点（不含解释器自身的启动）
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
-import requests
+import tkinter.font as tkfont
 import json
 import threading
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import os
+import sys
+import queue
+import sqlite3
 import configparser
-import time
-from collections import deque
-from PIL import Image, ImageTk, ImageDraw
-import base64
-from io import BytesIO
+import argparse
+import math
+import random
+import re
+import bisect
+import hashlib
+import html
+import tempfile
+import socket
+import functools
+import importlib
+import itertools
+import codecs
+import keyword
+import unicodedata
+import traceback
+from collections import deque, OrderedDict, namedtuple, Counter
+from urllib.parse import urlsplit
+
+class LazyModule:
+    """首次访问属性时才导入的模块：requests（连同 urllib3）的导入要几十毫秒，推迟到第一次发送请求，不拖慢启动"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+        
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+        
+    def load(self):
+        """导入并返回模块，已导入时直接返回"""
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    self.module = importlib.import_module(self.name)
+        return self.module
+
+requests = LazyModule('requests')
+
+def report_error(label):
+    """在 except 块中调用：把当前异常连同堆栈写到标准错误，后台线程和界面回调中的错误不会悄悄丢失"""
+    print(f"{label}:", file=sys.stderr)
+    traceback.print_exc()
+
+_request_state = threading.local()  # 当前线程的请求：新建连接所用的时间和取消令牌
+
+class CancelToken(threading.Event):
+    """取消一次发送：set() 后重试前的等待立即结束，请求正在使用的连接被关闭，阻塞中的连接、读取随即出错返回"""
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.finished = False
+        
+    def set(self):
+        super().set()
+        with self.lock:
+            connections, self.connections = self.connections, set()
+        for connection in connections:
+            self.shutdown(connection)
+            
+    def attach(self, connection):
+        """登记请求正在使用的连接；已经取消时立即关闭它"""
+        with self.lock:
+            if not self.is_set():
+                if not self.finished:
+                    self.connections.add(connection)
+                return
+        self.shutdown(connection)
+        
+    def finish(self):
+        """请求已结束：连接可能已归还连接池供其他请求使用，之后的取消不再关闭它们"""
+        with self.lock:
+            self.finished = True
+            self.connections.clear()
+            
+    @staticmethod
+    def shutdown(connection):
+        # 只关闭套接字的读写，阻塞在其上的线程收到错误；连接池取出连接时会发现它已断开并重新连接
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class TimedConnectionMixin:
+    """记录建立连接（DNS解析、TCP握手和TLS握手）的耗时，复用长连接时不会调用；
+    发出请求时把连接登记到当前线程的取消令牌上"""
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _request_state.connect_seconds = getattr(_request_state, 'connect_seconds', 0.0) + time.perf_counter() - start
+        cancel = getattr(_request_state, 'cancel', None)
+        if cancel is not None and cancel.is_set():
+            # 建立连接期间被取消
+            cancel.shutdown(self)
+            
+    def request(self, *args, **kwargs):
+        cancel = getattr(_request_state, 'cancel', None)
+        if cancel is not None:
+            cancel.attach(self)
+        return super().request(*args, **kwargs)
+
+@functools.lru_cache(maxsize=None)
+def timed_adapter_class():
+    """连接池中的连接会记录建立连接的耗时并能被取消（经代理的连接除外）的 HTTPAdapter；
+    首次创建传输层时才导入 requests 和 urllib3"""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+    
+    class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+        pass
+        
+    class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+        pass
+        
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+        
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+        
+    class TimedHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                       'https': TimedHTTPSConnectionPool}
+            
+    return TimedHTTPAdapter
+
+class ApiTransport:
+    """共享的HTTP传输层：复用长连接，避免每次请求重新握手"""
+    def __init__(self, api_url, api_key, pool_size=10, proxy='', verify_ssl=True, ca_bundle=''):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.session = requests.Session()
+        
+        # 连接池：保持keep-alive连接供后续请求复用
+        adapter = timed_adapter_class()(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        
+        # 代理与TLS设置
+        if proxy:
+            self.session.proxies.update({'http': proxy, 'https': proxy})
+        if not verify_ssl:
+            self.session.verify = False
+        elif ca_bundle:
+            self.session.verify = ca_bundle
+            
+    def matches(self, api_url, api_key):
+        """判断当前传输层是否仍对应给定的地址和密钥"""
+        return self.api_url == api_url and self.api_key == api_key
+        
+    def post(self, data, timeout, stream=False, cancel=None):
+        """向API地址发送JSON请求；cancel 为 CancelToken 时，取消会关闭这个请求使用的连接（普通的 threading.Event 不会）"""
+        _request_state.connect_seconds = 0.0
+        _request_state.cancel = cancel if isinstance(cancel, CancelToken) else None
+        try:
+            return self.session.post(self.api_url, json=data, timeout=timeout, stream=stream)
+        finally:
+            _request_state.cancel = None
+        
+    def probe(self, timeout=10):
+        """检查服务是否可用，返回HTTP状态码：地址以 /chat/completions 结尾时请求同一前缀下的 /models（不消耗token），
+        否则发送一个只生成1个token的聊天请求"""
+        if self.api_url.rstrip('/').endswith('/chat/completions'):
+            models_url = self.api_url.rstrip('/')[:-len('/chat/completions')] + '/models'
+            return self.session.get(models_url, timeout=timeout).status_code
+        return self.post({"model": "", "messages": [{"role": "user", "content": "Hi"}], "max_tokens": 1},
+                         timeout=timeout).status_code
+        
+    @staticmethod
+    def last_connect_time():
+        """当前线程上一次 post 中新建连接的耗时，复用长连接时为0"""
+        return getattr(_request_state, 'connect_seconds', 0.0)
+        
+    def close(self):
+        """关闭所有连接"""
+        self.session.close()
+
+@functools.lru_cache(maxsize=8192)
+def estimate_tokens(text):
+    """粗略估算文本的token数：中日韩字符每个约1个token，其余约4个字符1个token"""
+    cjk = sum(1 for ch in text if '\u3000' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af' or '\uff00' <= ch <= '\uffef')
+    return cjk + (len(text) - cjk + 3) // 4
+
+def message_tokens(message):
+    """估算一条消息的token数（含每条消息的固定开销）"""
+    return estimate_tokens(message["content"]) + 4
+
+class ContextWindow:
+    """按模型的token预算裁剪对话历史：保留系统提示和最近的对话，较早的对话用后台生成的摘要代替"""
+    DEFAULT_BUDGETS = {
+        "gpt-3.5-turbo": 12000,
+        "gpt-4": 6000,
+        "gpt-4-turbo": 100000,
+    }
+    SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+    
+    def __init__(self, default_budget=3000, budgets=None, summary_tokens=400, summarizer=None, on_summary=None,
+                 runner=None):
+        self.default_budget = default_budget
+        self.budgets = dict(self.DEFAULT_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.summary_tokens = summary_tokens  # 为摘要预留的token数
+        self.summarizer = summarizer  # summarizer(messages, previous_summary) -> 摘要文本
+        self.on_summary = on_summary  # 新摘要生成后的回调
+        self.runner = runner  # runner(func)，在后台执行摘要任务，默认每次新建线程
+        self.summaries = {}  # 较早对话的哈希 -> 摘要
+        self.pending = set()  # 正在生成摘要的哈希
+        self.lock = threading.Lock()
+        
+    def budget_for(self, model):
+        """获取模型的token预算"""
+        return self.budgets.get(model, self.budgets.get(model.lower(), self.default_budget))
+        
+    @staticmethod
+    def split_turns(messages):
+        """把对话按轮次分组，每轮从一条用户消息开始"""
+        turns = []
+        for message in messages:
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(message)
+        return turns
+        
+    @staticmethod
+    def prefix_hashes(turns):
+        """计算每个轮次前缀的哈希，用于查找已缓存的摘要"""
+        hashes = []
+        digest = hashlib.sha1()
+        for turn in turns:
+            digest.update(json.dumps(turn, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+            hashes.append(digest.copy().hexdigest())
+        return hashes
+        
+    def build(self, history, model):
+        """生成本次请求要发送的消息列表，返回 (messages, stats)"""
+        system = []
+        rest = list(history)
+        while rest and rest[0]["role"] == "system":
+            system.append(rest.pop(0))
+        turns = self.split_turns(rest)
+        
+        budget = self.budget_for(model) - sum(message_tokens(m) for m in system)
+        
+        # 从最新的轮次往前，尽可能多地原样保留（最新一轮总是保留）
+        recent = []
+        used = 0
+        for turn in reversed(turns):
+            tokens = sum(message_tokens(m) for m in turn)
+            if recent and used + tokens > budget - self.summary_tokens:
+                break
+            recent.insert(0, turn)
+            used += tokens
+        older = turns[:len(turns) - len(recent)]
+        
+        stats = {"turns": len(recent), "tokens": 0, "compacted": 0, "dropped": 0}
+        summary_message = None
+        if older:
+            hashes = self.prefix_hashes(older)
+            with self.lock:
+                covered = next((n for n in range(len(older), 0, -1) if hashes[n - 1] in self.summaries), 0)
+                summary = self.summaries[hashes[covered - 1]] if covered else None
+            if summary:
+                summary_message = {"role": "system", "content": self.SUMMARY_PREFIX + summary}
+                stats["compacted"] = covered
+                used += message_tokens(summary_message)
+            
+            # 摘要尚未覆盖的较早轮次在后台补充生成，本次放得下的原样发送，其余先丢弃
+            if covered < len(older):
+                self.request_summary(hashes[-1], [m for turn in older[covered:] for m in turn], summary)
+                while len(older) > covered:
+                    tokens = sum(message_tokens(m) for m in older[-1])
+                    if used + tokens > budget:
+                        break
+                    recent.insert(0, older.pop())
+                    used += tokens
+                stats["turns"] = len(recent)
+                stats["dropped"] = len(older) - covered
+                
+        messages = list(system)
+        if summary_message:
+            messages.append(summary_message)
+        for turn in recent:
+            messages.extend(turn)
+        stats["tokens"] = sum(message_tokens(m) for m in messages)
+        return messages, stats
+        
+    def request_summary(self, key, messages, previous_summary):
+        """在后台线程中生成摘要，同一段对话只生成一次"""
+        if self.summarizer is None:
+            return
+        with self.lock:
+            if key in self.summaries or key in self.pending:
+                return
+            self.pending.add(key)
+            
+        def worker():
+            try:
+                summary = self.summarizer(messages, previous_summary)
+                if summary:
+                    with self.lock:
+                        self.summaries[key] = summary
+                    if self.on_summary:
+                        self.on_summary(key)
+            except Exception:
+                report_error("Summary error")
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                    
+        if self.runner is not None:
+            self.runner(worker)
+        else:
+            threading.Thread(target=worker, daemon=True).start()
+        
+def parse_reset_time(value):
+    """解析 x-ratelimit-reset-* 响应头中的时长，如 "1s"、"6m0s"、"20ms"，返回秒数"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def parse_retry_after(value):
+    """解析 Retry-After 响应头（秒数或HTTP日期），返回秒数，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的限额，按固定速率持续补充"""
+    def __init__(self, capacity, period=60.0):
+        self.period = period
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # 服务端要求暂停（如 Retry-After）的截止时间
+        
+    def refill(self, now):
+        """按经过的时间补充令牌；now 早于上次更新（调用方在桶创建之前取的时间）时不变"""
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        
+    def wait_time(self, amount, now):
+        """获取 amount 个令牌需要等待的秒数"""
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        amount = min(amount, self.capacity)  # 超过容量的请求在桶满时放行
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+        
+    def consume(self, amount, now):
+        """扣除令牌"""
+        self.refill(now)
+        self.tokens -= min(amount, self.capacity)
+        
+    def set_capacity(self, capacity):
+        """更新每分钟的限额"""
+        capacity = float(capacity)
+        if capacity > 0 and capacity != self.capacity:
+            self.capacity = capacity
+            self.rate = capacity / self.period
+            self.tokens = min(self.tokens, capacity)
+            
+    def sync(self, remaining, reset_seconds, now):
+        """用服务端返回的剩余额度校准令牌数"""
+        self.refill(now)
+        self.tokens = min(self.tokens, float(remaining))
+        if remaining <= 0 and reset_seconds:
+            self.blocked_until = max(self.blocked_until, now + reset_seconds)
+            
+    def block(self, seconds, now):
+        """在指定时间内暂停发放令牌"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+class RateLimiter:
+    """按模型分别维护每分钟请求数和token数两个令牌桶，并从响应头学习实际限额"""
+    def __init__(self, default_rpm=3, default_tpm=40000, limits=None):
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.limits = limits or {}  # 模型 -> (rpm, tpm)
+        self.buckets = {}  # 模型 -> (请求桶, token桶)
+        self.lock = threading.Lock()
+        
+    def get_buckets(self, model):
+        """获取模型对应的两个令牌桶，不存在时按配置创建"""
+        if model not in self.buckets:
+            rpm, tpm = self.limits.get(model, (self.default_rpm, self.default_tpm))
+            self.buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+        return self.buckets[model]
+        
+    def reserve(self, model, tokens):
+        """尝试为一次请求预留额度：成功返回0，否则返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            requests_bucket, tokens_bucket = self.get_buckets(model)
+            wait = max(requests_bucket.wait_time(1, now), tokens_bucket.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+            requests_bucket.consume(1, now)
+            tokens_bucket.consume(tokens, now)
+            return 0.0
+            
+    def update_from_headers(self, model, headers):
+        """根据 x-ratelimit-* 和 Retry-After 响应头更新限额"""
+        with self.lock:
+            now = time.monotonic()
+            requests_bucket, tokens_bucket = self.get_buckets(model)
+            for bucket, kind in ((requests_bucket, 'requests'), (tokens_bucket, 'tokens')):
+                limit = headers.get(f'x-ratelimit-limit-{kind}')
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                try:
+                    if limit:
+                        bucket.set_capacity(float(limit))
+                    if remaining:
+                        bucket.sync(float(remaining), parse_reset_time(headers.get(f'x-ratelimit-reset-{kind}')), now)
+                except ValueError:
+                    continue
+            seconds = parse_retry_after(headers.get('Retry-After'))
+            if seconds:
+                requests_bucket.block(seconds, now)
+                    
+class Endpoint:
+    """一个服务：地址、密钥、权重、可用的模型和模型名映射，有自己的速率限制和连接，以及路由用的负载和健康状态"""
+    def __init__(self, name, url, key, weight=1.0, models=None, model_map=None, limiter=None, retry=None):
+        self.name = name
+        self.url = url
+        self.key = key
+        self.weight = max(weight, 0.01)
+        self.models = set(models or ())  # 为空表示支持所有模型
+        self.model_map = model_map or {}  # 模型 -> 该服务上的模型名
+        self.limiter = limiter or RateLimiter()
+        self.retry = retry or {}  # 覆盖的重试选项
+        self.transport = None  # 首次请求时创建
+        self.in_flight = 0
+        self.sent = 0
+        self.reserved = Counter()  # 模型 -> 已预留速率额度、尚未发出的请求数
+        self.failures = 0  # 连续失败次数
+        self.healthy = True
+        self.last_status = None  # 最近一次请求或健康检查的结果
+        
+    def supports(self, model):
+        return not self.models or model in self.models
+        
+    def upstream_model(self, model):
+        """该服务上对应的模型名"""
+        return self.model_map.get(model, model)
+
+class EndpointRouter:
+    """在多个服务之间分配请求：只使用健康的服务，从中选择 (进行中+已预留的请求数)/权重 最低的一个。
+    reserve 与 RateLimiter 的接口相同，在选中的服务上预留额度，随后 acquire 优先使用有预留的服务；
+    连接失败、超时、5xx和认证失败连续出现 failure_threshold 次后暂停使用，直到健康检查或请求成功"""
+    def __init__(self, endpoints, failure_threshold=3):
+        self.endpoints = endpoints
+        self.by_name = {endpoint.name: endpoint for endpoint in endpoints}
+        self.failure_threshold = max(failure_threshold, 1)
+        self.lock = threading.Lock()
+        
+    @staticmethod
+    def is_outage(status):
+        """请求结果（HTTP状态码或错误类型）是否说明服务不可用；501表示服务端不支持健康检查的请求，服务本身可用"""
+        if isinstance(status, int):
+            return (status >= 500 and status != 501) or status in (401, 403)
+        return status in ('timeout', 'connection')
+        
+    @staticmethod
+    def load(endpoint):
+        """排序用的负载：先比较按权重折算的并发数，相同时比较按权重折算的已发送请求数，使空闲的服务按权重轮流使用"""
+        busy = endpoint.in_flight + sum(endpoint.reserved.values())
+        return busy / endpoint.weight, endpoint.sent / endpoint.weight
+        
+    def candidates(self, model, avoid=None):
+        """可以处理该模型的健康服务；除 avoid 外没有可用的服务时退而使用 avoid，全部不健康时仍全部尝试"""
+        usable = [endpoint for endpoint in self.endpoints if endpoint.supports(model)] or self.endpoints
+        healthy = [endpoint for endpoint in usable if endpoint.healthy]
+        return [endpoint for endpoint in healthy if endpoint is not avoid] or healthy or usable
+        
+    def reserve(self, model, tokens, avoid=None):
+        """在负载最低且有额度的服务上预留一次请求：成功返回0，否则返回最短的等待秒数"""
+        with self.lock:
+            waits = []
+            for endpoint in sorted(self.candidates(model, avoid), key=self.load):
+                wait = endpoint.limiter.reserve(model, tokens)
+                if wait <= 0:
+                    endpoint.reserved[model] += 1
+                    return 0.0
+                waits.append(wait)
+            return min(waits)
+            
+    def acquire(self, model, avoid=None):
+        """为一次请求选择服务并计入进行中的请求：优先使用为该模型预留了额度的服务"""
+        with self.lock:
+            candidates = self.candidates(model, avoid)
+            reserved = [endpoint for endpoint in candidates if endpoint.reserved[model] > 0]
+            endpoint = min(reserved or candidates, key=self.load)
+            # 预留在不可用的服务上时，用掉那份预留，避免预留越积越多
+            holder = endpoint if endpoint.reserved[model] > 0 else next(
+                (other for other in self.endpoints if other.reserved[model] > 0), None)
+            if holder is not None:
+                holder.reserved[model] -= 1
+            endpoint.in_flight += 1
+            endpoint.sent += 1
+            return endpoint
+            
+    def cancel_reservation(self, model):
+        """放弃一份预留：预留了额度的请求在发出前被取消时调用，否则 load 会一直把它算作待发送的请求"""
+        with self.lock:
+            holder = next((endpoint for endpoint in self.endpoints if endpoint.reserved[model] > 0), None)
+            if holder is not None:
+                holder.reserved[model] -= 1
+                if not holder.reserved[model]:
+                    del holder.reserved[model]
+            
+    def release(self, name, status):
+        """请求结束，status 为HTTP状态码或错误类型"""
+        with self.lock:
+            endpoint = self.by_name[name]
+            endpoint.in_flight = max(endpoint.in_flight - 1, 0)
+            self.update_health(endpoint, status)
+            
+    def update_health(self, endpoint, status):
+        endpoint.last_status = status
+        if self.is_outage(status):
+            endpoint.failures += 1
+            if endpoint.failures >= self.failure_threshold:
+                endpoint.healthy = False
+        elif isinstance(status, int):
+            endpoint.failures = 0
+            if not endpoint.healthy:
+                # 恢复的服务从其他服务的进度开始轮流，不会一下子接到所有请求
+                endpoint.sent = max((other.sent / other.weight for other in self.endpoints), default=0) * endpoint.weight
+                endpoint.healthy = True
+            
+    def mark_probe(self, endpoint, status):
+        """记录健康检查的结果，检查失败时立即暂停使用"""
+        with self.lock:
+            if self.is_outage(status):
+                endpoint.failures = max(endpoint.failures, self.failure_threshold - 1)
+            self.update_health(endpoint, status)
+
+class SendScheduler:
+    """发送调度器：消息排队，令牌桶有余量且并发数未满时立即发送，等待期间每秒回调一次用于显示倒计时"""
+    def __init__(self, root, limiter, dispatch, on_wait=None, prepare=None, max_in_flight=1):
+        self.root = root
+        self.limiter = limiter
+        self.dispatch = dispatch  # dispatch(job)，在界面线程中调用
+        self.on_wait = on_wait  # on_wait(job, seconds)
+        self.prepare = prepare  # prepare(job)，发送前补全 tokens 等字段
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.queue = deque()
+        self.timer = None
+        
+    def submit(self, job):
+        """加入发送队列，job 至少包含 model，以及 tokens 或由 prepare 补全；prepare 补全了 cached 的任务不需要请求服务器"""
+        self.queue.append(job)
+        if self.timer is None:
+            self.pump()
+            
+    def set_max_in_flight(self, max_in_flight):
+        """修改最大并发数"""
+        self.max_in_flight = max(max_in_flight, 1)
+        if self.timer is None:
+            self.pump()
+            
+    def done(self):
+        """一个已发送的请求结束，释放并发名额"""
+        self.in_flight = max(self.in_flight - 1, 0)
+        if self.timer is None:
+            self.pump()
+            
+    def pump(self):
+        """按顺序发送队列中的消息，额度不足时在额度恢复的时刻再次检查"""
+        self.timer = None
+        while self.queue and self.in_flight < self.max_in_flight:
+            job = self.queue[0]
+            if self.prepare and "tokens" not in job:
+                self.prepare(job)
+            # 缓存命中的任务不请求服务器，也就不占用速率额度
+            wait = self.limiter.reserve(job["model"], job["tokens"]) if job.get("cached") is None else 0
+            if wait > 0:
+                if self.on_wait:
+                    self.on_wait(job, wait)
+                self.timer = self.root.after(max(int(min(wait, 1.0) * 1000), 1), self.pump)
+                return
+            self.queue.popleft()
+            self.in_flight += 1
+            self.dispatch(job)
+            
+    def pending(self):
+        """排队中（尚未发送）的任务数"""
+        return len(self.queue)
+        
+    def cancel_all(self):
+        """取消所有排队中的消息，返回被取消的任务"""
+        if self.timer is not None:
+            self.root.after_cancel(self.timer)
+            self.timer = None
+        jobs = list(self.queue)
+        self.queue.clear()
+        return jobs
+
+class WorkerPool:
+    """常驻工作线程池：所有后台任务进入同一个队列，由固定数量的线程执行，避免每次请求新建线程"""
+    def __init__(self, size=4):
+        self.tasks = queue.Queue()
+        self.size = 0
+        self.threads = []
+        self.lock = threading.Lock()
+        self.resize(size)
+        
+    def submit(self, func, *args):
+        """提交一个后台任务"""
+        self.tasks.put((func, args))
+        
+    def resize(self, size):
+        """调整线程数：增加时启动新线程，减少时让多余的线程执行完当前任务后退出"""
+        size = max(size, 1)
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            for _ in range(size - self.size):
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            for _ in range(self.size - size):
+                self.tasks.put(None)
+            self.size = size
+            
+    def work(self):
+        """工作线程：依次执行队列中的任务，收到None时退出"""
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                report_error("Worker error")
+                
+    def shutdown(self, timeout=None):
+        """通知所有线程在队列中已有的任务完成后退出；给出 timeout 时最多等待这么多秒"""
+        with self.lock:
+            for _ in range(self.size):
+                self.tasks.put(None)
+            self.size = 0
+            threads, self.threads = self.threads, []
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+            for thread in threads:
+                thread.join(max(deadline - time.monotonic(), 0))
+
+class UiDispatcher:
+    """界面分发队列：任意线程都可以 post 回调，界面线程用一个 after 定时器统一取出执行，工作线程从不直接调用Tk"""
+    POLL_INTERVAL = 16  # 轮询间隔（毫秒），约每帧一次
+    TIME_BUDGET = 0.012  # 每次轮询最多执行的时间（秒），剩余的回调留到下一次
+    
+    def __init__(self, root):
+        self.root = root
+        self.queue = queue.SimpleQueue()
+        self.timer = self.root.after(self.POLL_INTERVAL, self.poll)
+        
+    def post(self, func, *args):
+        """从任意线程提交一个要在界面线程中执行的回调"""
+        self.queue.put((func, args))
+        
+    def poll(self):
+        """按提交顺序执行排队的回调"""
+        deadline = time.perf_counter() + self.TIME_BUDGET
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    func, args = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    func(*args)
+                except Exception:
+                    report_error("UI callback error")
+        finally:
+            self.timer = self.root.after(self.POLL_INTERVAL, self.poll)
+            
+    def stop(self):
+        """停止轮询"""
+        if self.timer is not None:
+            self.root.after_cancel(self.timer)
+            self.timer = None
+            
+    def drain(self):
+        """立即执行所有排队的回调（关闭窗口前、停止轮询之后使用）"""
+        while True:
+            try:
+                func, args = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                func(*args)
+            except Exception:
+                report_error("UI callback error")
+
+class RenderScheduler:
+    """界面更新合并器：文本追加、标签文字和滚动到底部的请求先记录下来，按帧率上限统一刷新到界面"""
+    def __init__(self, root, view, max_fps=30):
+        self.root = root
+        self.view = view  # ChatView
+        self.interval = max(int(1000 / max(max_fps, 1)), 1)  # 两次刷新之间的最短间隔（毫秒）
+        self.appends = OrderedDict()  # 消息序号 -> 待追加的文本片段
+        self.labels = {}  # 控件 -> 待设置的选项，同一控件只保留最后一次
+        self.scroll_requested = False
+        self.timer = None
+        self.last_flush = 0.0
+        
+    def append_text(self, index, delta):
+        """追加文本到消息（流式回复），同一帧内的多个片段合并为一次插入"""
+        self.appends.setdefault(index, []).append(delta)
+        self.schedule()
+        
+    def configure(self, widget, **options):
+        """设置标签等控件的选项，同一帧内多次设置只生效最后一次"""
+        self.labels.setdefault(widget, {}).update(options)
+        self.schedule()
+        
+    def scroll_to_bottom(self):
+        """请求滚动到底部"""
+        self.scroll_requested = True
+        self.schedule()
+        
+    def discard_text(self):
+        """丢弃尚未刷新的文本追加（消息列表被清空时调用）"""
+        self.appends.clear()
+        self.scroll_requested = False
+        
+    def schedule(self):
+        """距上次刷新不足一帧时推迟到下一帧"""
+        if self.timer is None:
+            elapsed = (time.perf_counter() - self.last_flush) * 1000
+            self.timer = self.root.after(max(int(self.interval - elapsed), 0), self.flush)
+            
+    def flush(self):
+        """把积累的更新一次性应用到界面"""
+        if self.timer is not None:
+            self.root.after_cancel(self.timer)
+            self.timer = None
+        self.last_flush = time.perf_counter()
+        
+        if self.appends:
+            # 追加前停留在底部时，追加后继续跟随到底部
+            if self.view.is_at_bottom():
+                self.scroll_requested = True
+            for index, deltas in self.appends.items():
+                self.view.append_text(index, "".join(deltas))
+            self.appends.clear()
+        for widget, options in self.labels.items():
+            widget.configure(**options)
+        self.labels.clear()
+        if self.scroll_requested:
+            self.scroll_requested = False
+            self.view.scroll_to_bottom()
+
+# 发送给工作线程的请求快照：创建后不再修改，工作线程不读取界面或对话历史的共享状态
+ChatRequest = namedtuple('ChatRequest', ['seq', 'messages', 'model', 'stream', 'cache_key', 'queued_at', 'cancel'])
+
+CJK_RUN = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+def index_text(text):
+    """把文本转换为全文索引用的词序列：中日韩文字切成相邻的二元组，其余文字保持原样"""
+    parts = []
+    position = 0
+    for match in CJK_RUN.finditer(text):
+        parts.append(text[position:match.start()])
+        run = match.group()
+        if len(run) == 1:
+            parts.append(run)
+        else:
+            parts.append(" ".join(run[i:i + 2] for i in range(len(run) - 1)))
+        position = match.end()
+    parts.append(text[position:])
+    return " ".join(part for part in parts if part)
+
+def build_fts_query(query):
+    """把用户输入转换为FTS5查询：每个词都必须出现，中文词按二元组短语匹配，其余按前缀匹配"""
+    terms = []
+    for word in query.split():
+        for match in re.finditer(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|\w+', word):
+            token = match.group()
+            if CJK_RUN.fullmatch(token):
+                if len(token) == 1:
+                    terms.append(f'"{token}"*')
+                else:
+                    terms.append('"' + " ".join(token[i:i + 2] for i in range(len(token) - 1)) + '"')
+            else:
+                terms.append(f'"{token}"*')
+    return " ".join(terms)
+
+def make_snippet(text, query, width=40):
+    """截取第一个命中词附近的一段文字作为搜索结果摘要"""
+    text = " ".join(text.split())
+    lowered = text.lower()
+    positions = [lowered.find(word.lower()) for word in query.split()]
+    positions = [p for p in positions if p >= 0]
+    start = max(min(positions) - width // 2, 0) if positions else 0
+    snippet = text[start:start + width * 2]
+    if start > 0:
+        snippet = "…" + snippet
+    if start + width * 2 < len(text):
+        snippet += "…"
+    return snippet
+
+class ConversationStore:
+    """基于SQLite的对话存储：WAL模式，消息只追加，写入在后台线程中批量提交；
+    读取和会话管理在工作线程中进行，每个线程使用自己的连接，界面线程不访问数据库"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            conversation_id INTEGER NOT NULL REFERENCES conversations(id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            model TEXT,
+            in_context INTEGER NOT NULL DEFAULT 1,
+            stats TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, id);
+        CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at);
+    """
+    FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, tokenize='unicode61')"
+    BATCH_WINDOW = 0.05  # 合并写入的时间窗口（秒）
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # 各线程的读取连接
+        self.connections = []  # 所有读取连接，关闭时一起关闭
+        self.lock = threading.Lock()
+        conn = self.reader()
+        conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+        if 'stats' not in columns:
+            # 旧版本的数据库没有记录请求耗时的列
+            conn.execute("ALTER TABLE messages ADD COLUMN stats TEXT")
+        try:
+            conn.execute(self.FTS_SCHEMA)
+            self.fts_enabled = True
+        except sqlite3.OperationalError:
+            self.fts_enabled = False  # SQLite未编译FTS5时不提供搜索
+        conn.commit()
+        
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        
+    def connect(self):
+        """打开一个WAL模式的连接"""
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+        
+    def reader(self):
+        """当前线程的读取连接，第一次使用时打开；常驻的工作线程一直复用同一个连接"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+        
+    def write_loop(self):
+        """后台写线程：把短时间内的多次追加合并成一个事务提交"""
+        conn = self.connect()
+        if self.fts_enabled:
+            self.index_backlog(conn)
+        while True:
+            item = self.write_queue.get()
+            batch = [item]
+            deadline = time.monotonic() + self.BATCH_WINDOW
+            while item is not None:
+                try:
+                    item = self.write_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                batch.append(item)
+                
+            rows = [row for row in batch if row is not None]
+            if rows:
+                try:
+                    with conn:
+                        for row in rows:
+                            cursor = conn.execute(
+                                "INSERT INTO messages (conversation_id, role, content, created_at, model, in_context, stats) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+                            if self.fts_enabled:
+                                conn.execute("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                                             (cursor.lastrowid, index_text(row[2])))
+                        for conversation_id, updated_at in {row[0]: row[3] for row in rows}.items():
+                            conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?",
+                                         (updated_at, conversation_id))
+                except sqlite3.Error:
+                    report_error("Storage error")
+            for _ in batch:
+                self.write_queue.task_done()
+            if None in batch:
+                conn.close()
+                return
+                
+    def index_backlog(self, conn, chunk=1000):
+        """为尚未建立索引的旧消息补建全文索引"""
+        last_id = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM messages_fts").fetchone()[0]
+        while True:
+            rows = conn.execute("SELECT id, content FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                                (last_id, chunk)).fetchall()
+            if not rows:
+                return
+            with conn:
+                conn.executemany("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                                 [(row_id, index_text(content)) for row_id, content in rows])
+            last_id = rows[-1][0]
+            
+    def search(self, query, limit=50):
+        """全文搜索所有对话，按相关度返回 [(message_id, conversation_id, title, role, content, created_at), ...]"""
+        fts_query = build_fts_query(query)
+        if not self.fts_enabled or not fts_query:
+            return []
+        return self.reader().execute(
+            "SELECT m.id, m.conversation_id, c.title, m.role, m.content, m.created_at "
+            "FROM (SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?) AS f "
+            "JOIN messages m ON m.id = f.rowid JOIN conversations c ON c.id = m.conversation_id "
+            "ORDER BY f.rank", (fts_query, limit)).fetchall()
+            
+    def append_message(self, conversation_id, role, content, model=None, in_context=True, created_at=None, stats=None):
+        """追加一条消息（异步写入），stats 为回复的耗时统计"""
+        self.write_queue.put((conversation_id, role, content, created_at or time.time(), model, int(in_context),
+                              json.dumps(stats) if stats else None))
+        
+    def flush(self):
+        """等待所有排队的写入完成"""
+        self.write_queue.join()
+        
+    def close(self):
+        """写完剩余数据并关闭数据库"""
+        self.write_queue.put(None)
+        self.writer.join(timeout=5)
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+        
+    def create_conversation(self, title):
+        """新建对话，返回其id"""
+        now = time.time()
+        conn = self.reader()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO conversations (title, created_at, updated_at) VALUES (?, ?, ?)", (title, now, now))
+        return cursor.lastrowid
+        
+    def list_conversations(self, limit=200):
+        """按最近更新时间列出对话 [(id, title, updated_at), ...]"""
+        return self.reader().execute(
+            "SELECT id, title, updated_at FROM conversations ORDER BY updated_at DESC LIMIT ?", (limit,)).fetchall()
+            
+    def load_from(self, conversation_id, first_id):
+        """读取从 first_id 开始到最新的所有消息（按时间正序）"""
+        return self.reader().execute(
+            "SELECT id, role, content, created_at, model, in_context FROM messages "
+            "WHERE conversation_id = ? AND id >= ? ORDER BY id", (conversation_id, first_id)).fetchall()
+            
+    def page_start(self, conversation_id, message_id, before=10):
+        """获取某条消息之前第 before 条消息的id，用于跳转时带上少量上文"""
+        row = self.reader().execute(
+            "SELECT MIN(id) FROM (SELECT id FROM messages WHERE conversation_id = ? AND id <= ? "
+            "ORDER BY id DESC LIMIT ?)", (conversation_id, message_id, before + 1)).fetchone()
+        return row[0] if row and row[0] is not None else message_id
+        
+    def load_page(self, conversation_id, before_id=None, limit=50):
+        """读取一页消息（按时间正序），before_id 为空时读取最新的一页"""
+        if before_id is None:
+            before_id = sys.maxsize
+        rows = self.reader().execute(
+            "SELECT id, role, content, created_at, model, in_context FROM messages "
+            "WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (conversation_id, before_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+        
+    def iter_conversations(self, conn, conversation_ids=None):
+        """逐个读取对话及其消息，供后台导出使用：产出 (对话, 消息迭代器)，不把所有消息一次读入内存"""
+        if conversation_ids is None:
+            rows = conn.execute("SELECT id, title, created_at, updated_at FROM conversations ORDER BY id")
+        else:
+            rows = [conn.execute("SELECT id, title, created_at, updated_at FROM conversations WHERE id = ?",
+                                 (conversation_id,)).fetchone() for conversation_id in conversation_ids]
+        for row in list(rows):
+            if row is None:
+                continue
+            conversation = {"id": row[0], "title": row[1], "created_at": row[2], "updated_at": row[3]}
+            yield conversation, self.iter_messages(conn, row[0])
+            
+    def iter_messages(self, conn, conversation_id, chunk=500):
+        """按id分批读取一个对话的全部消息"""
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, role, content, created_at, model, in_context, stats FROM messages "
+                "WHERE conversation_id = ? AND id > ? ORDER BY id LIMIT ?", (conversation_id, last_id, chunk)).fetchall()
+            for row_id, role, content, created_at, model, in_context, stats in rows:
+                yield {"id": row_id, "role": role, "content": content, "created_at": created_at,
+                       "model": model, "in_context": bool(in_context), "stats": json.loads(stats) if stats else None}
+            if len(rows) < chunk:
+                return
+            last_id = rows[-1][0]
+            
+    def insert_conversation(self, conn, conversation, messages, chunk=1000, progress=None, stop=None):
+        """把导入的对话分批写入存储（工作线程使用自己的连接），返回新对话的id，没有消息时返回None"""
+        now = time.time()
+        with conn:
+            cursor = conn.execute("INSERT INTO conversations (title, created_at, updated_at) VALUES (?, ?, ?)",
+                                  (conversation['title'], conversation.get('created_at') or now, now))
+        conversation_id = cursor.lastrowid
+        messages = iter(messages)
+        count = 0
+        try:
+            while True:
+                batch = list(itertools.islice(messages, chunk))
+                if stop is not None and stop.is_set():
+                    raise InterruptedError("import cancelled")
+                if not batch:
+                    break
+                count += len(batch)
+                with conn:
+                    for message in batch:
+                        cursor = conn.execute(
+                            "INSERT INTO messages (conversation_id, role, content, created_at, model, in_context, stats) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (conversation_id, message['role'], message['content'], message['created_at'],
+                             message.get('model'), int(bool(message.get('in_context', True))),
+                             json.dumps(message['stats']) if message.get('stats') else None))
+                        if self.fts_enabled:
+                            conn.execute("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                                         (cursor.lastrowid, index_text(message['content'])))
+                if progress:
+                    progress()
+        except BaseException:
+            self.delete_conversation(conn, conversation_id)  # 取消或出错时不留下导入了一半的对话
+            raise
+        if not count:
+            self.delete_conversation(conn, conversation_id)
+            return None
+        return conversation_id
+        
+    def delete_conversation(self, conn, conversation_id):
+        """删除一个对话及其消息和索引"""
+        with conn:
+            if self.fts_enabled:
+                conn.execute("DELETE FROM messages_fts WHERE rowid IN "
+                             "(SELECT id FROM messages WHERE conversation_id = ?)", (conversation_id,))
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            
+    def count_messages(self, conn, conversation_ids=None):
+        """统计要导出的消息数，用于显示进度"""
+        if conversation_ids is None:
+            return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return sum(conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = ?",
+                                (conversation_id,)).fetchone()[0] for conversation_id in conversation_ids)
+
+def format_timestamp(timestamp):
+    """导出文件中使用的本地时间"""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else ''
+
+def describe_stats(stats):
+    """把回复的耗时统计写成一行简短说明"""
+    parts = []
+    if stats.get("elapsed") is not None:
+        parts.append(f"{stats['elapsed']:.2f}s")
+    if stats.get("ttft") is not None:
+        parts.append(f"TTFT {stats['ttft']:.2f}s")
+    tokens = stats.get("completion_tokens") or stats.get("tokens")
+    if tokens:
+        parts.append(f"{tokens} tokens")
+    if stats.get("cached"):
+        parts.append("cached")
+    if stats.get("truncated"):
+        parts.append("truncated")
+    return " · ".join(parts)
+
+class Exporter:
+    """导出格式的基类：按对话、按消息逐条写出，不在内存中保留整个对话"""
+    label = ''
+    extension = ''
+    
+    def __init__(self, f):
+        self.f = f
+        
+    def begin(self):
+        """写文件头"""
+        
+    def start_conversation(self, conversation):
+        """开始写一个对话"""
+        
+    def write_message(self, conversation, message):
+        """写一条消息"""
+        raise NotImplementedError
+        
+    def end_conversation(self, conversation):
+        """一个对话写完"""
+        
+    def end(self):
+        """写文件尾"""
+
+class MarkdownExporter(Exporter):
+    """Markdown：每个对话一个标题，每条消息注明角色、时间、模型和耗时"""
+    label = 'Markdown'
+    extension = '.md'
+    
+    def start_conversation(self, conversation):
+        self.f.write(f"# {conversation['title']}\n\n")
+        self.f.write(f"- id: {conversation['id']}\n- created: {format_timestamp(conversation['created_at'])}\n"
+                     f"- updated: {format_timestamp(conversation['updated_at'])}\n\n")
+        
+    def write_message(self, conversation, message):
+        details = [format_timestamp(message['created_at'])]
+        if message.get('model'):
+            details.append(message['model'])
+        if message.get('stats'):
+            details.append(describe_stats(message['stats']))
+        if not message.get('in_context', True):
+            details.append('not in context')
+        self.f.write(f"### {message['role']}\n\n_{' · '.join(details)}_\n\n{message['content']}\n\n")
+        
+    def end_conversation(self, conversation):
+        self.f.write("---\n\n")
+
+class JsonlExporter(Exporter):
+    """JSONL：每行一条消息，带所属对话的id和标题，可以再导入"""
+    label = 'JSONL'
+    extension = '.jsonl'
+    
+    def write_message(self, conversation, message):
+        record = {"conversation_id": conversation['id'], "conversation_title": conversation['title']}
+        record.update(message)
+        self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+class HtmlExporter(Exporter):
+    """单个HTML文件：每个对话一个区块，消息内容转义后原样保留换行"""
+    label = 'HTML'
+    extension = '.html'
+    STYLE = ("body{font-family:sans-serif;background:#f0f0f0;max-width:800px;margin:auto;padding:20px}"
+             ".msg{background:#fff;border-radius:6px;padding:8px 12px;margin:8px 0;white-space:pre-wrap}"
+             ".user{background:#95ec69}.system{background:#fff3cd}.meta{color:#999;font-size:12px}")
+    
+    def begin(self):
+        self.f.write(f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>EasyChat</title>"
+                     f"<style>{self.STYLE}</style></head><body>\n")
+        
+    def start_conversation(self, conversation):
+        self.f.write(f"<section><h1>{html.escape(conversation['title'])}</h1>"
+                     f"<p class=\"meta\">{format_timestamp(conversation['created_at'])}</p>\n")
+        
+    def write_message(self, conversation, message):
+        details = [message['role'], format_timestamp(message['created_at'])]
+        if message.get('model'):
+            details.append(message['model'])
+        if message.get('stats'):
+            details.append(describe_stats(message['stats']))
+        self.f.write(f"<div class=\"msg {html.escape(message['role'])}\"><div class=\"meta\">"
+                     f"{html.escape(' · '.join(details))}</div>{html.escape(message['content'])}</div>\n")
+        
+    def end_conversation(self, conversation):
+        self.f.write("</section>\n")
+        
+    def end(self):
+        self.f.write("</body></html>\n")
+
+class FineTuneExporter(Exporter):
+    """OpenAI微调格式的JSONL：每个对话一行 {"messages": [...]}，只保留计入上下文的问答"""
+    label = 'Fine-tuning JSONL'
+    extension = '.jsonl'
+    
+    def start_conversation(self, conversation):
+        self.messages = []
+        
+    def write_message(self, conversation, message):
+        if message.get('in_context', True) and message['role'] in ('system', 'user', 'assistant'):
+            self.messages.append({"role": message['role'], "content": message['content']})
+            
+    def end_conversation(self, conversation):
+        if any(message['role'] == 'assistant' for message in self.messages):
+            self.f.write(json.dumps({"messages": self.messages}, ensure_ascii=False) + "\n")
+        self.messages = []
+
+EXPORT_FORMATS = OrderedDict([
+    ('markdown', MarkdownExporter),
+    ('jsonl', JsonlExporter),
+    ('html', HtmlExporter),
+    ('finetune', FineTuneExporter),
+])
+
+def export_conversations(conversations, path, exporter_class, total=0, progress=None, stop=None):
+    """把 (对话, 消息迭代器) 逐条写入临时文件再原子替换目标文件；progress(已写, 总数) 每百条调用一次，返回写出的消息数"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.easychat-export-', suffix='.tmp', dir=directory)
+    written = 0
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as f:
+            exporter = exporter_class(f)
+            exporter.begin()
+            for conversation, messages in conversations:
+                exporter.start_conversation(conversation)
+                for message in messages:
+                    if stop is not None and stop.is_set():
+                        raise InterruptedError("export cancelled")
+                    exporter.write_message(conversation, message)
+                    written += 1
+                    if progress and written % 100 == 0:
+                        progress(written, total)
+                exporter.end_conversation(conversation)
+            exporter.end()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if progress:
+        progress(written, total)
+    return written
+
+IMPORT_ROLES = {'system': 'system', 'developer': 'system', 'user': 'user', 'assistant': 'assistant'}
+
+class JsonStream:
+    """增量读取JSON：按块解码，顶层数组的元素逐个产出，不把整个文件读入内存"""
+    CHUNK_SIZE = 1 << 16
+    
+    def __init__(self, f):
+        self.f = f  # 二进制文件
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        
+    def fill(self):
+        """再读入一块，返回是否读到了新数据"""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.CHUNK_SIZE)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(chunk, final=self.eof)
+        self.pos = 0
+        return bool(chunk)
+        
+    def peek(self):
+        """跳过空白并返回下一个字符，文件结束时返回空字符串"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n\ufeff':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+                
+    def expect(self, ch):
+        """读掉一个预期的分隔符"""
+        if self.peek() != ch:
+            raise ValueError(f"expected {ch!r} in JSON")
+        self.pos += 1
+        
+    def value(self):
+        """解码下一个完整的值，缓冲区不够时继续读"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buffer) and not self.eof and isinstance(value, (int, float)):
+                self.fill()  # 数字可能在块的边界处被截断
+                continue
+            self.pos = end
+            return value
+            
+    def items(self):
+        """逐个产出数组的元素（当前位置必须是 '['）"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+                
+    def members(self):
+        """逐个产出对象的键，调用方读取（或用 value() 跳过）对应的值"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+def import_time(value, default=None):
+    """导入文件中的时间转换为时间戳：数字、数字字符串或ISO 8601字符串（如 "2024-05-01T12:00:00Z"），
+    缺失或无法识别（包括超出本地时间范围）时返回 default"""
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            try:
+                parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith(('Z', 'z')) else value)
+                value = parsed.timestamp()
+            except (ValueError, OverflowError, OSError):
+                return default
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value or not math.isfinite(value):
+        return default
+    try:
+        datetime.fromtimestamp(value)  # 显示时会用到，毫秒时间戳等超出范围的值在这里被排除
+    except (ValueError, OverflowError, OSError):
+        return default
+    return float(value)
+
+def import_message(record, default_time=None):
+    """把各种形状的消息规范化为存储使用的字典，不支持的角色返回None"""
+    role = IMPORT_ROLES.get(record.get('role') or (record.get('author') or {}).get('role'))
+    content = record.get('content')
+    if isinstance(content, dict):  # ChatGPT导出：{"content_type": ..., "parts": [...]}
+        content = content.get('parts')
+    if isinstance(content, list):  # 多段内容：字符串或 {"type": "text", "text": ...}
+        content = "\n".join(part if isinstance(part, str) else part.get('text', '')
+                            for part in content if isinstance(part, (str, dict)))
+    if role is None or not isinstance(content, str) or not content:
+        return None
+    return {"role": role, "content": content,
+            "created_at": import_time(record.get('created_at'), import_time(record.get('create_time'))) or
+                          default_time or time.time(),
+            "model": record.get('model') or (record.get('metadata') or {}).get('model_slug'),
+            "in_context": record.get('in_context', True), "stats": record.get('stats')}
+
+def mapping_messages(mapping, current_node=None):
+    """ChatGPT导出的消息树：从当前节点沿父节点回溯得到对话主线"""
+    if current_node is None:
+        nodes = sorted(mapping.values(), key=lambda node: import_time((node.get('message') or {}).get('create_time'), 0))
+    else:
+        nodes = []
+        while current_node in mapping:
+            nodes.append(mapping[current_node])
+            current_node = mapping[current_node].get('parent')
+        nodes.reverse()
+    return [node['message'] for node in nodes if node.get('message')]
+
+def import_conversation(item, default_title):
+    """一个完整的对话对象（{"messages": [...]} 或带 mapping 的ChatGPT导出）转换为 (对话, 消息迭代器)"""
+    if 'mapping' in item:
+        records = mapping_messages(item['mapping'], item.get('current_node'))
+    else:
+        records = item.get('messages') or []
+    conversation = {"title": item.get('title') or default_title,
+                    "created_at": import_time(item.get('created_at'), import_time(item.get('create_time')))}
+    return conversation, filter(None, (import_message(record, conversation['created_at']) for record in records))
+
+def iter_jsonl_records(f):
+    """逐行读取JSONL，跳过空行"""
+    for line in f:
+        if line.strip():
+            record = json.loads(line)
+            if isinstance(record, dict):
+                yield record
+
+def iter_jsonl_import(f, default_title):
+    """JSONL：EasyChat导出的逐条消息（按conversation_id分组）、每行一个 {"messages": [...]}，或每行一条消息"""
+    def group_key(record):
+        if 'messages' in record or 'mapping' in record:
+            return ('item', id(record))
+        return ('conversation', record.get('conversation_id'), record.get('conversation_title'))
+        
+    for key, records in itertools.groupby(iter_jsonl_records(f), key=group_key):
+        if key[0] == 'item':
+            for record in records:
+                yield import_conversation(record, default_title)
+        else:
+            yield ({"title": key[2] or default_title, "created_at": None},
+                   filter(None, (import_message(record) for record in records)))
+
+def iter_json_import(f, default_title):
+    """JSON：消息数组、{"messages": [...]} 对象，或这两种对象组成的数组（包括ChatGPT导出的conversations.json）"""
+    stream = JsonStream(f)
+    if stream.peek() == '[':
+        items = stream.items()
+        first = next(items, None)
+        if isinstance(first, dict) and ('messages' in first or 'mapping' in first):
+            for item in itertools.chain([first], items):
+                if isinstance(item, dict):
+                    yield import_conversation(item, default_title)
+        elif first is not None:
+            # 顶层就是消息列表：整个文件是一个对话，消息边读边产出
+            yield ({"title": default_title, "created_at": None},
+                   filter(None, (import_message(record) for record in itertools.chain([first], items)
+                                 if isinstance(record, dict))))
+        return
+        
+    item = {}
+    for key in stream.members():
+        if key == 'messages' and stream.peek() == '[':
+            # 大文件里的消息数组不整体解码
+            conversation = {"title": item.get('title') or default_title,
+                            "created_at": import_time(item.get('created_at'), import_time(item.get('create_time')))}
+            yield conversation, filter(None, (import_message(record, conversation['created_at'])
+                                              for record in stream.items() if isinstance(record, dict)))
+            item = None
+        elif item is not None:
+            item[key] = stream.value()
+        else:
+            stream.value()
+    if item and 'mapping' in item:
+        yield import_conversation(item, default_title)
+
+IMPORT_FORMATS = {
+    '.jsonl': iter_jsonl_import,
+    '.json': iter_json_import,
+}
+
+class ResponseCache:
+    """回复缓存：内存中的LRU加SQLite磁盘缓存，以规范化请求体的哈希为键，超过有效期或容量时淘汰"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            used_at REAL NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_responses_used ON responses(used_at);
+    """
+    TRANSPORT_FIELDS = ('stream', 'stream_options')  # 只影响传输方式，不影响回复内容
+    
+    def __init__(self, path, memory_entries=200, max_bytes=50 * 1024 * 1024, ttl=86400):
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key -> (created_at, content)，最近使用的在末尾
+        self.hits = 0
+        self.misses = 0
+        # 界面线程只查内存LRU（memory_lock），磁盘缓存只在工作线程中读写，共用一个连接并由 lock 保护；
+        # 两把锁分开，界面线程不会等待磁盘读写
+        self.memory_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        with self.lock:
+            self.trim()
+            # 最近用过的回复预先读入内存，界面线程只查内存也能命中
+            rows = self.conn.execute("SELECT key, created_at, content FROM responses ORDER BY used_at DESC LIMIT ?",
+                                     (memory_entries,)).fetchall()
+        for key, created_at, content in reversed(rows):
+            self.remember(key, (created_at, content))
+            
+    @classmethod
+    def make_key(cls, api_url, data):
+        """规范化请求体（去掉传输相关字段、按键排序）后计算哈希"""
+        body = {key: value for key, value in data.items() if key not in cls.TRANSPORT_FIELDS}
+        text = json.dumps([api_url, body], sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+        
+    def peek(self, key):
+        """只在内存LRU中查找（不访问磁盘，可在界面线程中调用），未命中时返回None且不计入未命中次数"""
+        with self.memory_lock:
+            entry = self.memory.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+            
+    def get(self, key):
+        """查找缓存的回复（内存中没有时查询磁盘），未命中或已过期时返回None"""
+        now = time.time()
+        with self.memory_lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+        if entry is None:
+            with self.lock:
+                try:
+                    entry = self.conn.execute("SELECT created_at, content FROM responses WHERE key = ?",
+                                              (key,)).fetchone()
+                    if entry is not None:
+                        with self.conn:
+                            self.conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+                except sqlite3.Error:
+                    report_error("Cache error")
+                    entry = None
+            if entry is not None:
+                self.remember(key, tuple(entry))
+        with self.memory_lock:
+            if entry is None or now - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+            
+    def put(self, key, content):
+        """保存一条回复，磁盘缓存超过容量时淘汰最久未使用的回复"""
+        now = time.time()
+        size = len(content.encode('utf-8'))
+        self.remember(key, (now, content))
+        with self.lock:
+            try:
+                with self.conn:
+                    old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO responses (key, content, created_at, used_at, size) VALUES (?, ?, ?, ?, ?)",
+                        (key, content, now, now, size))
+                self.disk_bytes += size - (old[0] if old else 0)
+                if self.disk_bytes > self.max_bytes:
+                    self.trim()
+            except sqlite3.Error:
+                report_error("Cache error")
+                
+    def remember(self, key, entry):
+        """放入内存LRU"""
+        with self.memory_lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+            
+    def trim(self):
+        """删除过期的回复，并把磁盘缓存淘汰到容量的九成以下（调用方持有 lock）"""
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,))
+            self.disk_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if self.disk_bytes > self.max_bytes:
+                evicted = []
+                for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY used_at"):
+                    if self.disk_bytes <= self.max_bytes * 0.9:
+                        break
+                    evicted.append((key,))
+                    self.disk_bytes -= size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+                with self.memory_lock:
+                    for (key,) in evicted:
+                        self.memory.pop(key, None)
+                    
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()
+
+class ChatConfig:
+    """与界面无关的配置：API、网络、上下文窗口、速率限制和回复缓存，对应 easychat_config.ini 中的各节"""
+    DEFAULT_URL = "https://api.openai.com/v1/chat/completions"
+    
+    def __init__(self):
+        self.api_key = ''
+        self.api_url = self.DEFAULT_URL
+        self.model = 'gpt-3.5-turbo'
+        self.stream = True  # 是否流式输出回复
+        self.parallel_requests = 1  # 同时发送的最大请求数
+        self.temperature = 0.7
+        self.max_tokens = 2000  # 每次回复的最大token数
+        self.timeout = 30  # 请求超时（秒）
+        self.workers = 4  # 界面使用的常驻工作线程数
+        self.network = {
+            'pool_size': 10,
+            'proxy': '',
+            'verify_ssl': True,
+            'ca_bundle': '',
+            'stream_usage': True,  # 流式请求附带 stream_options.include_usage，以获得准确的token用量
+        }
+        self.metrics = {
+            'window': 200,  # 内存中保留的最近请求数
+            'file': '',  # 指标文件，为空时不写
+            'format': 'jsonl',  # jsonl 或 prometheus
+        }
+        self.retry = {
+            'max_attempts': 3,  # 包括第一次在内的最多请求次数
+            'base_delay': 0.5,  # 第一次重试前的最长等待（秒），之后每次翻倍
+            'max_delay': 8.0,
+            'max_retry_after': 60.0,  # Retry-After 超过此值时不再重试
+            'retry_statuses': '408,500,502,503,504',
+            'hedge': False,  # 首字节迟迟未到时发送重复请求
+            'hedge_percentile': 0.95,
+            'hedge_min_samples': 20,  # 最近的成功请求不足此数时不对冲
+            'hedge_min_delay': 0.5,
+        }
+        self.retry_overrides = {}  # 服务主机名 -> 覆盖的重试选项
+        self.router = {
+            'weight': 1.0,  # [API] 中的服务的权重
+            'probe_interval': 30.0,  # 有多个服务时后台健康检查的间隔（秒）
+            'failure_threshold': 3,  # 连续失败多少次后暂停使用一个服务
+        }
+        self.endpoints = []  # [Endpoint <名称>] 节中的其他服务
+        self.context_budget = 3000  # 未单独配置的模型的token预算
+        self.context_budgets = {}  # 模型 -> token预算
+        self.summary_tokens = 400
+        self.default_rpm = 3
+        self.default_tpm = 40000
+        self.rate_limits = {}  # 模型 -> (rpm, tpm)
+        self.cache_enabled = False
+        self.cache_file = 'easychat_cache.db'
+        self.cache = {
+            'memory_entries': 200,
+            'max_size_mb': 50,
+            'ttl_hours': 24,
+        }
+        
+    @classmethod
+    def load(cls, path="easychat_config.ini"):
+        """读取配置文件，文件不存在时使用默认配置"""
+        parser = configparser.ConfigParser()
+        if os.path.exists(path):
+            parser.read(path, encoding='utf-8')
+        return cls.from_parser(parser)
+        
+    @classmethod
+    def from_parser(cls, parser):
+        """从 ConfigParser 读取配置，缺少的项使用默认值"""
+        config = cls()
+        config.api_key = parser.get('API', 'key', fallback=config.api_key)
+        config.api_url = parser.get('API', 'url', fallback=config.api_url)
+        config.model = parser.get('API', 'model', fallback=config.model)
+        config.stream = parser.getboolean('API', 'stream', fallback=config.stream)
+        config.parallel_requests = parser.getint('API', 'parallel_requests', fallback=config.parallel_requests)
+        config.temperature = parser.getfloat('API', 'temperature', fallback=config.temperature)
+        config.max_tokens = parser.getint('API', 'max_tokens', fallback=config.max_tokens)
+        config.timeout = parser.getfloat('API', 'timeout', fallback=config.timeout)
+        config.workers = parser.getint('API', 'workers', fallback=config.workers)
+        
+        config.network = {
+            'pool_size': parser.getint('Network', 'pool_size', fallback=10),
+            'proxy': parser.get('Network', 'proxy', fallback=''),
+            'verify_ssl': parser.getboolean('Network', 'verify_ssl', fallback=True),
+            'ca_bundle': parser.get('Network', 'ca_bundle', fallback=''),
+            'stream_usage': parser.getboolean('Network', 'stream_usage', fallback=True),
+        }
+        config.metrics = {
+            'window': parser.getint('Metrics', 'window', fallback=200),
+            'file': parser.get('Metrics', 'file', fallback=''),
+            'format': parser.get('Metrics', 'format', fallback='jsonl').lower(),
+        }
+        
+        # 重试与对冲：[Retry] 中的选项对所有服务生效，<选项>.<主机名> 只对该服务生效，如 max_attempts.api.openai.com = 5
+        if parser.has_section('Retry'):
+            for key in parser.options('Retry'):
+                option, _, host = key.partition('.')
+                if option not in config.retry:
+                    continue
+                value = cls.get_typed(parser, 'Retry', key, config.retry[option])
+                if host:
+                    config.retry_overrides.setdefault(host, {})[option] = value
+                else:
+                    config.retry[option] = value
+                    
+        # 多个服务：[API] 中的地址和密钥之外，每个 [Endpoint <名称>] 节是一个服务，有各自的密钥、权重、模型和速率限制
+        config.router = {
+            'weight': parser.getfloat('Router', 'weight', fallback=1.0),
+            'probe_interval': parser.getfloat('Router', 'probe_interval', fallback=30.0),
+            'failure_threshold': parser.getint('Router', 'failure_threshold', fallback=3),
+        }
+        for section in parser.sections():
+            if section.startswith('Endpoint ') and section[len('Endpoint '):].strip():
+                config.endpoints.append(config.parse_endpoint(parser, section))
+        
+        # 上下文窗口：各模型的token预算写在 [Context] 中，如 budget.gpt-4 = 6000
+        config.context_budget = parser.getint('Context', 'default_budget', fallback=config.context_budget)
+        config.summary_tokens = parser.getint('Context', 'summary_tokens', fallback=config.summary_tokens)
+        if parser.has_section('Context'):
+            for key, value in parser.items('Context'):
+                if key.startswith('budget.'):
+                    config.context_budgets[key[len('budget.'):]] = int(value)
+                    
+        # 速率限制：[RateLimits] 中可按模型配置，如 rpm.gpt-4 = 500、tpm.gpt-4 = 10000
+        config.default_rpm = parser.getint('RateLimits', 'default_rpm', fallback=config.default_rpm)
+        config.default_tpm = parser.getint('RateLimits', 'default_tpm', fallback=config.default_tpm)
+        config.rate_limits = cls.parse_model_limits(parser, 'RateLimits', config.default_rpm, config.default_tpm)
+                    
+        config.cache_enabled = parser.getboolean('Cache', 'enabled', fallback=config.cache_enabled)
+        config.cache_file = parser.get('Cache', 'database', fallback=config.cache_file)
+        config.cache = {
+            'memory_entries': parser.getint('Cache', 'memory_entries', fallback=200),
+            'max_size_mb': parser.getint('Cache', 'max_size_mb', fallback=50),
+            'ttl_hours': parser.getfloat('Cache', 'ttl_hours', fallback=24),
+        }
+        return config
+        
+    @staticmethod
+    def get_typed(parser, section, key, default):
+        """按默认值的类型读取一个选项"""
+        if isinstance(default, bool):
+            return parser.getboolean(section, key)
+        if isinstance(default, int):
+            return parser.getint(section, key)
+        if isinstance(default, float):
+            return parser.getfloat(section, key)
+        return parser.get(section, key)
+        
+    @staticmethod
+    def parse_model_limits(parser, section, default_rpm, default_tpm):
+        """读取节中按模型配置的 rpm.<模型> / tpm.<模型>，返回 {模型: (rpm, tpm)}"""
+        limits = {}
+        if parser.has_section(section):
+            for key, value in parser.items(section):
+                kind, _, model = key.partition('.')
+                if kind in ('rpm', 'tpm') and model:
+                    rpm, tpm = limits.get(model, (default_rpm, default_tpm))
+                    limits[model] = (int(value), tpm) if kind == 'rpm' else (rpm, int(value))
+        return limits
+        
+    def parse_endpoint(self, parser, section):
+        """读取一个 [Endpoint <名称>] 节：url、key、weight、models（可用的模型，为空表示全部）、
+        model.<模型> = 该服务上的模型名、rpm / tpm 及 rpm.<模型> / tpm.<模型>，以及覆盖 [Retry] 的选项"""
+        rpm = parser.getint(section, 'rpm', fallback=self.default_rpm)
+        tpm = parser.getint(section, 'tpm', fallback=self.default_tpm)
+        endpoint = {
+            'name': section[len('Endpoint '):].strip(),
+            'url': parser.get(section, 'url', fallback=self.DEFAULT_URL),
+            'key': parser.get(section, 'key', fallback=''),
+            'weight': parser.getfloat(section, 'weight', fallback=1.0),
+            'models': [model.strip() for model in parser.get(section, 'models', fallback='').split(',') if model.strip()],
+            'model_map': {},
+            'rpm': rpm,
+            'tpm': tpm,
+            'rate_limits': self.parse_model_limits(parser, section, rpm, tpm),
+            'retry': {},
+        }
+        for key in parser.options(section):
+            if key.startswith('model.'):
+                endpoint['model_map'][key[len('model.'):]] = parser.get(section, key).strip()
+            elif key in self.retry:
+                endpoint['retry'][key] = self.get_typed(parser, section, key, self.retry[key])
+        return endpoint
+        
+    def save_to(self, parser):
+        """写回 ConfigParser：界面中可修改的项每次更新，只在配置文件中编辑的节不存在时写入默认值方便修改"""
+        if 'API' not in parser:
+            parser.add_section('API')
+        if 'Network' not in parser:
+            parser.add_section('Network')
+            for key, value in self.network.items():
+                parser.set('Network', key, str(value).lower() if isinstance(value, bool) else str(value))
+        if 'Context' not in parser:
+            parser.add_section('Context')
+            parser.set('Context', 'default_budget', str(self.context_budget))
+            parser.set('Context', 'summary_tokens', str(self.summary_tokens))
+            for model, budget in ContextWindow.DEFAULT_BUDGETS.items():
+                parser.set('Context', 'budget.' + model, str(budget))
+        if 'Cache' not in parser:
+            parser.add_section('Cache')
+            parser.set('Cache', 'database', self.cache_file)
+            for key, value in self.cache.items():
+                parser.set('Cache', key, str(value))
+        if 'Metrics' not in parser:
+            parser.add_section('Metrics')
+            for key, value in self.metrics.items():
+                parser.set('Metrics', key, str(value))
+        if 'Retry' not in parser:
+            parser.add_section('Retry')
+            for key, value in self.retry.items():
+                parser.set('Retry', key, str(value).lower() if isinstance(value, bool) else str(value))
+        if 'Router' not in parser:
+            parser.add_section('Router')
+            for key, value in self.router.items():
+                parser.set('Router', key, str(value))
+        if 'RateLimits' not in parser:
+            parser.add_section('RateLimits')
+            parser.set('RateLimits', 'default_rpm', str(self.default_rpm))
+            parser.set('RateLimits', 'default_tpm', str(self.default_tpm))
+            
+        parser.set('API', 'key', self.api_key)
+        parser.set('API', 'url', self.api_url)
+        parser.set('API', 'model', self.model)
+        parser.set('API', 'stream', str(self.stream).lower())
+        parser.set('API', 'parallel_requests', str(self.parallel_requests))
+        parser.set('Cache', 'enabled', str(self.cache_enabled).lower())
+        
+    def retry_policy(self, api_url, overrides=None):
+        """某个服务的重试策略：[Retry] 的选项，加上该主机的覆盖项和服务自己的覆盖项"""
+        host = (urlsplit(api_url).hostname or '').lower()
+        return RetryPolicy(**dict(self.retry, **self.retry_overrides.get(host, {}), **(overrides or {})))
+
+class ChatError(Exception):
+    """请求失败：kind 为 timeout、connection、rate_limit、status、cancelled 或 error，details 为服务端返回的错误信息"""
+    def __init__(self, kind, details=None, status_code=None, retry_after=None):
+        super().__init__(details or kind)
+        self.kind = kind
+        self.details = details
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class ChatResult:
+    """一次请求的结果：成功时 content 为回复文本，失败时 error 为 ChatError，流式回复中途失败或被取消时 content 为已收到的部分"""
+    __slots__ = ('content', 'error', 'stats', 'cached', 'streamed')
+    
+    def __init__(self, content=None, error=None, stats=None, cached=False, streamed=False):
+        self.content = content
+        self.error = error
+        self.stats = stats  # 请求的耗时分解和token用量（见 ChatEngine.send）
+        self.cached = cached
+        self.streamed = streamed
+        
+    @property
+    def ok(self):
+        return self.error is None
+
+class RetryPolicy:
+    """重试与对冲策略：超时、连接失败、429和部分5xx按指数退避加随机抖动重试，至少等待服务端要求的 Retry-After；
+    启用对冲时，首字节的等待超过最近成功请求的百分位数，就再发一个相同的请求，使用先成功返回的那个"""
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0, max_retry_after=60.0,
+                 retry_statuses='408,500,502,503,504', hedge=False, hedge_percentile=0.95, hedge_min_samples=20,
+                 hedge_min_delay=0.5):
+        self.max_attempts = max(int(max_attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = {int(status) for status in str(retry_statuses).split(',') if status.strip()}
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.rng = random.Random()
+        
+    def retryable(self, error):
+        """判断错误是否可能在重试后消失（请求错误、认证失败等不重试）"""
+        if error.kind in ('timeout', 'connection'):
+            return True
+        if error.kind == 'rate_limit':
+            return error.retry_after is None or error.retry_after <= self.max_retry_after
+        return error.kind == 'status' and error.status_code in self.retry_statuses
+        
+    def delay(self, attempt, error):
+        """第 attempt 次请求失败后，到下一次请求要等待的秒数；不再重试时返回None"""
+        if attempt >= self.max_attempts or not self.retryable(error):
+            return None
+        # full jitter：在 [0, 指数退避上限] 中随机取值，避免多个客户端同时重试
+        backoff = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if error.retry_after is not None:
+            backoff = max(backoff, error.retry_after)
+        return backoff
+        
+    def hedge_delay(self, metrics, **match):
+        """发出重复请求前等待首字节的秒数，未启用对冲或样本不足时返回None"""
+        if not self.hedge:
+            return None
+        threshold = metrics.percentile('ttfb', self.hedge_percentile, self.hedge_min_samples, status=200, **match)
+        return None if threshold is None else max(threshold, self.hedge_min_delay)
+
+class RequestMetrics:
+    """每个请求的耗时分解：内存中保留最近的若干条，可选追加到JSONL文件或写成Prometheus文本格式"""
+    PHASES = ('queue', 'connect', 'ttfb', 'ttft', 'total')
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self, window=200, file='', format='jsonl'):
+        self.recent = deque(maxlen=max(window, 1))  # 最近的请求，供状态栏和分位数使用
+        self.path = file  # 为空时不写文件
+        self.format = format  # jsonl 或 prometheus
+        self.lock = threading.Lock()
+        self.requests = Counter()  # (服务, 模型, 状态) -> 请求数
+        self.phase_sums = Counter()  # 阶段 -> 累计秒数
+        self.phase_counts = Counter()
+        self.tokens = Counter()  # prompt / completion -> 累计token数
+        
+    def record(self, timing):
+        """记录一个已结束的请求（可在任意线程调用）"""
+        with self.lock:
+            self.recent.append(timing)
+            self.requests[(timing.get("endpoint", "default"), timing["model"], str(timing["status"]))] += 1
+            for phase in self.PHASES:
+                if timing.get(phase) is not None:
+                    self.phase_sums[phase] += timing[phase]
+                    self.phase_counts[phase] += 1
+            for kind in ('prompt', 'completion'):
+                self.tokens[kind] += timing.get(kind + "_tokens") or 0
+            if self.path:
+                try:
+                    if self.format == 'prometheus':
+                        self.write_prometheus()
+                    else:
+                        with open(self.path, 'a', encoding='utf-8') as f:
+                            f.write(json.dumps(timing, ensure_ascii=False) + "\n")
+                except OSError:
+                    report_error("Metrics error")
+                    
+    def last(self):
+        """最近一个请求的耗时分解"""
+        with self.lock:
+            return self.recent[-1] if self.recent else None
+            
+    def percentile(self, phase, fraction, min_samples=1, **match):
+        """最近若干个请求中某个阶段耗时的百分位数，只统计与 match 中各字段相同的请求；样本不足时返回None"""
+        with self.lock:
+            values = sorted(timing[phase] for timing in self.recent if timing.get(phase) is not None
+                            and all(timing.get(key) == value for key, value in match.items()))
+        return percentile(values, fraction) if values and len(values) >= min_samples else None
+        
+    def write_prometheus(self):
+        """以Prometheus文本格式（供 node_exporter 的 textfile 收集器读取）原子地重写指标文件"""
+        lines = ["# HELP easychat_requests_total Finished chat completion requests.",
+                 "# TYPE easychat_requests_total counter"]
+        for (endpoint, model, status), count in sorted(self.requests.items()):
+            lines.append(f'easychat_requests_total{{endpoint="{endpoint}",model="{model}",status="{status}"}} {count}')
+        lines += ["# HELP easychat_request_phase_seconds Request time by phase over the recent window.",
+                  "# TYPE easychat_request_phase_seconds summary"]
+        for phase in self.PHASES:
+            values = sorted(timing[phase] for timing in self.recent if timing.get(phase) is not None)
+            for fraction in self.QUANTILES:
+                if values:
+                    lines.append(f'easychat_request_phase_seconds{{phase="{phase}",quantile="{fraction}"}} '
+                                 f'{percentile(values, fraction):.6f}')
+            lines.append(f'easychat_request_phase_seconds_sum{{phase="{phase}"}} {self.phase_sums[phase]:.6f}')
+            lines.append(f'easychat_request_phase_seconds_count{{phase="{phase}"}} {self.phase_counts[phase]}')
+        lines += ["# HELP easychat_tokens_total Tokens reported in the usage field of responses.",
+                  "# TYPE easychat_tokens_total counter"]
+        for kind in ('prompt', 'completion'):
+            lines.append(f'easychat_tokens_total{{type="{kind}"}} {self.tokens[kind]}')
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
+
+class ChatEngine:
+    """与界面无关的聊天核心：对话历史、上下文窗口、请求构造、速率限制、回复缓存和HTTP传输。
+    send 会阻塞直到请求结束，回调在调用 send 的线程中执行；脚本、测试可以直接使用，界面在工作线程中调用"""
+    def __init__(self, config=None, runner=None):
+        self.config = config or ChatConfig()
+        self.history = []  # 计入上下文的消息 {"role": ..., "content": ...}
+        self.context_window = ContextWindow(
+            default_budget=self.config.context_budget,
+            budgets=self.config.context_budgets,
+            summary_tokens=self.config.summary_tokens,
+            summarizer=self.summarize,
+            runner=runner  # runner(func)，在后台执行摘要请求
+        )
+        self.router = EndpointRouter(self.build_endpoints(), self.config.router['failure_threshold'])
+        self.transport_lock = threading.Lock()
+        self.attempt_pool = None  # 对冲时并行发出请求的常驻线程池，第一次对冲时创建
+        self.response_cache = None  # 回复缓存，启用后首次使用时打开
+        self.cache_lock = threading.Lock()
+        self.metrics = RequestMetrics(**self.config.metrics)
+        self.closing = threading.Event()  # 关闭时中断重试前的等待和健康检查
+        if len(self.router.endpoints) > 1 and self.config.router['probe_interval'] > 0:
+            threading.Thread(target=self.health_loop, daemon=True).start()
+            
+    def build_endpoints(self):
+        """[API] 中的服务（名为 default）和各个 [Endpoint] 节中的服务"""
+        config = self.config
+        endpoints = [Endpoint('default', config.api_url, config.api_key, config.router['weight'],
+                              limiter=RateLimiter(config.default_rpm, config.default_tpm, config.rate_limits))]
+        names = {'default'}
+        for options in config.endpoints:
+            if options['name'] in names:
+                continue
+            names.add(options['name'])
+            endpoints.append(Endpoint(options['name'], options['url'], options['key'], options['weight'],
+                                      options['models'], options['model_map'],
+                                      RateLimiter(options['rpm'], options['tpm'], options['rate_limits']),
+                                      options['retry']))
+        return endpoints
+        
+    def build_context(self, message, model=None):
+        """把新消息接在历史之后，按模型的token预算裁剪，返回 (messages, stats)"""
+        history = self.history + [{"role": "user", "content": message}]
+        return self.context_window.build(history, model or self.config.model)
+        
+    def request_tokens(self, context_stats):
+        """一次请求最多消耗的token数（上下文加回复上限），用于速率限制"""
+        return context_stats["tokens"] + self.config.max_tokens
+        
+    def commit(self, message, reply):
+        """把完成的一轮对话加入历史"""
+        self.history.append({"role": "user", "content": message})
+        self.history.append({"role": "assistant", "content": reply})
+        
+    def reset(self):
+        """清空对话历史"""
+        self.history.clear()
+        
+    def build_request(self, messages, model=None):
+        """构造聊天请求体（不含传输方式相关的字段）"""
+        return {
+            "model": model or self.config.model,
+            "messages": messages,
+            "temperature": self.config.temperature,
+            "max_tokens": self.config.max_tokens
+        }
+        
+    def acquire(self, model, tokens, stop=None):
+        """阻塞等待速率限制的额度，stop（threading.Event）被设置时放弃并返回False"""
+        while True:
+            wait = self.router.reserve(model, tokens)
+            if wait <= 0:
+                return True
+            if stop is not None and stop.wait(min(wait, 1.0)):
+                return False
+            if stop is None:
+                time.sleep(min(wait, 1.0))
+                
+    def get_response_cache(self):
+        """获取回复缓存，首次使用时打开缓存数据库，打开失败时关闭缓存"""
+        with self.cache_lock:
+            if self.response_cache is None and self.config.cache_enabled:
+                try:
+                    self.response_cache = ResponseCache(
+                        self.config.cache_file,
+                        memory_entries=self.config.cache['memory_entries'],
+                        max_bytes=self.config.cache['max_size_mb'] * 1024 * 1024,
+                        ttl=self.config.cache['ttl_hours'] * 3600
+                    )
+                except sqlite3.Error:
+                    report_error("Cache error")
+                    self.config.cache_enabled = False
+            return self.response_cache
+            
+    def cache_lookup(self, messages, model=None, memory_only=False):
+        """查找缓存的回复，返回 (缓存键, 回复)；未启用缓存时返回 (None, None)。
+        memory_only 时只查内存LRU、不打开缓存数据库，可在界面线程中调用，之后由工作线程用 cached_reply 查磁盘"""
+        if not self.config.cache_enabled:
+            return None, None
+        cache = self.response_cache if memory_only else self.get_response_cache()
+        if cache is None and not memory_only:
+            return None, None
+        key = ResponseCache.make_key(self.config.api_url, self.build_request(messages, model))
+        if cache is None:
+            return key, None
+        return key, cache.peek(key) if memory_only else cache.get(key)
+        
+    def cached_reply(self, cache_key):
+        """按缓存键查找回复（包括磁盘缓存，需要时打开缓存数据库），在工作线程中调用"""
+        cache = self.get_response_cache()
+        return cache.get(cache_key) if cache is not None else None
+        
+    def send(self, messages, model=None, stream=None, cache_key=None, on_start=None, on_delta=None, queued_at=None,
+             on_retry=None, stop=None):
+        """发送一次请求并等待结束，不抛出异常；流式回复时收到第一个片段调用 on_start()，每个片段调用 on_delta(text)。
+        每次请求由 self.router 选择服务，可重试的错误按该服务的重试策略等待后重试（优先换一个服务），
+        重试前调用 on_retry(已请求次数, 等待秒数, ChatError)，回复已开始输出后不再重试；
+        stop（threading.Event）被设置时放弃等待，返回最后一次的错误；stop 为 CancelToken 时还会关闭进行中的请求的连接，
+        返回错误类型为 cancelled 的结果，content 为已收到的部分回复。调用前应已用 acquire（或 router.reserve）
+        预留速率额度，调用时已经取消的话放弃这份预留。
+        result.stats 为最后一次请求的耗时分解（秒）：queue 从 queued_at（重试时为上次失败）到发出请求、connect 新建连接、
+        ttfb 收到响应头、ttft 收到第一个片段、total 总耗时，以及 usage 中的token数和生成速度；每次请求都记录到 self.metrics"""
+        model = model or self.config.model
+        stream = self.config.stream if stream is None else stream
+        data = self.build_request(messages, model)
+        if stream:
+            data["stream"] = True
+            if self.config.network['stream_usage']:
+                data["stream_options"] = {"include_usage": True}
+        tokens = sum(message_tokens(m) for m in messages) + self.config.max_tokens
+        
+        started = []
+        def start():
+            started.append(True)
+            if on_start:
+                on_start()
+        
+        if stop is not None and stop.is_set():
+            self.router.cancel_reservation(model)  # 调用方为这次请求预留的额度不会再用到
+            return ChatResult(error=ChatError('cancelled'))
+        attempt = 1
+        endpoint = None
+        try:
+            while True:
+                endpoint = self.router.acquire(model, avoid=endpoint)
+                policy = self.config.retry_policy(endpoint.url, endpoint.retry)
+                result = self.attempt(endpoint, policy, data, model, stream, tokens, attempt, queued_at, start, on_delta,
+                                      stop)
+                delay = policy.delay(attempt, result.error) if not result.ok and not started else None
+                if delay is None:
+                    break
+                if on_retry:
+                    on_retry(attempt, delay, result.error)
+                queued_at = time.perf_counter()
+                if (stop or self.closing).wait(delay) or not self.acquire(model, tokens, stop or self.closing):
+                    break
+                attempt += 1
+        finally:
+            if isinstance(stop, CancelToken):
+                stop.finish()
+        
+        if cache_key is not None and result.ok and result.content and self.response_cache is not None:
+            self.response_cache.put(cache_key, result.content)
+        return result
+        
+    def attempt(self, endpoint, policy, data, model, stream, tokens, attempt, queued_at, on_start, on_delta, stop=None):
+        """向选中的服务发送一次请求（必要时对冲），记录耗时分解，返回 ChatResult"""
+        request_start = time.perf_counter()
+        timing = {
+            "time": time.time(),
+            "endpoint": endpoint.name,  # 对冲时为使用了其响应的服务
+            "model": model,
+            "stream": stream,
+            "attempt": attempt,
+            "hedged": False,  # 是否发出了重复请求
+            "status": None,  # HTTP状态码，未收到响应时为错误类型
+            "queue": max(request_start - queued_at, 0.0) if queued_at is not None else 0.0,
+            "connect": None,
+            "ttfb": None,
+            "ttft": None,
+            "total": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "tokens_per_sec": None,
+        }
+        hedge_delay = policy.hedge_delay(self.metrics, model=model, stream=stream, endpoint=endpoint.name)
+        result = self.request(endpoint, data, model, stream, tokens, hedge_delay, timing, request_start,
+                              on_start, on_delta, stop)
+        timing["total"] = time.perf_counter() - request_start
+        if not result.ok and result.error.status_code is None:
+            timing["status"] = result.error.kind  # 没有收到响应，或读取回复时出错
+        if result.ok and timing["tokens_per_sec"] is None and timing["completion_tokens"]:
+            # 非流式回复在返回响应头之前就已生成完毕，按总耗时计算
+            timing["tokens_per_sec"] = timing["completion_tokens"] / timing["total"] if timing["total"] > 0 else 0.0
+        self.router.release(timing["endpoint"], timing["status"])
+        result.stats = timing
+        self.metrics.record(timing)
+        return result
+        
+    def request(self, endpoint, data, model, stream, tokens, hedge_delay, timing, request_start,
+                on_start=None, on_delta=None, stop=None):
+        """执行HTTP请求并把各阶段的耗时写入 timing，返回 ChatResult；出错时保留流式回复已收到的部分"""
+        chunks = []
+        try:
+            response, endpoint = self.open_response(endpoint, data, model, stream, tokens, hedge_delay, timing,
+                                                    request_start, stop)
+            timing["status"] = response.status_code
+            endpoint.limiter.update_from_headers(model, response.headers)
+            if response.status_code != 200:
+                return ChatResult(error=self.status_error(endpoint, model, response))
+        
+            if stream and 'text/event-stream' in response.headers.get('Content-Type', ''):
+                content, stats = self.receive_stream(response, request_start, on_start, on_delta, chunks, stop)
+                timing.update(stats)
+                return ChatResult(content, streamed=True)
+            # 服务端不支持流式输出时按普通响应处理
+            body = response.json()
+            usage = body.get('usage') or {}
+            timing["prompt_tokens"] = usage.get('prompt_tokens')
+            timing["completion_tokens"] = usage.get('completion_tokens')
+            return ChatResult(body['choices'][0]['message']['content'])
+        except Exception as e:
+            if stop is not None and stop.is_set():
+                error = ChatError('cancelled')  # 取消时关闭连接引起的错误
+            elif isinstance(e, requests.exceptions.Timeout):
+                error = ChatError('timeout')
+            elif isinstance(e, requests.exceptions.ConnectionError):
+                error = ChatError('connection')
+            else:
+                error = ChatError('error', str(e))
+            return ChatResult("".join(chunks) or None, error=error, streamed=bool(chunks))
+        
+    def open_response(self, endpoint, data, model, stream, tokens, hedge_delay, timing, request_start, stop=None):
+        """发出请求，收到响应头时返回 (响应, 服务)，并在 timing 中记录 connect 和 ttfb。
+        hedge_delay 不为None时，等待这么久仍未收到响应头，就在有速率额度的另一个服务（只有一个服务时为同一个）上
+        再发一个相同的请求：使用先成功的响应，都失败时使用先返回的结果，用不上的响应在返回后关闭"""
+        if hedge_delay is None:
+            transport = self.transport_for(endpoint)
+            try:
+                response = transport.post(dict(data, model=endpoint.upstream_model(model)),
+                                          timeout=self.config.timeout, stream=stream, cancel=stop)
+            finally:
+                timing["connect"] = transport.last_connect_time()
+            timing["ttfb"] = response.elapsed.total_seconds()  # 从发出请求到解析完响应头
+            return response, endpoint
+        
+        outcomes = queue.Queue()
+        lock = threading.Lock()
+        decided = []
+        
+        def run(target):
+            # 总是按流式读取，post 在收到响应头时就返回，非流式回复的正文稍后由 response.json() 读取
+            transport = self.transport_for(target)
+            try:
+                response, error = transport.post(dict(data, model=target.upstream_model(model)),
+                                                 timeout=self.config.timeout, stream=True, cancel=stop), None
+            except Exception as e:
+                response, error = None, ChatError('cancelled') if stop is not None and stop.is_set() else e
+            outcome = (response, error, transport.last_connect_time(), time.perf_counter(), target)
+            with lock:
+                if not decided:
+                    outcomes.put(outcome)
+                    return
+            self.discard_outcome(outcome)
+        
+        pool = self.get_attempt_pool()
+        pool.submit(run, endpoint)
+        pending = 1
+        try:
+            outcome = outcomes.get(timeout=hedge_delay)
+        except queue.Empty:
+            outcome = None
+            if self.router.reserve(model, tokens, avoid=endpoint) <= 0:
+                target = self.router.acquire(model, avoid=endpoint)
+                pool.submit(run, target)
+                pending += 1
+                timing["hedged"] = True
+        
+        failures = []
+        while True:
+            if outcome is None:
+                outcome = outcomes.get()
+            pending -= 1
+            response = outcome[0]
+            if response is not None and response.status_code == 200:
+                break
+            failures.append(outcome)
+            outcome = None
+            if pending == 0:
+                break
+        chosen = outcome or failures[0]
+        with lock:
+            decided.append(True)
+            while not outcomes.empty():
+                failures.append(outcomes.get())
+        for other in failures:
+            if other is not chosen:
+                self.discard_outcome(other)
+        
+        response, error, connect, arrived, winner = chosen
+        timing["endpoint"] = winner.name
+        timing["connect"] = connect
+        if error is not None:
+            raise error
+        timing["ttfb"] = arrived - request_start  # 对冲时包括发出重复请求前的等待
+        return response, winner
+        
+    def discard_outcome(self, outcome):
+        """关闭对冲中用不上的响应，并把结果计入该服务的健康状态"""
+        response, error, _, _, target = outcome
+        if response is not None:
+            status = response.status_code if response.status_code != 200 else None
+            response.close()
+        elif isinstance(error, ChatError):
+            status = error.kind
+        else:
+            status = 'timeout' if isinstance(error, requests.exceptions.Timeout) else 'connection'
+        self.router.release(target.name, status)
+        
+    def status_error(self, endpoint, model, response):
+        """把非200的响应转换为 ChatError，429时按 Retry-After 暂停该服务上该模型的发送"""
+        try:
+            error_response = response.json()
+            details = error_response['error'].get('message', '') if 'error' in error_response else None
+        except ValueError:
+            details = None
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if response.status_code == 429:
+            if retry_after is None:
+                retry_after = 60
+                endpoint.limiter.update_from_headers(model, {'Retry-After': str(retry_after)})
+            return ChatError('rate_limit', details, 429, retry_after)
+        return ChatError('status', details, response.status_code, retry_after)
+        
+    def receive_stream(self, response, request_start, on_start=None, on_delta=None, chunks=None, stop=None):
+        """逐块接收流式回复（SSE），返回 (回复文本, 统计数据)；收到的片段同时追加到 chunks，出错时调用方仍能取得部分回复"""
+        chunks = [] if chunks is None else chunks
+        token_count = 0
+        usage = {}
+        first_token_time = None
+        
+        try:
+            for payload in iter_sse_data(response.iter_lines(chunk_size=None)):
+                if payload == "[DONE]":
+                    break
+                if stop is not None and stop.is_set():
+                    raise ChatError('cancelled')
+                event = json.loads(payload)
+                if event.get('usage'):
+                    usage = event['usage']
+                if 'error' in event:
+                    raise ValueError(event['error'].get('message', payload))
+                for choice in event.get('choices', []):
+                    delta = choice.get('delta', {}).get('content')
+                    if not delta:
+                        continue
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                        if on_start:
+                            on_start()
+                    chunks.append(delta)
+                    token_count += 1  # 每个数据块大致对应一个token
+                    if on_delta:
+                        on_delta(delta)
+        finally:
+            response.close()
+        
+        end_time = time.perf_counter()
+        if first_token_time is None:
+            first_token_time = end_time
+            if on_start:
+                on_start()
+        
+        # 统计首字延迟与生成速度，服务端没有返回用量时按片段数估算
+        tokens = usage.get('completion_tokens') or token_count
+        generation_time = end_time - first_token_time
+        stats = {
+            "ttft": first_token_time - request_start,
+            "prompt_tokens": usage.get('prompt_tokens'),
+            "completion_tokens": tokens,
+            "tokens_per_sec": tokens / generation_time if generation_time > 0 else 0.0,
+        }
+        return "".join(chunks), stats
+        
+    def probe(self, api_url=None, api_key=None, model=None):
+        """发送一个简短请求测试连接，返回HTTP状态码；地址或密钥与当前连接不同时使用临时连接"""
+        data = {
+            "model": model or self.config.model,
+            "messages": [{"role": "user", "content": "Hello"}],
+            "max_tokens": 10
+        }
+        api_url = api_url or self.config.api_url
+        api_key = api_key or self.config.api_key
+        transport = self.get_transport()
+        if not transport.matches(api_url, api_key):
+            transport = self.create_transport(api_url, api_key)
+        try:
+            return transport.post(data, timeout=10).status_code
+        finally:
+            if transport is not self.router.endpoints[0].transport:
+                transport.close()
+                
+    def check_health(self):
+        """检查所有服务并更新路由中的健康状态，返回 {服务名: HTTP状态码或错误类型}"""
+        results = {}
+        for endpoint in self.router.endpoints:
+            try:
+                status = self.transport_for(endpoint).probe()
+            except requests.exceptions.Timeout:
+                status = 'timeout'
+            except requests.exceptions.RequestException:
+                status = 'connection'
+            self.router.mark_probe(endpoint, status)
+            results[endpoint.name] = status
+        return results
+        
+    def health_loop(self):
+        """后台健康检查线程：启动时和之后每隔 probe_interval 秒检查一次，关闭时退出"""
+        while True:
+            self.check_health()
+            if self.closing.wait(self.config.router['probe_interval']):
+                return
+                
+    def summarize(self, messages, previous_summary):
+        """请求模型为较早的对话生成摘要（由上下文窗口在后台线程中调用）"""
+        transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if previous_summary:
+            transcript = f"Existing summary:\n{previous_summary}\n\nNew messages:\n{transcript}"
+        data = {
+            "model": self.config.model,
+            "messages": [
+                {"role": "system", "content": "Summarize the conversation below for use as context in a later request. "
+                                              "Keep facts, decisions, names, numbers and code identifiers. "
+                                              "Answer in the language of the conversation, in at most 200 words."},
+                {"role": "user", "content": transcript}
+            ],
+            "temperature": 0.2,
+            "max_tokens": self.context_window.summary_tokens
+        }
+        response = self.get_transport().post(data, timeout=60)
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+        
+    def get_attempt_pool(self):
+        """对冲请求使用的线程池，大小与连接池相同；不用界面的线程池，因为调用 send 的工作线程要等这些任务完成，
+        共用时线程全被等待中的 send 占满就会互相等待"""
+        with self.transport_lock:
+            if self.attempt_pool is None:
+                self.attempt_pool = WorkerPool(self.config.network['pool_size'])
+            return self.attempt_pool
+            
+    def get_transport(self):
+        """[API] 中的服务的传输层，用于摘要和测试连接"""
+        return self.transport_for(self.router.endpoints[0])
+        
+    def transport_for(self, endpoint):
+        """获取服务共享的HTTP传输层，不存在时按当前配置创建"""
+        with self.transport_lock:
+            if endpoint.transport is None:
+                endpoint.transport = self.create_transport(endpoint.url, endpoint.key)
+            return endpoint.transport
+            
+    def create_transport(self, api_url, api_key):
+        """按网络配置创建传输层"""
+        return ApiTransport(
+            api_url,
+            api_key,
+            pool_size=self.config.network['pool_size'],
+            proxy=self.config.network['proxy'],
+            verify_ssl=self.config.network['verify_ssl'],
+            ca_bundle=self.config.network['ca_bundle']
+        )
+        
+    def reset_transport(self):
+        """丢弃所有服务的现有连接，下次请求时重新创建传输层"""
+        with self.transport_lock:
+            for endpoint in self.router.endpoints:
+                if endpoint.transport is not None:
+                    endpoint.transport.close()
+                    endpoint.transport = None
+                    
+    def apply_config(self):
+        """配置修改后调用：只有 [API] 中的地址或密钥改变时才重建该服务的连接"""
+        primary = self.router.endpoints[0]
+        primary.weight = max(self.config.router['weight'], 0.01)
+        if primary.url == self.config.api_url and primary.key == self.config.api_key:
+            return
+        with self.transport_lock:
+            primary.url, primary.key = self.config.api_url, self.config.api_key
+            if primary.transport is not None:
+                primary.transport.close()
+                primary.transport = None
+        with self.router.lock:
+            primary.failures = 0  # 新的地址或密钥重新计算健康状态
+            primary.healthy = True
+            
+    def close(self):
+        """关闭连接和缓存"""
+        self.closing.set()
+        self.reset_transport()
+        with self.transport_lock:
+            if self.attempt_pool is not None:
+                self.attempt_pool.shutdown()
+                self.attempt_pool = None
+        with self.cache_lock:
+            if self.response_cache is not None:
+                self.response_cache.close()
+                self.response_cache = None
+
+def percentile(values, fraction):
+    """计算已排序数据的百分位数（线性插值）"""
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def read_batch_items(lines):
+    """读取JSONL格式的提示：每行包含 prompt 或 messages，可选 id、model、system；没有 id 时使用行号。
+    无法解析的行产出 {"id": 行号, "error": 原因}，作为失败结果写出，不影响其余的行"""
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            yield {"id": number, "error": f"invalid_json: {e}"}
+            continue
+        if isinstance(item, str):
+            item = {"prompt": item}
+        if not isinstance(item, dict):
+            yield {"id": number, "error": "invalid_item: expected an object or a string"}
+            continue
+        item.setdefault("id", number)
+        if "messages" not in item and "prompt" not in item:
+            yield {"id": item["id"], "error": "invalid_item: missing prompt or messages"}
+            continue
+        if "messages" not in item:
+            messages = [{"role": "system", "content": item["system"]}] if item.get("system") else []
+            messages.append({"role": "user", "content": item["prompt"]})
+            item["messages"] = messages
+        yield item
+
+def read_done_ids(path):
+    """读取已有结果文件中成功完成的id，用于中断后继续"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # 中断时可能留下不完整的最后一行
+            if "error" not in result:
+                done.add(json.dumps(result.get("id")))
+    return done
+
+def ends_with_newline(path):
+    """文件最后一个字节是否为换行符"""
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+class BatchRunner:
+    """命令行批处理：有限并发地发送一组提示，遵守速率限制，结果按完成顺序逐行写入JSONL"""
+    RATE_LIMIT_RETRIES = 5  # 按重试策略重试后仍是429时，再等待额度重新发送的次数
+    
+    def __init__(self, engine, output, concurrency=4, model=None, progress=None):
+        self.engine = engine
+        self.output = output  # 以追加方式打开的文件
+        self.concurrency = max(concurrency, 1)
+        self.model = model or engine.config.model
+        self.progress = progress  # progress(完成数, 失败数)
+        self.items = queue.Queue(maxsize=self.concurrency * 2)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.completed = 0
+        self.failed = 0
+        self.cached = 0
+        self.output_tokens = 0
+        
+    def run(self, items):
+        """处理所有任务并返回统计结果；Ctrl+C 时停止分发，等待进行中的请求写完结果"""
+        workers = [threading.Thread(target=self.work, daemon=True) for _ in range(self.concurrency)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        try:
+            for item in items:
+                while not self.stop.is_set():
+                    try:
+                        self.items.put(item, timeout=0.2)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stop.is_set():
+                    break
+        except KeyboardInterrupt:
+            self.stop.set()
+        finally:
+            for _ in workers:
+                self.items.put(None)
+            for worker in workers:
+                while worker.is_alive():
+                    try:
+                        worker.join(0.2)
+                    except KeyboardInterrupt:
+                        self.stop.set()
+        return self.summary(time.perf_counter() - start)
+        
+    def work(self):
+        """工作线程：取任务、等待速率限制额度、发送并写出结果"""
+        while True:
+            item = self.items.get()
+            if item is None:
+                return
+            if self.stop.is_set():
+                continue
+            result = self.process(item)
+            if result is not None:
+                self.write(result)
+                
+    def process(self, item):
+        """发送一条提示，返回要写入的结果；停止时返回None"""
+        if "error" in item:
+            return {"id": item["id"], "error": item["error"]}  # 输入文件中无法解析的行
+        model = item.get("model", self.model)
+        messages = item["messages"]
+        tokens = sum(message_tokens(m) for m in messages) + self.engine.config.max_tokens
+        cache_key, cached = self.engine.cache_lookup(messages, model)
+        start = time.perf_counter()
+        if cached is not None:
+            response = ChatResult(cached, cached=True)
+        else:
+            for _ in range(self.RATE_LIMIT_RETRIES + 1):
+                if not self.engine.acquire(model, tokens, self.stop):
+                    return None
+                response = self.engine.send(messages, model, stream=False, cache_key=cache_key, queued_at=start,
+                                            stop=self.stop)
+                if self.stop.is_set() and not response.ok:
+                    return None  # 在重试前的等待中停止，下次续跑时重新发送
+                if response.ok or response.error.kind != 'rate_limit':
+                    break
+        latency = time.perf_counter() - start
+        
+        result = {"id": item["id"], "model": model, "latency": round(latency, 3)}
+        if response.ok:
+            result["response"] = response.content
+            if response.cached:
+                result["cached"] = True
+        else:
+            error = response.error
+            result["error"] = error.kind if error.details is None else f"{error.kind}: {error.details}"
+            if error.status_code:
+                result["status"] = error.status_code
+        return result
+        
+    def write(self, result):
+        """写出一条结果并立即刷新，保证中断后已完成的结果不会丢失"""
+        with self.lock:
+            self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.output.flush()
+            if "error" in result:
+                self.failed += 1
+            else:
+                self.completed += 1
+                self.cached += bool(result.get("cached"))
+                self.latencies.append(result["latency"])
+                self.output_tokens += estimate_tokens(result["response"])
+            if self.progress:
+                self.progress(self.completed, self.failed)
+                
+    def summary(self, elapsed):
+        """吞吐量和延迟百分位数"""
+        latencies = sorted(self.latencies)
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "cached": self.cached,
+            "interrupted": self.stop.is_set(),
+            "elapsed": elapsed,
+            "requests_per_sec": self.completed / elapsed if elapsed > 0 else 0.0,
+            "tokens_per_sec": self.output_tokens / elapsed if elapsed > 0 else 0.0,
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+        }
+
+def run_batch(args):
+    """批处理模式入口：读取配置和提示文件，结果追加到输出文件，已成功的id会被跳过"""
+    config = ChatConfig.load(args.config)
+    if not config.api_key:
+        print(f"No API key configured in {args.config}", file=sys.stderr)
+        return 2
+    engine = ChatEngine(config)
+    
+    done = read_done_ids(args.output) if not args.no_resume else set()
+    source = sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')
+    items = (item for item in read_batch_items(source) if json.dumps(item["id"]) not in done)
+    if done:
+        print(f"Skipping {len(done)} completed prompts", file=sys.stderr)
+        
+    def show_progress(completed, failed):
+        print(f"\r{completed} done, {failed} failed", end="", file=sys.stderr, flush=True)
+        
+    try:
+        with open(args.output, 'a', encoding='utf-8') as output:
+            if output.tell() > 0 and not ends_with_newline(args.output):
+                output.write("\n")  # 上次中断时留下的不完整行单独成行
+            runner = BatchRunner(engine, output, concurrency=args.concurrency, model=args.model,
+                                 progress=show_progress if sys.stderr.isatty() else None)
+            stats = runner.run(items)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        engine.close()
+        
+    print(file=sys.stderr)
+    print(f"{stats['completed']} completed ({stats['cached']} cached), {stats['failed']} failed"
+          f"{' (interrupted)' if stats['interrupted'] else ''} in {stats['elapsed']:.1f}s", file=sys.stderr)
+    print(f"Throughput: {stats['requests_per_sec']:.2f} requests/s, {stats['tokens_per_sec']:.1f} tokens/s", file=sys.stderr)
+    print(f"Latency: p50 {stats['p50']:.2f}s, p90 {stats['p90']:.2f}s, p99 {stats['p99']:.2f}s, "
+          f"max {stats['max']:.2f}s", file=sys.stderr)
+    return 1 if stats['failed'] or stats['interrupted'] else 0
+
+# 各平台依次尝试的界面字体，第一个已安装的字体生效；都没有时用 Tk 的默认字体
+FONT_FALLBACKS = {
+    'win32': ('Microsoft YaHei UI', 'Microsoft YaHei', 'SimHei', 'Segoe UI'),
+    'darwin': ('PingFang SC', 'Hiragino Sans GB', 'Heiti SC', 'Helvetica Neue'),
+    'linux': ('Noto Sans CJK SC', 'Source Han Sans SC', 'WenQuanYi Micro Hei', 'Droid Sans Fallback', 'DejaVu Sans'),
+}
+
+def resolve_font_family(root, preferred=None):
+    """按平台的候选列表选出一个已安装的字体族，preferred 为配置文件中指定的字体"""
+    installed = set(tkfont.families(root))
+    platform = 'linux' if sys.platform.startswith('linux') else sys.platform
+    candidates = ((preferred,) if preferred else ()) + FONT_FALLBACKS.get(platform, FONT_FALLBACKS['linux'])
+    for family in candidates:
+        if family in installed:
+            return family
+    return tkfont.nametofont('TkDefaultFont').actual('family')
+
+class TextMeasurer:
+    """按字体度量计算文本换行后的行数和宽度，不依赖控件排版；字形宽度按字体缓存"""
+    PARAGRAPH_CACHE_SIZE = 4096
+    # Tk 8.7 起 Text 控件可以在中日韩文字之间换行，8.6 只在空白处换行（过长的词按字符断开）
+    CJK_BREAKS = getattr(tk, 'TkVersion', 8.6) >= 8.7
+    _measurers = {}  # (字体族, 字号, 粗细, 倾斜) -> TextMeasurer
+    
+    def __init__(self, font):
+        self.font = font
+        self.linespace = font.metrics('linespace')
+        self.glyphs = {}  # 字符 -> 像素宽度
+        self.paragraphs = {}  # (段落, 换行宽度) -> (行数, 宽度, 是否换行)
+        self.space_width = self.glyph_width(' ')
+        self.tokenizer = re.compile(
+            r'\s+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]|'
+            r'[^\s\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+'
+            if self.CJK_BREAKS else r'\s+|\S+')
+        
+    @classmethod
+    def for_font(cls, font):
+        """获取某个字体当前属性的测量器，同一字体共享字形宽度缓存"""
+        actual = font.actual()
+        key = (actual['family'], actual['size'], actual['weight'], actual['slant'])
+        if key not in cls._measurers:
+            # 共享字体随设置改变字号，测量用一份固定的副本，缓存的字形宽度才不会过期
+            cls._measurers[key] = cls(font.copy())
+        return cls._measurers[key]
+        
+    def glyph_width(self, ch):
+        """单个字符的像素宽度"""
+        width = self.glyphs.get(ch)
+        if width is None:
+            width = self.glyphs[ch] = self.font.measure(ch)
+        return width
+        
+    def text_width(self, text):
+        """一段不换行文本的像素宽度"""
+        if text.isspace():
+            return sum(self.space_width * 4 if ch == '\t' else self.glyph_width(ch) for ch in text)
+        return sum(self.glyph_width(ch) for ch in text)
+        
+    def layout(self, text, wrap_width):
+        """返回 (行数, 最宽一行的像素宽度, 是否发生了自动换行)"""
+        lines = 0
+        widest = 0
+        wrapped = False
+        for paragraph in text.split('\n'):
+            paragraph_lines, width, paragraph_wrapped = self.layout_paragraph(paragraph, wrap_width)
+            lines += paragraph_lines
+            widest = max(widest, width)
+            wrapped = wrapped or paragraph_wrapped
+        return lines, widest, wrapped
+        
+    def layout_paragraph(self, paragraph, wrap_width, styles=()):
+        """按词换行排版一个段落，结果缓存，流式追加时只有最后一段需要重新计算；
+        styles 为 ((起点, 终点, TextMeasurer), ...)，这些字符按其他字体（粗体、等宽）的宽度计算"""
+        key = (paragraph, wrap_width, styles)
+        result = self.paragraphs.get(key)
+        if result is not None:
+            return result
+            
+        measurers = None
+        if styles:
+            measurers = [self] * len(paragraph)
+            for start, end, measurer in styles:
+                measurers[start:end] = [measurer] * (end - start)
+        lines = 1
+        x = 0
+        widest = 0
+        for match in self.tokenizer.finditer(paragraph):
+            token = match.group()
+            if measurers is None:
+                width = self.text_width(token)
+            else:
+                width = sum(measurers[i].text_width(ch) for i, ch in enumerate(token, match.start()))
+            if token.isspace() or x + width <= wrap_width:
+                x += width  # 行尾的空白不会导致换行
+                continue
+            if x > 0:
+                widest = max(widest, x)
+                lines += 1
+                x = 0
+            if width <= wrap_width:
+                x = width
+                continue
+            # 比一行还长的词按字符断开
+            for i, ch in enumerate(token, match.start()):
+                ch_width = (self if measurers is None else measurers[i]).glyph_width(ch)
+                if x + ch_width > wrap_width and x > 0:
+                    widest = max(widest, x)
+                    lines += 1
+                    x = 0
+                x += ch_width
+        widest = min(max(widest, x), wrap_width)
+        
+        if len(self.paragraphs) >= self.PARAGRAPH_CACHE_SIZE:
+            self.paragraphs.clear()
+        result = self.paragraphs[key] = (lines, widest, lines > 1)
+        return result
+
+HIGHLIGHT_KEYWORDS = {
+    'python': keyword.kwlist + ['self', 'print', 'len', 'range', 'int', 'str', 'dict', 'list', 'set', 'tuple'],
+    'c': ['auto', 'break', 'case', 'catch', 'class', 'const', 'continue', 'default', 'delete', 'do', 'else', 'enum',
+          'export', 'extends', 'extern', 'final', 'finally', 'fn', 'for', 'func', 'function', 'go', 'if', 'impl',
+          'implements', 'import', 'in', 'interface', 'let', 'match', 'mut', 'namespace', 'new', 'package', 'private',
+          'protected', 'pub', 'public', 'return', 'static', 'struct', 'switch', 'this', 'throw', 'throws', 'trait',
+          'try', 'type', 'typeof', 'use', 'using', 'var', 'void', 'while', 'yield', 'async', 'await', 'int',
+          'char', 'bool', 'float', 'double', 'long', 'string', 'true', 'false', 'null', 'nil', 'None', 'undefined'],
+    'shell': ['if', 'then', 'else', 'elif', 'fi', 'for', 'while', 'do', 'done', 'case', 'esac', 'in', 'function',
+              'return', 'export', 'local', 'echo', 'cd', 'sudo'],
+    'ruby': ['BEGIN', 'END', 'alias', 'and', 'begin', 'break', 'case', 'class', 'def', 'defined', 'do', 'else',
+             'elsif', 'end', 'ensure', 'false', 'for', 'if', 'in', 'module', 'next', 'nil', 'not', 'or', 'redo',
+             'rescue', 'retry', 'return', 'self', 'super', 'then', 'true', 'undef', 'unless', 'until', 'when',
+             'while', 'yield', 'require', 'puts', 'attr_accessor', 'attr_reader'],
+    'lua': ['and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto', 'if', 'in', 'local',
+            'nil', 'not', 'or', 'repeat', 'return', 'then', 'true', 'until', 'while', 'require', 'self'],
+    'data': [],  # YAML、TOML、INI 等配置文件：只有注释、字符串和数字
+    'sql': ['select', 'from', 'where', 'insert', 'into', 'values', 'update', 'set', 'delete', 'create', 'table',
+            'drop', 'alter', 'index', 'join', 'left', 'right', 'inner', 'outer', 'on', 'group', 'by', 'order',
+            'having', 'limit', 'and', 'or', 'not', 'null', 'as', 'distinct', 'primary', 'key', 'union', 'case',
+            'when', 'then', 'else', 'end', 'is', 'in', 'like', 'between', 'exists', 'count', 'sum'],
+}
+HIGHLIGHT_COMMENTS = {'python': r'#[^\n]*', 'c': r'//[^\n]*|/\*[\s\S]*?(?:\*/|$)', 'shell': r'#[^\n]*',
+                      'sql': r'--[^\n]*|/\*[\s\S]*?(?:\*/|$)', 'ruby': r'#[^\n]*',
+                      'lua': r'--\[\[[\s\S]*?(?:\]\]|$)|--[^\n]*', 'data': r'#[^\n]*|(?m:^[ \t]*;[^\n]*)'}
+HIGHLIGHT_LANGUAGES = {  # 代码块标注的语言 -> 使用的高亮规则
+    'python': 'python', 'py': 'python', 'python3': 'python', 'ruby': 'ruby', 'rb': 'ruby', 'yaml': 'data',
+    'yml': 'data', 'toml': 'data', 'ini': 'data', 'bash': 'shell', 'sh': 'shell', 'shell': 'shell', 'zsh': 'shell',
+    'console': 'shell', 'powershell': 'shell', 'ps1': 'shell', 'sql': 'sql', 'mysql': 'sql', 'postgresql': 'sql',
+    'sqlite': 'sql', 'lua': 'lua',
+}
+
+@functools.lru_cache(maxsize=None)
+def highlight_pattern(rules):
+    """某种高亮规则的组合正则：注释、字符串、数字、关键字依次尝试"""
+    strings = r'"""[\s\S]*?(?:"""|$)|\'\'\'[\s\S]*?(?:\'\'\'|$)|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\''
+    if rules == 'c':
+        strings += r'|`(?:\\.|[^`\\])*`'
+    keywords = '|'.join(sorted(set(HIGHLIGHT_KEYWORDS[rules]), key=len, reverse=True))
+    flags = re.IGNORECASE if rules == 'sql' else 0
+    pattern = (rf'(?P<hl_comment>{HIGHLIGHT_COMMENTS[rules]})|(?P<hl_string>{strings})|'
+               rf'(?P<hl_number>\b(?:0[xX][0-9a-fA-F]+|\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\b)')
+    if keywords:  # 没有关键字的规则（配置文件）不加这一组，空的分组会匹配每个词边界
+        pattern += rf'|(?P<hl_keyword>\b(?:{keywords})\b)'
+    return re.compile(pattern, flags)
+
+def highlight_code(code, language):
+    """对代码做语法高亮，返回 [(起点, 终点, 标签)]；未知语言按类C语法处理"""
+    pattern = highlight_pattern(HIGHLIGHT_LANGUAGES.get(language.lower(), 'c'))
+    return [(match.start(), match.end(), match.lastgroup) for match in pattern.finditer(code)]
+
+def display_width(text):
+    """文本在等宽字体中占的列数，全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(ch) in 'WF' else 1 for ch in text)
+
+class RenderedText:
+    """Markdown 的渲染结果：text 为显示的文本，runs 为 [(起点, 终点, 标签)]，fonts 为需要按其他字体测量的区间
+    [(起点, 终点, 字体)]，code 为 [(起点, 语言, 代码, 是否已结束)]，tail 为最后一块的起点（流式追加时只有它会变化）"""
+    __slots__ = ('text', 'runs', 'fonts', 'code', 'tail')
+    
+    def __init__(self, text, runs, fonts, code, tail):
+        self.text = text
+        self.runs = runs
+        self.fonts = fonts
+        self.code = code
+        self.tail = tail
+
+class MarkdownRenderer:
+    """把 Markdown 转换为 Text 控件的文本和标签区间，不依赖Tk：按块解析，每块的结果按源文本缓存，
+    流式追加时只有最后一块需要重新解析；完整消息的结果按内容哈希缓存，滚动和缩放不会重新解析。
+    代码块的语法高亮提交到 workers（界面的常驻线程池）中计算，完成后经 post 回到界面线程并调用 on_highlight()"""
+    BLOCK_CACHE_SIZE = 2048
+    MESSAGE_CACHE_SIZE = 512
+    HIGHLIGHT_CACHE_SIZE = 512
+    STREAM_CACHE_SIZE = 8  # 同时在流式追加的消息数
+    FONT_TAGS = {'bold': 'bold', 'heading': 'bold', 'italic': 'italic', 'code': 'mono', 'code_block': 'mono',
+                 'table': 'mono'}
+    FENCE = re.compile(r'\s{0,3}(`{3,}|~{3,})\s*([\w+#.-]*)[^`\n]*$')
+    HEADING = re.compile(r'\s{0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+    QUOTE = re.compile(r'\s{0,3}>\s?(.*)$')
+    BULLET = re.compile(r'(\s*)[-*+]\s+(?:\[([ xX])\]\s+)?(.*)$')
+    ORDERED = re.compile(r'(\s*)(\d{1,9}[.)])\s+(.*)$')
+    RULE = re.compile(r'\s{0,3}([-*_])(?:\s*\1){2,}\s*$')
+    TABLE_SEPARATOR = re.compile(r'\s*\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?\s*$')
+    INLINE = re.compile(r'(?P<code>(`+)(?P<code_text>.+?)\2)|\*\*(?P<bold>.+?)\*\*|__(?P<bold2>.+?)__|'
+                        r'~~(?P<strike>.+?)~~|(?<![\w*])\*(?P<italic>[^\s*](?:.*?[^\s*])?)\*(?![\w*])|'
+                        r'(?<![\w_])_(?P<italic2>[^\s_](?:.*?[^\s_])?)_(?![\w_])|'
+                        r'\[(?P<link>[^\]]+)\]\([^)\s]+(?:\s+"[^"]*")?\)')
+    INLINE_TAGS = {'code_text': 'code', 'bold': 'bold', 'bold2': 'bold', 'strike': 'strike', 'italic': 'italic',
+                   'italic2': 'italic', 'link': 'link'}
+    
+    def __init__(self, post, workers):
+        self.post = post
+        self.workers = workers
+        self.blocks = OrderedDict()  # 块的源文本 -> (显示文本, 标签区间, 字体区间, 代码块)
+        self.messages = OrderedDict()  # 消息内容的哈希 -> RenderedText
+        self.highlights = OrderedDict()  # (语言, 代码) -> 高亮区间
+        self.pending = set()  # 正在后台高亮的代码块
+        self.streams = OrderedDict()  # 流式消息上次的源文本 -> (已结束的块在源文本中的终点, 这些块的 RenderedText)
+        self.on_highlight = None
+        
+    def render(self, text, partial=False):
+        """渲染一条消息；partial 为 True 表示流式回复还没有结束，结果不放入消息缓存，未结束的代码块暂不高亮"""
+        if partial:
+            rendered = self.render_stream(text)
+        else:
+            key = hashlib.sha1(text.encode('utf-8', 'surrogatepass')).digest()
+            rendered = self.messages.get(key)
+            if rendered is not None:
+                self.messages.move_to_end(key)
+                return rendered
+            rendered = self.render_blocks(self.split_blocks(text))
+            self.messages[key] = rendered
+            if len(self.messages) > self.MESSAGE_CACHE_SIZE:
+                self.messages.popitem(last=False)
+            self.streams.pop(text, None)  # 流式回复已经结束
+            
+        for _, language, body, closed in rendered.code:
+            if closed or not partial:
+                self.request_highlight(language, body)
+        return rendered
+        
+    def render_stream(self, text):
+        """渲染流式回复：最后一块之前的块不会再变化，记下它们在源文本中的终点和渲染结果，
+        下一次只切分和解析终点之后的文本，每次刷新的解析量只与最后一块有关，与整条消息的长度无关"""
+        previous = max((last for last in self.streams if text.startswith(last)), key=len, default=None)
+        if previous is None:
+            end, done = 0, RenderedText("", [], [], [], 0)
+        else:
+            end, done = self.streams.pop(previous)
+        blocks = self.split_blocks(text[end:])
+        if len(blocks) > 1:
+            finished = self.render_blocks(blocks[:-1], len(done.text))
+            done = RenderedText(done.text + finished.text, done.runs + finished.runs, done.fonts + finished.fonts,
+                                done.code + finished.code, finished.tail)
+            end += sum(len(source) for source in blocks[:-1])
+            blocks = blocks[-1:]
+        last = self.render_blocks(blocks, len(done.text))
+        
+        self.streams[text] = (end, done)
+        if len(self.streams) > self.STREAM_CACHE_SIZE:
+            self.streams.popitem(last=False)
+        return RenderedText(done.text + last.text, done.runs + last.runs, done.fonts + last.fonts,
+                            done.code + last.code, last.tail)
+                            
+    def render_blocks(self, blocks, offset=0):
+        """解析并拼接若干块，offset 为第一块在整条消息显示文本中的起点"""
+        parts, runs, fonts, code = [], [], [], []
+        tail = offset
+        for source in blocks:
+            display, block_runs, block_fonts, block_code = self.parse_block(source)
+            runs.extend((start + offset, end + offset, tag) for start, end, tag in block_runs)
+            fonts.extend((start + offset, end + offset, font) for start, end, font in block_fonts)
+            code.extend((start + offset, language, body, closed) for start, language, body, closed in block_code)
+            parts.append(display)
+            tail = offset
+            offset += len(display)
+        return RenderedText("".join(parts), runs, fonts, code, tail)
+        
+    def split_blocks(self, text):
+        """按空行和代码围栏把源文本分成块，每块保留自己的换行符，前面的块不会因为后续追加的文本而改变"""
+        blocks = []
+        current = []
+        fence = None
+        for line in text.splitlines(keepends=True):
+            stripped = line.strip()
+            if fence is not None:
+                current.append(line)
+                if self.closes(fence, line):
+                    blocks.append("".join(current))  # 代码块结束
+                    current = []
+                    fence = None
+                continue
+            match = self.FENCE.match(line)
+            if match:
+                if current:
+                    blocks.append("".join(current))
+                current = [line]
+                fence = match.group(1)
+                continue
+            current.append(line)
+            if not stripped:
+                blocks.append("".join(current))
+                current = []
+        if current:
+            blocks.append("".join(current))
+        return blocks
+        
+    @staticmethod
+    def closes(fence, line):
+        """这一行是否结束以 fence 开始的代码块"""
+        stripped = line.strip()
+        return stripped.startswith(fence) and stripped == fence[0] * len(stripped)
+        
+    def parse_block(self, source):
+        """解析一块源文本，返回 (显示文本, [(起点, 终点, 标签)], [(起点, 终点, 字体)], [(起点, 语言, 代码, 是否已结束)])，
+        结果缓存"""
+        result = self.blocks.get(source)
+        if result is not None:
+            self.blocks.move_to_end(source)
+            return result
+        lines = source.splitlines(keepends=True)
+        match = self.FENCE.match(lines[0])
+        if match:
+            fence = match.group(1)
+            body = lines[1:]
+            closed = bool(body) and self.closes(fence, body[-1])
+            if closed:
+                body = body[:-1]
+            code = "".join(line.expandtabs(4) for line in body)
+            result = (code, [(0, len(code), 'code_block')] if code else [], [(0, match.group(2), code, closed)])
+        elif len(lines) >= 2 and '|' in lines[0] and '|' in lines[1] and self.TABLE_SEPARATOR.match(lines[1]):
+            result = self.parse_table(lines)
+        else:
+            parts, runs = [], []
+            offset = 0
+            for line in lines:
+                display, line_runs = self.parse_line(line)
+                runs.extend((start + offset, end + offset, tag) for start, end, tag in line_runs)
+                parts.append(display)
+                offset += len(display)
+            result = ("".join(parts), runs, [])
+            
+        display, runs, code = result
+        result = (display, runs, self.font_spans(runs, len(display)), code)
+        self.blocks[source] = result
+        if len(self.blocks) > self.BLOCK_CACHE_SIZE:
+            self.blocks.popitem(last=False)
+        return result
+        
+    def parse_line(self, line):
+        """解析标题、引用、列表、分隔线或普通段落中的一行"""
+        newline = line[len(line.rstrip('\r\n')):]
+        content = line[:len(line) - len(newline)]
+        newline = '\n' if newline else ''
+        
+        match = self.HEADING.match(content)
+        if match:
+            display, runs = self.parse_inline(match.group(2))
+            return display + newline, [(0, len(display), 'heading')] + runs
+        if self.RULE.match(content):
+            return '─' * 24 + newline, [(0, 24, 'rule')]
+        match = self.QUOTE.match(content)
+        if match:
+            display, runs = self.parse_inline(match.group(1))
+            return '▎ ' + display + newline, [(0, len(display) + 2, 'quote')] + [
+                (start + 2, end + 2, tag) for start, end, tag in runs]
+        match = self.BULLET.match(content)
+        if match:
+            indent, task, text = match.groups()
+            prefix = indent + ('• ' if task is None else '☐ ' if task == ' ' else '☑ ')
+        else:
+            match = self.ORDERED.match(content)
+            if match:
+                indent, number, text = match.groups()
+                prefix = f"{indent}{number} "
+            else:
+                prefix, text = '', content
+        display, runs = self.parse_inline(text)
+        shift = len(prefix)
+        return prefix + display + newline, [(start + shift, end + shift, tag) for start, end, tag in runs]
+        
+    def parse_inline(self, text):
+        """解析行内的代码、粗体、斜体、删除线和链接，去掉标记符号，返回 (显示文本, 标签区间)"""
+        parts, runs = [], []
+        position = offset = 0
+        for match in self.INLINE.finditer(text):
+            parts.append(text[position:match.start()])
+            offset += match.start() - position
+            group = next(name for name in self.INLINE_TAGS if match.group(name) is not None)
+            inner = match.group(group)
+            if group == 'code_text':
+                inner = inner.strip(' ') or inner
+            parts.append(inner)
+            runs.append((offset, offset + len(inner), self.INLINE_TAGS[group]))
+            offset += len(inner)
+            position = match.end()
+        parts.append(text[position:])
+        return "".join(parts), runs
+        
+    def parse_table(self, lines):
+        """把表格排成等宽字体下对齐的文本"""
+        rows, trailing = [], []
+        newline = "\n"
+        for index, line in enumerate(lines):
+            if index == 1:
+                continue
+            if '|' not in line:
+                trailing = lines[index:]
+                break
+            newline = "\n" if line.endswith("\n") else ""  # 流式回复中最后一行可能还没有结束
+            cells = line.strip().strip('|').split('|')
+            rows.append([self.parse_inline(cell.strip())[0] for cell in cells])
+        columns = max(len(row) for row in rows)
+        widths = [max((display_width(row[column]) for row in rows if column < len(row)), default=0)
+                  for column in range(columns)]
+        
+        def format_row(row):
+            cells = [row[column] if column < len(row) else '' for column in range(columns)]
+            return " │ ".join(cell + ' ' * (width - display_width(cell)) for cell, width in zip(cells, widths)).rstrip()
+            
+        table = [format_row(rows[0]), "─┼─".join('─' * width for width in widths)]
+        table.extend(format_row(row) for row in rows[1:])
+        text = "\n".join(table) + newline
+        parts, runs = [text], [(0, len(text.rstrip("\n")), 'table')]
+        offset = len(text)
+        for line in trailing:
+            display, line_runs = self.parse_line(line)
+            runs.extend((start + offset, end + offset, tag) for start, end, tag in line_runs)
+            parts.append(display)
+            offset += len(display)
+        return "".join(parts), runs, []
+        
+    def font_spans(self, runs, length):
+        """从一块的标签区间中取出改变字体的部分，重叠时后面的（内层的）优先，返回按起点排序、互不重叠的区间"""
+        font_runs = [(start, end, self.FONT_TAGS[tag]) for start, end, tag in runs if tag in self.FONT_TAGS and end > start]
+        if not font_runs:
+            return []
+        fonts = [None] * length
+        for start, end, font in font_runs:
+            fonts[start:end] = [font] * (end - start)
+        spans = []
+        for font, group in itertools.groupby(enumerate(fonts), key=lambda item: item[1]):
+            group = list(group)
+            if font is not None:
+                spans.append((group[0][0], group[-1][0] + 1, font))
+        return spans
+        
+    def cached_highlight(self, language, code):
+        """已计算好的高亮区间，还没有时返回None"""
+        return self.highlights.get((language, code))
+        
+    def request_highlight(self, language, code):
+        """在后台线程中为代码块计算高亮"""
+        key = (language, code)
+        if key in self.highlights or key in self.pending or not code.strip():
+            return
+        self.pending.add(key)
+        self.workers.submit(self.highlight, key)
+        
+    def highlight(self, key):
+        # 工作线程：只做计算，结果交给界面线程
+        runs = highlight_code(key[1], key[0])
+        self.post(self.highlight_done, key, runs)
+        
+    def highlight_done(self, key, runs):
+        """界面线程：保存高亮结果并通知视图"""
+        self.pending.discard(key)
+        self.highlights[key] = runs
+        if len(self.highlights) > self.HIGHLIGHT_CACHE_SIZE:
+            self.highlights.popitem(last=False)
+        if self.on_highlight is not None:
+            self.on_highlight()
+
+class MessageRow:
+    """聊天视图中一条消息的轻量模型，不持有任何控件"""
+    __slots__ = ('sender', 'text', 'rendered', 'time', 'show_time', 'height', 'text_height', 'width', 'wrapped',
+                 'status', 'highlight')
+    
+    def __init__(self, sender, text, time, show_time, rendered=None):
+        self.sender = sender
+        self.text = text  # 消息的原文
+        self.rendered = rendered  # Markdown 渲染结果（RenderedText），纯文本显示时为None
+        self.time = time
+        self.show_time = show_time  # 是否在消息上方显示时间戳
+        self.height = 0  # 整行占用的像素高度
+        self.text_height = 0  # 换行后文本的像素高度
+        self.width = 0  # 文本最宽一行的像素宽度
+        self.wrapped = False  # 是否因宽度不够自动换行，未换行的消息在画布变宽时不需要重新测量
+        self.status = None  # 显示在气泡旁的状态文字，如"排队中"
+        self.highlight = False  # 搜索跳转时高亮显示
+        
+class BubbleSlot:
+    """可复用的消息气泡控件，滚动时在不同消息之间回收使用"""
+    def __init__(self, canvas, font, time_font, tags=()):
+        self.frame = tk.Frame(canvas, relief="flat", borderwidth=ChatView.BUBBLE_BORDER)
+        self.frame.pack_propagate(False)  # 气泡大小由测量结果决定，不让Text控件自行排版
+        self.text = tk.Text(
+            self.frame,
+            wrap=tk.WORD,
+            font=font,
+            relief="flat",
+            borderwidth=0,
+            highlightthickness=0,
+            height=1,
+            width=1,
+            padx=ChatView.TEXT_PADX,
+            pady=ChatView.TEXT_PADY,
+            state='disabled'  # 设置为只读
+        )
+        self.text.pack(expand=True, fill=tk.BOTH)
+        for tag, options in tags:
+            self.text.tag_configure(tag, **options)  # 后配置的标签优先级更高
+        self.window_id = canvas.create_window(0, 0, window=self.frame, anchor="nw", state='hidden')
+        self.time_id = canvas.create_text(0, 0, text="", font=time_font,
+                                          fill='#999999', anchor="n", state='hidden')
+        self.status_id = canvas.create_text(0, 0, text="", font=time_font,
+                                            fill='#999999', anchor="se", state='hidden')
+        self.index = None  # 当前绑定的消息序号
+        self.content = None  # 当前显示的文本
+        self.rendered = None  # 当前显示的 Markdown 渲染结果
+        self.highlighted = set()  # 已应用语法高亮的代码块序号
+        
+class ChatView:
+    """虚拟化的聊天消息列表：只为可视区域附近的消息创建控件"""
+    OVERSCAN = 400  # 可视区域上下额外渲染的像素
+    ROW_GAP = 10  # 消息之间的间距
+    TEXT_PADX = 10
+    TEXT_PADY = 5
+    BUBBLE_BORDER = 1
+    SIDE_MARGIN = 10  # 气泡与画布左右边缘的距离
+    MAX_BUBBLE_RATIO = 0.7  # 气泡最大宽度占画布宽度的比例
+    MAX_BUBBLE_WIDTH = 640
+    MIN_WRAP_WIDTH = 80
+    TIME_PAD = 5  # 时间戳与气泡之间的间距
+    TIME_GROUP_SECONDS = 300  # 超过该间隔的消息显示新的时间戳
+    # Markdown 标签的样式，font 为派生字体的名字；语法高亮只改变颜色，不影响测量
+    TAG_STYLES = (
+        ('heading', {'font': 'bold', 'foreground': '#1f2d3d'}),
+        ('bold', {'font': 'bold'}),
+        ('italic', {'font': 'italic'}),
+        ('strike', {'overstrike': True}),
+        ('link', {'foreground': '#0969da', 'underline': True}),
+        ('quote', {'foreground': '#6a737d'}),
+        ('rule', {'foreground': '#c0c4c8'}),
+        ('code', {'font': 'mono', 'background': '#eef0f2'}),
+        ('code_block', {'font': 'mono', 'background': '#f3f4f6'}),
+        ('table', {'font': 'mono'}),
+        ('hl_comment', {'foreground': '#6e7781'}),
+        ('hl_string', {'foreground': '#0a3069'}),
+        ('hl_number', {'foreground': '#0550ae'}),
+        ('hl_keyword', {'foreground': '#cf222e'}),
+    )
+    
+    def __init__(self, parent, font, time_font, renderer=None):
+        self.canvas = tk.Canvas(
+            parent,
+            bg='#f0f0f0',
+            highlightthickness=0,
+            relief='flat',
+            yscrollincrement=20
+        )
+        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.yview)
+        self.canvas.configure(yscrollcommand=self.on_scroll_change)
+        
+        self.rows = []  # 所有消息的模型
+        self.base = 0  # rows[0] 对应的消息序号，向前加载更早的消息时会变为负数
+        self.offsets = []  # 每条消息顶部的y坐标
+        self.total_height = 0
+        self.slots = {}  # 消息序号 -> 正在显示它的气泡控件
+        self.free_slots = []  # 空闲的气泡控件
+        self.width = 1
+        self.wrap_width = self.MIN_WRAP_WIDTH  # 文本换行宽度，随画布宽度变化
+        self.resize_pending = False
+        self.last_time_shown = None
+        self.refresh_pending = False
+        self.on_reach_top = None  # 滚动到顶部时的回调，用于加载更早的消息
+        
+        self.font = font  # 共享的命名字体，所有气泡引用同一个对象
+        self.time_font = time_font
+        self.time_linespace = time_font.metrics('linespace')
+        self.renderer = renderer  # 助手消息的 Markdown 渲染器，为None时按纯文本显示
+        if renderer is not None:
+            renderer.on_highlight = self.on_highlight
+            
+        # Markdown 用的派生字体，字号随消息字体变化
+        self.style_fonts = {'bold': font.copy(), 'italic': font.copy(), 'mono': font.copy()}
+        self.style_fonts['mono'].configure(family=tkfont.nametofont('TkFixedFont').actual('family'))
+        self.tags = [(tag, {key: self.style_fonts[value] if key == 'font' else value for key, value in options.items()})
+                     for tag, options in self.TAG_STYLES]
+        self.font_changed()
+        
+        # 绑定事件
+        self.canvas.bind('<Configure>', self.on_canvas_configure)
+        self.bind_wheel(self.canvas)
+        
+    def bind_wheel(self, widget):
+        """滚轮在画布或气泡上时滚动消息列表；只绑定这些控件，输入框等其他控件的滚轮不受影响"""
+        widget.bind("<MouseWheel>", self.on_mousewheel)
+        widget.bind("<Button-4>", lambda e: self.on_wheel_units(-1))
+        widget.bind("<Button-5>", lambda e: self.on_wheel_units(1))
+        
+    def new_slot(self):
+        """新建一个气泡控件，滚轮在气泡上时同样滚动消息列表"""
+        slot = BubbleSlot(self.canvas, self.font, self.time_font, self.tags)
+        self.bind_wheel(slot.frame)
+        self.bind_wheel(slot.text)
+        return slot
+        
+    def font_changed(self):
+        """共享字体的属性改变后重新测量并排版（控件的字体由 Tk 自动更新）"""
+        size = self.font.cget('size')
+        self.style_fonts['bold'].configure(family=self.font.cget('family'), size=size, weight='bold')
+        self.style_fonts['italic'].configure(family=self.font.cget('family'), size=size, slant='italic')
+        self.style_fonts['mono'].configure(size=size)
+        self.style_measurers = {name: TextMeasurer.for_font(style_font) for name, style_font in self.style_fonts.items()}
+        self.measurer = TextMeasurer.for_font(self.font)
+        self.linespace = self.measurer.linespace
+        self.time_linespace = self.time_font.metrics('linespace')
+        self.relayout()
+        
+    def compute_wrap_width(self):
+        """根据画布宽度计算文本换行宽度"""
+        bubble_width = min(int(self.width * self.MAX_BUBBLE_RATIO), self.MAX_BUBBLE_WIDTH)
+        return max(bubble_width - 2 * self.TEXT_PADX - 2 * self.BUBBLE_BORDER, self.MIN_WRAP_WIDTH)
+        
+    def bubble_size(self, row):
+        """气泡的像素宽高（含内边距和边框）"""
+        # 多留2像素，避免Text控件因取整把最后一个字挤到下一行
+        width = row.width + 2 * self.TEXT_PADX + 2 * self.BUBBLE_BORDER + 2
+        height = row.text_height + 2 * self.TEXT_PADY + 2 * self.BUBBLE_BORDER
+        return width, height
+        
+    def measure(self, row):
+        """按字体度量计算消息换行后的尺寸，返回整行占用的高度"""
+        row.text_height, row.width, row.wrapped = self.layout(row)
+        height = self.bubble_size(row)[1] + self.ROW_GAP
+        if row.show_time:
+            height += self.time_linespace + self.TIME_PAD
+        return height
+        
+    def layout(self, row):
+        """返回 (文本的像素高度, 最宽一行的像素宽度, 是否发生了自动换行)；
+        Markdown 中粗体、代码等字符按各自的字体测量，每段的行高取段内所用字体中最大的"""
+        rendered = row.rendered
+        if rendered is None or not rendered.fonts:
+            lines, width, wrapped = self.measurer.layout(self.display_text(row), self.wrap_width)
+            return lines * self.linespace, width, wrapped
+            
+        spans = rendered.fonts
+        height = widest = 0
+        wrapped = False
+        first = 0  # 第一个还没有结束的字体区间
+        start = 0
+        for paragraph in rendered.text.split('\n'):
+            end = start + len(paragraph)
+            while first < len(spans) and spans[first][1] <= start:
+                first += 1
+            styles = []
+            for span_start, span_end, font in itertools.takewhile(lambda span: span[0] < end or span[0] == start,
+                                                                  itertools.islice(spans, first, None)):
+                styles.append((max(span_start, start) - start, min(span_end, end) - start, self.style_measurers[font]))
+            measurer = self.measurer
+            if len(styles) == 1 and styles[0][:2] == (0, len(paragraph)):
+                measurer, styles = styles[0][2], []  # 整段同一种字体，如代码块中的一行
+            lines, width, paragraph_wrapped = measurer.layout_paragraph(paragraph, self.wrap_width, tuple(styles))
+            linespace = max([measurer.linespace] + [style[2].linespace for style in styles])
+            height += lines * linespace
+            widest = max(widest, width)
+            wrapped = wrapped or paragraph_wrapped
+            start = end + 1
+        return height, widest, wrapped
+        
+    def display_text(self, row):
+        """消息在气泡中显示的文本"""
+        return row.text if row.rendered is None else row.rendered.text
+        
+    def render(self, sender, text, partial=False):
+        """渲染助手消息的 Markdown，没有需要显示的格式时返回None（按纯文本显示）"""
+        if self.renderer is None or sender.lower() != "assistant":
+            return None
+        rendered = self.renderer.render(text, partial)
+        if not rendered.runs and rendered.text == text:
+            return None
+        return rendered
+        
+    def relayout(self, changed=None):
+        """重新计算消息的位置；changed(row)用于只重新测量受影响的消息"""
+        self.offsets = []
+        y = 0
+        for row in self.rows:
+            if changed is None or changed(row):
+                row.height = self.measure(row)
+            self.offsets.append(y)
+            y += row.height
+        self.total_height = y
+        self.update_scrollregion()
+        for index, slot in self.slots.items():
+            self.place(slot, index)
+        self.schedule_refresh()
+        
+    def append(self, sender, text, timestamp=None):
+        """追加一条消息，返回其序号"""
+        timestamp = timestamp or datetime.now()
+        show_time = (self.last_time_shown is None or
+                     (timestamp - self.last_time_shown).total_seconds() > self.TIME_GROUP_SECONDS)
+        if show_time:
+            self.last_time_shown = timestamp
+            
+        row = MessageRow(sender, text, timestamp, show_time, self.render(sender, text))
+        row.height = self.measure(row)
+        self.rows.append(row)
+        self.offsets.append(self.total_height)
+        self.total_height += row.height
+        self.update_scrollregion()
+        self.schedule_refresh()
+        return self.base + len(self.rows) - 1
+        
+    def prepend(self, messages):
+        """在最前面插入更早的消息 [(sender, text, timestamp), ...]，保持当前可视内容不动，返回第一条的序号"""
+        if not messages:
+            return self.base
+        rows = []
+        last_time_shown = None
+        for sender, text, timestamp in messages:
+            show_time = (last_time_shown is None or
+                         (timestamp - last_time_shown).total_seconds() > self.TIME_GROUP_SECONDS)
+            if show_time:
+                last_time_shown = timestamp
+            rows.append(MessageRow(sender, text, timestamp, show_time, self.render(sender, text)))
+            
+        old_top = self.canvas.canvasy(0)
+        old_height = self.total_height
+        self.rows[:0] = rows
+        self.base -= len(rows)
+        self.relayout()
+        
+        # 保持原来可视区域内的消息位置不变
+        if self.total_height > 0:
+            self.canvas.yview_moveto((old_top + self.total_height - old_height) / self.total_height)
+        return self.base
+        
+    def row(self, index):
+        """按序号获取消息模型"""
+        return self.rows[index - self.base]
+        
+    def append_text(self, index, delta):
+        """向已有消息末尾追加文本（用于流式回复）：Markdown 按块缓存，只有最后一块需要重新解析和写入控件"""
+        row = self.row(index)
+        row.text += delta
+        row.rendered = self.render(row.sender, row.text, partial=True)
+        slot = self.slots.get(index)
+        if slot is not None:
+            old, new = slot.rendered, row.rendered
+            text = self.display_text(row)
+            if old is not None and new is not None:
+                keep = min(old.tail, new.tail)  # 最后一块之前的内容不会再变化
+            elif old is None and new is None:
+                keep = len(slot.content)  # 纯文本只在末尾追加
+            else:
+                keep = 0
+            slot.text.configure(state='normal')
+            slot.text.delete(self.text_index(text, keep), tk.END)
+            slot.text.insert(tk.END, text[keep:])
+            if new is not None:
+                self.apply_runs(slot.text, text, [run for run in new.runs if run[0] >= keep])
+            slot.text.configure(state='disabled')
+            slot.content, slot.rendered = text, new
+            slot.highlighted = {number for number in slot.highlighted if new is not None and new.code[number][0] < keep}
+            self.apply_highlights(slot, row)
+        self.update_height(index)
+        
+    def set_text(self, index, text):
+        """替换一条消息的文本"""
+        row = self.row(index)
+        row.text = text
+        row.rendered = self.render(row.sender, text)
+        self.update_height(index)
+        
+    @staticmethod
+    def text_index(text, offset):
+        """文本中第 offset 个字符对应的 Text 控件索引（行.列）"""
+        line = text.count('\n', 0, offset)
+        column = offset - (text.rfind('\n', 0, offset) + 1)
+        return f"{line + 1}.{column}"
+        
+    @staticmethod
+    def apply_runs(widget, text, runs):
+        """给 Text 控件中的文本加上标签，同一标签的所有区间一次加上"""
+        if not runs:
+            return
+        line_starts = [0] + [match.end() for match in re.finditer('\n', text)]
+        
+        def index(offset):
+            line = bisect.bisect_right(line_starts, offset) - 1
+            return f"{line + 1}.{offset - line_starts[line]}"
+            
+        ranges = {}
+        for start, end, tag in runs:
+            if end > start:
+                ranges.setdefault(tag, []).extend((index(start), index(end)))
+        for tag, indices in ranges.items():
+            widget.tag_add(tag, *indices)
+            
+    def apply_highlights(self, slot, row):
+        """把后台计算好的代码高亮加到气泡中（只改颜色，不需要重新测量）"""
+        rendered = row.rendered
+        if rendered is None or not rendered.code or self.renderer is None:
+            return
+        for number, (offset, language, code, _) in enumerate(rendered.code):
+            if number in slot.highlighted:
+                continue
+            runs = self.renderer.cached_highlight(language, code)
+            if runs is None:
+                continue
+            self.apply_runs(slot.text, rendered.text, [(start + offset, end + offset, tag) for start, end, tag in runs])
+            slot.highlighted.add(number)
+            
+    def on_highlight(self):
+        """有代码块的高亮计算完成，更新正在显示的气泡"""
+        for index, slot in self.slots.items():
+            self.apply_highlights(slot, self.row(index))
+        
+    def set_status(self, index, status):
+        """设置消息气泡旁的状态文字，None表示不显示"""
+        self.row(index).status = status
+        slot = self.slots.get(index)
+        if slot is not None:
+            self.place(slot, index)
+            
+    def flash(self, index, duration=2000):
+        """短暂高亮一条消息"""
+        self.row(index).highlight = True
+        if index in self.slots:
+            self.place(self.slots[index], index)
+            
+        def unflash():
+            if 0 <= index - self.base < len(self.rows):
+                self.row(index).highlight = False
+                if index in self.slots:
+                    self.place(self.slots[index], index)
+                    
+        self.canvas.after(duration, unflash)
+        
+    def update_height(self, index):
+        """消息内容变化后更新其高度和之后所有消息的位置"""
+        row = self.row(index)
+        new_height = self.measure(row)
+        delta = new_height - row.height
+        if delta:
+            row.height = new_height
+            for i in range(index - self.base + 1, len(self.offsets)):
+                self.offsets[i] += delta
+            self.total_height += delta
+            self.update_scrollregion()
+            for i, slot in self.slots.items():
+                if i > index:
+                    self.place(slot, i)
+        slot = self.slots.get(index)
+        if slot is not None:
+            self.place(slot, index)
+        self.schedule_refresh()
+        
+    def clear(self):
+        """清空所有消息"""
+        for index in list(self.slots):
+            self.release(index)
+        self.rows = []
+        self.base = 0
+        self.offsets = []
+        self.total_height = 0
+        self.last_time_shown = None
+        self.update_scrollregion()
+        self.canvas.yview_moveto(0.0)
+        
+    def update_scrollregion(self):
+        """根据总高度更新画布的滚动区域"""
+        self.canvas.configure(scrollregion=(0, 0, self.width, max(self.total_height, 1)))
+        
+    def is_at_bottom(self):
+        """视图是否停留在底部"""
+        return self.canvas.yview()[1] >= 0.999
+        
+    def scroll_to_bottom(self):
+        """滚动到底部"""
+        self.canvas.yview_moveto(1.0)
+        self.schedule_refresh()
+        
+    def scroll_to(self, index):
+        """滚动使指定消息位于视图顶部"""
+        if self.total_height > 0 and 0 <= index - self.base < len(self.rows):
+            self.canvas.yview_moveto(self.offsets[index - self.base] / self.total_height)
+            self.schedule_refresh()
+            
+    def yview(self, *args):
+        """滚动条拖动"""
+        self.canvas.yview(*args)
+        self.schedule_refresh()
+        
+    def scroll_units(self, units):
+        """按单位滚动"""
+        if self.rows:
+            self.canvas.yview_scroll(units, "units")
+            self.schedule_refresh()
+            
+    def on_mousewheel(self, event):
+        """鼠标滚轮事件"""
+        return self.on_wheel_units(int(-1 * (event.delta / 120)))
+        
+    def on_wheel_units(self, units):
+        """滚轮滚动消息列表，并阻止气泡内的 Text 控件自己滚动"""
+        self.scroll_units(units)
+        return "break"
+        
+    def on_scroll_change(self, *args):
+        """处理滚动条位置变化"""
+        self.scrollbar.set(*args)
+        self.schedule_refresh()
+        
+    def on_canvas_configure(self, event):
+        """当画布大小改变时，在空闲时重新排版（连续拖动窗口只排版一次）"""
+        if event.width != self.width:
+            self.width = event.width
+            if not self.resize_pending:
+                self.resize_pending = True
+                self.canvas.after_idle(self.apply_resize)
+        self.schedule_refresh()
+        
+    def apply_resize(self):
+        """换行宽度变化后只重新测量发生过换行、或宽度超过新换行宽度的消息"""
+        self.resize_pending = False
+        wrap_width = self.compute_wrap_width()
+        if wrap_width == self.wrap_width:
+            self.update_scrollregion()
+            for index, slot in self.slots.items():
+                self.place(slot, index)
+            return
+        self.wrap_width = wrap_width
+        
+        # 停留在底部时继续停在底部，否则保持视图顶部的消息不动
+        at_bottom = self.is_at_bottom()
+        top = self.canvas.canvasy(0)
+        anchor = max(bisect.bisect_right(self.offsets, top) - 1, 0)
+        self.relayout(changed=lambda row: row.wrapped or row.width > wrap_width)
+        if at_bottom:
+            self.scroll_to_bottom()
+        elif self.total_height > 0 and anchor < len(self.offsets):
+            self.canvas.yview_moveto(self.offsets[anchor] / self.total_height)
+        
+    def schedule_refresh(self):
+        """合并多次刷新请求，在空闲时统一处理"""
+        if not self.refresh_pending:
+            self.refresh_pending = True
+            self.canvas.after_idle(self.refresh)
+            
+    def refresh(self):
+        """只为可视区域附近的消息绑定控件，其余控件回收"""
+        self.refresh_pending = False
+        if not self.rows:
+            return
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(bisect.bisect_right(self.offsets, top - self.OVERSCAN) - 1, 0) + self.base
+        last = bisect.bisect_right(self.offsets, bottom + self.OVERSCAN) + self.base
+        
+        for index in list(self.slots):
+            if index < first or index >= last:
+                self.release(index)
+        for index in range(first, last):
+            if index not in self.slots:
+                slot = self.free_slots.pop() if self.free_slots else self.new_slot()
+                slot.index = index
+                self.slots[index] = slot
+                self.place(slot, index)
+                
+        # 接近顶部时加载更早的消息
+        if top < self.OVERSCAN and self.on_reach_top is not None:
+            self.on_reach_top()
+                
+    def release(self, index):
+        """回收一个气泡控件"""
+        slot = self.slots.pop(index)
+        slot.index = None
+        self.canvas.itemconfigure(slot.window_id, state='hidden')
+        self.canvas.itemconfigure(slot.time_id, state='hidden')
+        self.canvas.itemconfigure(slot.status_id, state='hidden')
+        self.free_slots.append(slot)
+        
+    def place(self, slot, index):
+        """把消息内容写入气泡控件并放到对应位置"""
+        row = self.row(index)
+        top = self.offsets[index - self.base] + self.ROW_GAP // 2
+        
+        # 时间戳
+        if row.show_time:
+            self.canvas.coords(slot.time_id, self.width // 2, top)
+            self.canvas.itemconfigure(slot.time_id, text=row.time.strftime("%H:%M:%S"), state='normal')
+            top += self.time_linespace + self.TIME_PAD
+        else:
+            self.canvas.itemconfigure(slot.time_id, state='hidden')
+            
+        # 根据发送者决定消息框的样式和位置
+        is_user = row.sender.lower() == "user"
+        bubble_color = "#95ec69" if is_user else "#ffffff"  # 微信绿色 / 白色
+        if row.highlight:
+            bubble_color = "#fff3b0"
+        slot.frame.configure(bg=bubble_color)
+        
+        bubble_width, bubble_height = self.bubble_size(row)
+        slot.frame.configure(width=bubble_width, height=bubble_height)
+        slot.text.configure(bg=bubble_color)
+        text = self.display_text(row)
+        if slot.content != text or slot.rendered is not row.rendered:
+            slot.text.configure(state='normal')
+            slot.text.delete("1.0", tk.END)
+            slot.text.insert("1.0", text)
+            if row.rendered is not None:
+                self.apply_runs(slot.text, text, row.rendered.runs)
+            slot.text.configure(state='disabled')
+            slot.content, slot.rendered = text, row.rendered
+            slot.highlighted = set()
+            self.apply_highlights(slot, row)
+            
+        if is_user:
+            self.canvas.coords(slot.window_id, self.width - self.SIDE_MARGIN, top)  # 靠右对齐
+            self.canvas.itemconfigure(slot.window_id, anchor="ne", state='normal')
+        else:
+            self.canvas.coords(slot.window_id, self.SIDE_MARGIN, top)  # 靠左对齐
+            self.canvas.itemconfigure(slot.window_id, anchor="nw", state='normal')
+            
+        # 状态文字放在气泡底部的外侧
+        if row.status:
+            bubble_bottom = top + bubble_height
+            if is_user:
+                self.canvas.coords(slot.status_id, self.width - self.SIDE_MARGIN - bubble_width - 6, bubble_bottom)
+                self.canvas.itemconfigure(slot.status_id, text=row.status, anchor="se", state='normal')
+            else:
+                self.canvas.coords(slot.status_id, self.SIDE_MARGIN + bubble_width + 6, bubble_bottom)
+                self.canvas.itemconfigure(slot.status_id, text=row.status, anchor="sw", state='normal')
+        else:
+            self.canvas.itemconfigure(slot.status_id, state='hidden')
+
+class StartupTimeline:
+    """启动时间线：记录各阶段完成的时刻，report() 列出每个阶段的耗时和从起点开始的累计耗时"""
+    TARGET = 0.150  # 从起点到窗口首次绘制的目标时间（秒）
+    
+    def __init__(self, start=None, output=None):
+        self.start = time.perf_counter() if start is None else start
+        self.output = output  # 启动完成时写入时间线的流，None 时不输出
+        self.marks = []  # [(阶段, 完成时刻)]
+        
+    def mark(self, phase, at=None):
+        """记录阶段完成，at 默认为现在"""
+        self.marks.append((phase, time.perf_counter() if at is None else at))
+        
+    def elapsed(self, phase):
+        """从起点到该阶段完成的秒数，没有记录时返回None"""
+        for name, at in self.marks:
+            if name == phase:
+                return at - self.start
+        return None
+        
+    def report(self):
+        """每个阶段一行：阶段、本阶段耗时、累计耗时（毫秒）"""
+        lines = []
+        previous = self.start
+        for phase, at in self.marks:
+            lines.append(f"{phase:<12}{(at - previous) * 1000:9.1f} ms{(at - self.start) * 1000:9.1f} ms")
+            previous = at
+        shown = self.elapsed('first paint')
+        if shown is not None:
+            verdict = "ok" if shown <= self.TARGET else "over"
+            lines.append(f"window shown after {shown * 1000:.1f} ms (target {self.TARGET * 1000:.0f} ms: {verdict})")
+        return "\n".join(lines)
+        
+    def finish(self):
+        """启动完成：设置了 output 时写出时间线"""
+        if self.output is not None:
+            print(self.report(), file=self.output, flush=True)
 
 class EasyChat:
-    def __init__(self, root):
+    def __init__(self, root, timeline=None):
         self.root = root
+        # 窗口先显示出来，读取对话历史等较慢的初始化在首次绘制之后进行（finish_startup）
+        self.timeline = timeline or StartupTimeline()
+        self.ui = UiDispatcher(root)  # 工作线程的结果都经由这个队列回到界面线程
         self.setup_variables()
         self.setup_language_texts()
         self.load_config()
+        self.timeline.mark('config')
+        self.setup_fonts()
+        self.timeline.mark('fonts')
         self.setup_window()
         self.create_widgets()
+        # 文本追加、状态栏和滚动按帧率上限合并刷新
+        self.render = RenderScheduler(self.root, self.chat_view, max_fps=self.max_fps)
         self.setup_layout()
         self.setup_bindings()
-        self.request_timestamps = deque(maxlen=10)
+        self.send_scheduler = SendScheduler(
+            self.root,
+            self.engine.router,
+            self.dispatch_job,
+            on_wait=self.on_rate_wait,
+            prepare=self.prepare_job,
+            max_in_flight=self.parallel_requests.get()
+        )
         
         # 添加语言变化监听
         self.language.trace_add("write", self.on_language_change)
+        # 工具栏切换模型后，摘要等后台请求也使用新模型
+        self.model_name.trace_add("write", self.on_model_change)
+        self.timeline.mark('widgets')
+        self.started = False
+        self.paint_binding = self.root.bind('<Expose>', self.on_first_paint, '+')
+        self.root.after(1000, self.finish_startup)  # 窗口一直没有显示（如启动时最小化）也要完成初始化
+        
+    def on_first_paint(self, event=None):
+        """窗口第一次显示：等这一轮绘制完成后再做其余的初始化"""
+        self.root.unbind('<Expose>', self.paint_binding)
+        self.root.after_idle(self.finish_startup)
+        
+    def finish_startup(self):
+        """首次绘制之后的初始化：打开对话存储、加载最近的对话，并在后台预先导入 requests"""
+        if self.started:
+            return
+        self.started = True
+        self.root.update_idletasks()  # 完成已排队的绘制
+        self.timeline.mark('first paint')
+        self.open_store()
+        self.timeline.mark('history')
+        self.workers.submit(requests.load)  # 第一次发送时不必再等待导入
+        if self.engine.config.cache_enabled:
+            self.workers.submit(self.open_response_cache)
+        self.timeline.finish()
 
     def setup_variables(self):
         """初始化变量"""
@@ -35,9 +3856,32 @@ class EasyChat:
         self.language = tk.StringVar(value="中文")
         self.chat_font_size = tk.IntVar(value=11)  # 对话框字体大小
         self.input_font_size = tk.IntVar(value=11)  # 输入框字体大小
-        self.conversation_history = []
-        self.is_sending = False
+        self.stream_responses = tk.BooleanVar(value=True)  # 是否流式输出回复
+        self.parallel_requests = tk.IntVar(value=1)  # 同时发送的最大请求数
+        self.use_cache = tk.BooleanVar(value=False)  # 是否缓存相同请求的回复
+        self.bypass_cache = tk.BooleanVar(value=False)  # 当前对话是否跳过缓存
+        self.pending_turns = OrderedDict()  # 发送序号 -> 等待回复的消息，按发送顺序排列
+        self.next_seq = 0
         self.last_request_time = 0
+        self.streaming_rows = {}  # 发送序号 -> 正在流式写入的助手消息序号
+        self.active_requests = {}  # 发送序号 -> 已发出的请求的取消令牌，停止后的结果不再使用
+        self.last_timing = None  # 最近一次请求的耗时分解
+        self.store = None  # 对话存储，窗口首次绘制后打开
+        self.conversation_id = None  # 当前对话在存储中的id，发送第一条消息时创建
+        self.conversation_ids = []  # 对话下拉框中各项对应的id
+        self.oldest_loaded_id = None  # 已加载的最早一条消息的id
+        self.has_more_history = False  # 存储中是否还有更早的消息
+        self.message_rows = {}  # 存储中的消息id -> 消息在视图中的序号
+        self.history_generation = 0  # 每次切换或清空对话加一，用于丢弃过时的读取结果
+        self.loading_history = False  # 是否正在工作线程中读取消息
+        self.list_seq = 0  # 对话列表的读取序号
+        self.unsaved_turns = []  # 当前对话中已完成、还没有写入存储的轮次（存储未打开或对话正在新建）
+        self.creating_conversation = False  # 当前对话是否正在工作线程中新建
+        self.detached_turns = []  # 存储打开之前被清空的对话的轮次，存储打开后各自新建对话保存
+        self.closing = False
+        self.cache_bypass_ids = set()  # 跳过缓存的对话id
+        self.export_stop = None  # 正在进行的导出的取消标志
+        self.import_stop = None  # 正在进行的导入的取消标志
         
     def setup_language_texts(self):
         """设置语言文本映射"""
@@ -68,9 +3912,16 @@ class EasyChat:
                 "sending": "正在发送消息...",
                 "send_success": "消息发送成功",
                 "send_fail": "发送失败",
+                "input_restored": "发送失败，消息已放回输入框",
+                "endpoint_ok": "{name}：正常",
+                "endpoint_down": "{name}：不可用（{status}）",
+                "retrying": "请求失败（{reason}），{seconds:.1f} 秒后重试（已请求 {attempt} 次）",
+                "reason_timeout": "超时",
+                "reason_connection": "连接失败",
+                "retrying_short": "第 {attempt} 次尝试",
                 "copied": "消息已复制到剪贴板",
                 "no_api_key": "请先在设置中配置API密钥",
-                "confirm_clear": "确定要清空所有对话记录吗？",
+                "confirm_clear": "确定要清空当前对话吗？（对话记录仍保存在历史对话列表中）",
                 "cleared": "对话已清空",
                 "no_conversation": "没有对话记录可导出",
                 "export_title": "导出对话记录",
@@ -82,13 +3933,28 @@ class EasyChat:
                 "connection_fail": "连接失败: ",
                 "connection_error": "连接测试失败: ",
                 "rate_limit": "请求频率超限，请等待{seconds}秒后重试。",
-                "wait_time": "请求过于频繁，请等待 {seconds} 秒...",
+                "wait_time": "请求过于频繁，请等待 {seconds} 秒...（按 Esc 取消）",
                 "not_connected": "未连接",
                 "connected": "已连接",
                 "connection_lost": "连接失败",
                 "text_file": "文本文件",
                 "all_files": "所有文件",
                 "conversation_header": "EasyChat 对话记录",
+                "export_format": "导出格式",
+                "export_scope": "导出范围",
+                "export_current": "当前对话",
+                "export_all": "所有对话",
+                "export_progress": "正在导出… {percent}%",
+                "export_running": "正在导出，请等待当前导出完成",
+                "import": "导入",
+                "import_title": "导入对话记录",
+                "import_files": "对话记录 (JSON/JSONL)",
+                "import_progress": "正在导入… {percent}%",
+                "import_success": "已导入 {count} 个对话",
+                "import_empty": "文件中没有可导入的消息",
+                "import_fail": "导入失败: ",
+                "import_running": "正在导入，请等待当前导入完成",
+                "import_unavailable": "对话存储不可用，无法导入",
                 "select_avatar": "选择头像",
                 "avatar": "用户头像",
                 "avatar_updated": "头像更新成功",
@@ -103,6 +3969,31 @@ class EasyChat:
                 "request_timeout": "请求超时，请检查网络连接",
                 "connection_failed": "连接失败，请检查网络或API地址",
                 "error_occurred": "发生错误: {error}",
+                "stream_responses": "流式输出回复",
+                "receiving": "正在接收回复...",
+                "timing_status": "排队 {queue:.2f}s · 连接 {connect:.2f}s · 首字节 {ttfb:.2f}s · 总计 {total:.2f}s",
+                "timing_ttft": " · 首字 {ttft:.2f}s",
+                "timing_tokens": " · {prompt}+{completion} tokens · {tps:.1f} tokens/秒",
+                "context_status": "上下文 {turns} 轮 / {tokens} tokens · 已压缩 {compacted} 轮",
+                "context_pending": " · {dropped} 轮等待摘要",
+                "send_cancelled": "已取消发送",
+                "queued": "排队中",
+                "sending_short": "发送中",
+                "cancelled": "已取消",
+                "stop": "停止",
+                "truncated": "已截断",
+                "pending_messages": "{count} 条消息等待回复...",
+                "parallel_requests": "并发请求数:",
+                "new_conversation": "新对话",
+                "wait_for_replies": "请等待回复完成后再切换对话",
+                "search": "搜索",
+                "search_title": "搜索对话记录",
+                "search_results": "找到 {count} 条结果，用时 {ms:.1f} 毫秒",
+                "search_unavailable": "当前的SQLite不支持全文搜索（FTS5）",
+                "use_cache": "缓存相同请求的回复",
+                "bypass_cache": "本对话不使用缓存",
+                "cache_status": "缓存命中 {hits} / 未命中 {misses}",
+                "cached_reply": "⚡ 缓存",
             },
             "English": {
                 "window_title": "EasyChat - AI Conversation Assistant",
@@ -130,9 +4021,16 @@ class EasyChat:
                 "sending": "Sending message...",
                 "send_success": "Message sent successfully",
                 "send_fail": "Send failed",
+                "input_restored": "Send failed, the message is back in the input box",
+                "endpoint_ok": "{name}: OK",
+                "endpoint_down": "{name}: unavailable ({status})",
+                "retrying": "Request failed ({reason}), retrying in {seconds:.1f}s (attempt {attempt})",
+                "reason_timeout": "timeout",
+                "reason_connection": "connection failed",
+                "retrying_short": "Attempt {attempt}",
                 "copied": "Message copied to clipboard",
                 "no_api_key": "Please configure API key in settings first",
-                "confirm_clear": "Are you sure you want to clear all conversations?",
+                "confirm_clear": "Clear the current conversation? (It stays available in the conversation list)",
                 "cleared": "Conversation cleared",
                 "no_conversation": "No conversation to export",
                 "export_title": "Export Conversation",
@@ -144,13 +4042,28 @@ class EasyChat:
                 "connection_fail": "Connection failed: ",
                 "connection_error": "Connection test failed: ",
                 "rate_limit": "Rate limit exceeded, please wait {seconds} seconds.",
-                "wait_time": "Too many requests, please wait {seconds} seconds...",
+                "wait_time": "Too many requests, please wait {seconds} seconds... (Esc to cancel)",
                 "not_connected": "Not Connected",
                 "connected": "Connected",
                 "connection_lost": "Connection Lost",
                 "text_file": "Text File",
                 "all_files": "All Files",
                 "conversation_header": "EasyChat Conversation Log",
+                "export_format": "Format",
+                "export_scope": "Conversations",
+                "export_current": "Current conversation",
+                "export_all": "All conversations",
+                "export_progress": "Exporting... {percent}%",
+                "export_running": "An export is already running",
+                "import": "Import",
+                "import_title": "Import Conversations",
+                "import_files": "Conversations (JSON/JSONL)",
+                "import_progress": "Importing... {percent}%",
+                "import_success": "Imported {count} conversation(s)",
+                "import_empty": "No messages to import in this file",
+                "import_fail": "Import failed: ",
+                "import_running": "An import is already running",
+                "import_unavailable": "Conversation storage is not available, cannot import",
                 "select_avatar": "Select Avatar",
                 "avatar": "User Avatar",
                 "avatar_updated": "Avatar updated successfully",
@@ -165,6 +4078,31 @@ class EasyChat:
                 "request_timeout": "Request timeout, please check your network connection",
                 "connection_failed": "Connection failed, please check your network or API URL",
                 "error_occurred": "Error occurred: {error}",
+                "stream_responses": "Stream responses",
+                "receiving": "Receiving response...",
+                "timing_status": "Queue {queue:.2f}s · Connect {connect:.2f}s · TTFB {ttfb:.2f}s · Total {total:.2f}s",
+                "timing_ttft": " · First token {ttft:.2f}s",
+                "timing_tokens": " · {prompt}+{completion} tokens · {tps:.1f} tokens/s",
+                "context_status": "Context {turns} turns / {tokens} tokens · {compacted} compacted",
+                "context_pending": " · {dropped} awaiting summary",
+                "send_cancelled": "Sending cancelled",
+                "queued": "Queued",
+                "sending_short": "Sending",
+                "cancelled": "Cancelled",
+                "stop": "Stop",
+                "truncated": "Truncated",
+                "pending_messages": "{count} message(s) awaiting reply...",
+                "parallel_requests": "Parallel Requests:",
+                "new_conversation": "New Chat",
+                "wait_for_replies": "Please wait for pending replies before switching conversations",
+                "search": "Search",
+                "search_title": "Search Conversations",
+                "search_results": "{count} result(s) in {ms:.1f} ms",
+                "search_unavailable": "Full-text search (FTS5) is not available in this SQLite build",
+                "use_cache": "Cache replies to identical requests",
+                "bypass_cache": "No cache for this chat",
+                "cache_status": "Cache {hits} hits / {misses} misses",
+                "cached_reply": "⚡ Cached",
             }
         }
 
@@ -181,65 +4119,92 @@ class EasyChat:
             # 更新工具栏按钮
             if hasattr(self, 'toolbar_frame'):
                 for widget in self.toolbar_frame.winfo_children():
-                    if isinstance(widget, ttk.Frame):  # tools_frame
+                    if isinstance(widget, ttk.Frame):  # middle_frame / tools_frame
                         for btn in widget.winfo_children():
                             if isinstance(btn, ttk.Button):
                                 if "⚙" in btn['text']:
                                     btn.configure(text="⚙ " + self.get_text("settings"))
                                 elif "📁" in btn['text']:
                                     btn.configure(text="📁 " + self.get_text("export"))
+                                elif "📥" in btn['text']:
+                                    btn.configure(text="📥 " + self.get_text("import"))
                                 elif "🗑" in btn['text']:
                                     btn.configure(text="🗑 " + self.get_text("clear"))
+                                elif "🔍" in btn['text']:
+                                    btn.configure(text="🔍 " + self.get_text("search"))
+                                elif "＋" in btn['text']:
+                                    btn.configure(text="＋ " + self.get_text("new_conversation"))
             
             # 更新发送按钮
             if hasattr(self, 'send_button'):
                 self.send_button.configure(text=self.get_text("send"))
+                self.stop_button.configure(text="⏹ " + self.get_text("stop"))
             
             # 更新状态栏
             if hasattr(self, 'status_label'):
                 current_status = self.status_label['text']
                 if current_status == "就绪" or current_status == "Ready":
-                    self.status_label.configure(text=self.get_text("ready"))
+                    self.render.configure(self.status_label, text=self.get_text("ready"))
                 elif "发送成功" in current_status or "sent successfully" in current_status:
-                    self.status_label.configure(text=self.get_text("send_success"))
+                    self.render.configure(self.status_label, text=self.get_text("send_success"))
                 elif "发送失败" in current_status or "Send failed" in current_status:
-                    self.status_label.configure(text=self.get_text("send_fail"))
+                    self.render.configure(self.status_label, text=self.get_text("send_fail"))
+            
+            # 更新请求耗时
+            if hasattr(self, 'timing_label'):
+                self.show_timing(self.last_timing)
+            
+            # 更新缓存统计
+            if hasattr(self, 'cache_label'):
+                self.update_cache_status()
+                self.bypass_check.configure(text=self.get_text("bypass_cache"))
             
             # 更新连接状态
             if hasattr(self, 'connection_status'):
                 current_conn = self.connection_status['text']
                 if "未连接" in current_conn or "Not Connected" in current_conn:
-                    self.connection_status.configure(text="● " + self.get_text("not_connected"))
+                    self.render.configure(self.connection_status, text="● " + self.get_text("not_connected"))
                 elif "已连接" in current_conn or "Connected" in current_conn:
-                    self.connection_status.configure(text="● " + self.get_text("connected"))
+                    self.render.configure(self.connection_status, text="● " + self.get_text("connected"))
                 elif "连接失败" in current_conn or "Connection Lost" in current_conn:
-                    self.connection_status.configure(text="● " + self.get_text("connection_lost"))
+                    self.render.configure(self.connection_status, text="● " + self.get_text("connection_lost"))
             
             # 保存当前语言设置
             self.save_config()
             
-        except Exception as e:
-            print(f"Language update error: {str(e)}")
+        except Exception:
+            report_error("Language update error")
 
+    def on_model_change(self, *args):
+        """同步当前模型到聊天核心"""
+        self.engine.config.model = self.model_name.get()
+        
+    def setup_fonts(self):
+        """创建共享的命名字体，调整字号时只需修改字体对象，引用它的控件由 Tk 自动更新"""
+        family = resolve_font_family(self.root, self.font_family)
+        self.chat_font = tkfont.Font(self.root, name='EasyChatMessage', family=family, size=self.chat_font_size.get())
+        self.input_font = tkfont.Font(self.root, name='EasyChatInput', family=family, size=self.input_font_size.get())
+        self.time_font = tkfont.Font(self.root, name='EasyChatTime', family=family, size=8)
+        self.status_font = tkfont.Font(self.root, name='EasyChatStatus', family=family, size=9)
+        self.list_font = tkfont.Font(self.root, name='EasyChatList', family=family, size=10)
+        self.button_font = tkfont.Font(self.root, name='EasyChatButton', family=family, size=10, weight='bold')
+        self.title_font = tkfont.Font(self.root, name='EasyChatTitle', family=family, size=16, weight='bold')
+        
     def setup_window(self):
         """设置主窗口"""
         self.root.title(self.get_text("window_title"))
-        self.root.geometry("1000x700")
         self.root.minsize(800, 600)
         
         # 设置窗口图标和样式
         self.root.configure(bg='#f8f9fa')
         
         # 居中显示窗口
-        self.center_window()
-        
-    def center_window(self):
-        """窗口居中显示"""
-        self.root.update_idletasks()
-        width = self.root.winfo_width()
-        height = self.root.winfo_height()
-        x = (self.root.winfo_screenwidth() // 2) - (width // 2)
-        y = (self.root.winfo_screenheight() // 2) - (height // 2)
+        self.center_window(1000, 700)
+        
+    def center_window(self, width, height):
+        """按给定的大小居中显示窗口；不调用 update_idletasks 等待布局，以免在控件创建之前先绘制一次空窗口"""
+        x = max((self.root.winfo_screenwidth() - width) // 2, 0)
+        y = max((self.root.winfo_screenheight() - height) // 2, 0)
         self.root.geometry(f'{width}x{height}+{x}+{y}')
         
     def load_config(self):
@@ -249,28 +4214,67 @@ class EasyChat:
         
         if os.path.exists(self.config_file):
             self.config.read(self.config_file, encoding='utf-8')
-            if 'API' in self.config:
-                self.api_key.set(self.config.get('API', 'key', fallback=''))
-                self.api_url.set(self.config.get('API', 'url', fallback='https://api.openai.com/v1/chat/completions'))
-                self.model_name.set(self.config.get('API', 'model', fallback='gpt-3.5-turbo'))
             if 'Settings' in self.config:
                 self.language.set(self.config.get('Settings', 'language', fallback='中文'))
                 self.chat_font_size.set(self.config.getint('Settings', 'chat_font_size', fallback=11))
                 self.input_font_size.set(self.config.getint('Settings', 'input_font_size', fallback=11))
+        self.max_fps = self.config.getint('Settings', 'max_fps', fallback=30)  # 界面刷新的帧率上限
+        self.render_markdown = self.config.getboolean('Settings', 'markdown', fallback=True)  # 助手消息按 Markdown 显示
+        self.font_family = self.config.get('Settings', 'font_family', fallback='')  # 留空时按平台自动选择
+                
+        # API、网络、上下文、速率限制和缓存的配置交给与界面无关的聊天核心，后台请求都在常驻线程池中执行
+        engine_config = ChatConfig.from_parser(self.config)
+        self.workers = WorkerPool(self.worker_count(engine_config))
+        self.engine = ChatEngine(engine_config, runner=self.workers.submit)
+        self.api_key.set(engine_config.api_key)
+        self.api_url.set(engine_config.api_url)
+        self.model_name.set(engine_config.model)
+        self.stream_responses.set(engine_config.stream)
+        self.parallel_requests.set(engine_config.parallel_requests)
+        self.use_cache.set(engine_config.cache_enabled)
+        
+        # 对话存储
+        self.database_file = self.config.get('Storage', 'database', fallback='easychat_history.db')
+        self.history_page_size = self.config.getint('Storage', 'page_size', fallback=50)
+        
+        # bypass 中记录不使用缓存的对话id
+        self.cache_bypass_ids = {int(value) for value in self.config.get('Cache', 'bypass', fallback='').split(',')
+                                 if value.strip().isdigit()}
+        
+    @staticmethod
+    def worker_count(engine_config):
+        """工作线程数：至少比并发请求数多一个，留给摘要和连接测试"""
+        return max(engine_config.workers, engine_config.parallel_requests + 1)
+        
+    def apply_engine_settings(self):
+        """把界面中的设置同步到聊天核心（工作线程只读取聊天核心的配置）"""
+        engine_config = self.engine.config
+        engine_config.api_key = self.api_key.get()
+        engine_config.api_url = self.api_url.get()
+        engine_config.model = self.model_name.get()
+        engine_config.stream = self.stream_responses.get()
+        engine_config.parallel_requests = self.parallel_requests.get()
+        engine_config.cache_enabled = self.use_cache.get()
+        self.engine.apply_config()
                 
     def save_config(self):
         """保存配置文件"""
-        if 'API' not in self.config:
-            self.config.add_section('API')
+        self.apply_engine_settings()
+        self.engine.config.save_to(self.config)
         if 'Settings' not in self.config:
             self.config.add_section('Settings')
+        if 'Storage' not in self.config:
+            self.config.add_section('Storage')
+            self.config.set('Storage', 'database', self.database_file)
+            self.config.set('Storage', 'page_size', str(self.history_page_size))
             
-        self.config.set('API', 'key', self.api_key.get())
-        self.config.set('API', 'url', self.api_url.get())
-        self.config.set('API', 'model', self.model_name.get())
+        self.config.set('Cache', 'bypass', ",".join(str(i) for i in sorted(self.cache_bypass_ids)))
         self.config.set('Settings', 'language', self.language.get())
         self.config.set('Settings', 'chat_font_size', str(self.chat_font_size.get()))
         self.config.set('Settings', 'input_font_size', str(self.input_font_size.get()))
+        self.config.set('Settings', 'max_fps', str(self.max_fps))
+        self.config.set('Settings', 'markdown', str(self.render_markdown).lower())
+        self.config.set('Settings', 'font_family', self.font_family)
         
         with open(self.config_file, 'w', encoding='utf-8') as f:
             self.config.write(f)
@@ -312,7 +4316,7 @@ class EasyChat:
                        borderwidth=0,  # 去掉边框
                        focuscolor='none',
                        width=10,
-                       font=('Microsoft YaHei UI', 10, 'bold'),  # 保持粗体
+                       font=self.button_font,  # 保持粗体
                        background='#e6e6e6',  # 浅灰色背景
                        foreground='#333333')  # 深灰色文字
         style.map('Send.TButton',
@@ -339,7 +4343,7 @@ class EasyChat:
         title_label = ttk.Label(
             self.toolbar_frame, 
             text="EasyChat", 
-            font=('Microsoft YaHei UI', 16, 'bold'),
+            font=self.title_font,
             background='#ffffff',
             foreground='#2c3e50'
         )
@@ -349,6 +4353,24 @@ class EasyChat:
         middle_frame = ttk.Frame(self.toolbar_frame, style='Toolbar.TFrame')
         middle_frame.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
+        # 历史对话下拉框
+        self.conversation_combo = ttk.Combobox(
+            middle_frame,
+            state="readonly",
+            width=24
+        )
+        self.conversation_combo.pack(side=tk.LEFT)
+        self.conversation_combo.bind('<<ComboboxSelected>>', self.on_conversation_selected)
+        
+        # 新对话按钮
+        new_btn = ttk.Button(
+            middle_frame,
+            text="＋ " + self.get_text("new_conversation"),
+            command=self.new_conversation,
+            style='Clear.TButton'
+        )
+        new_btn.pack(side=tk.LEFT, padx=(5, 0))
+        
         # 模型选择下拉框
         models = ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo"]
         model_combo = ttk.Combobox(
@@ -383,6 +4405,15 @@ class EasyChat:
         )
         settings_btn.pack(side=tk.RIGHT, padx=(5, 0))
         
+        # 搜索按钮
+        search_btn = ttk.Button(
+            tools_frame, 
+            text="🔍 " + self.get_text("search"), 
+            command=self.open_search,
+            style='Clear.TButton'
+        )
+        search_btn.pack(side=tk.RIGHT, padx=(5, 0))
+        
         # 导出对话按钮
         export_btn = ttk.Button(
             tools_frame, 
@@ -392,6 +4423,15 @@ class EasyChat:
         )
         export_btn.pack(side=tk.RIGHT, padx=(5, 0))
         
+        # 导入对话按钮
+        import_btn = ttk.Button(
+            tools_frame, 
+            text="📥 " + self.get_text("import"), 
+            command=self.import_conversations,
+            style='Clear.TButton'
+        )
+        import_btn.pack(side=tk.RIGHT, padx=(5, 0))
+        
         # 清空对话按钮
         clear_btn = ttk.Button(
             tools_frame, 
@@ -405,80 +4445,16 @@ class EasyChat:
         """创建聊天显示区域"""
         self.chat_frame = ttk.Frame(self.main_frame, style='Chat.TFrame', padding="10")
         
-        # 创建画布和滚动条
-        self.chat_canvas = tk.Canvas(
-            self.chat_frame,
-            bg='#f0f0f0',
-            highlightthickness=0,
-            relief='flat'
-        )
-        self.scrollbar = ttk.Scrollbar(
-            self.chat_frame,
-            orient="vertical",
-            command=self.chat_canvas.yview
-        )
-        
-        # 创建消息容器框架
-        self.message_frame = ttk.Frame(
-            self.chat_canvas,
-            style='Chat.TFrame'
-        )
-        
-        # 配置画布滚动
-        self.chat_canvas.configure(yscrollcommand=self.on_scroll_change)
-        self.chat_canvas.create_window((0, 0), window=self.message_frame, anchor="nw")
+        # 虚拟化的消息列表，只有可视区域附近的消息才会创建控件；代码高亮在后台线程中计算
+        renderer = MarkdownRenderer(self.ui.post, self.workers) if self.render_markdown else None
+        self.chat_view = ChatView(self.chat_frame, self.chat_font, self.time_font, renderer)
+        self.chat_canvas = self.chat_view.canvas
+        self.scrollbar = self.chat_view.scrollbar
+        self.chat_view.on_reach_top = self.load_older_messages
         
         # 布局
         self.chat_canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        # 绑定事件
-        self.message_frame.bind('<Configure>', self.on_frame_configure)
-        self.chat_canvas.bind('<Configure>', self.on_canvas_configure)
-        self.chat_canvas.bind_all("<MouseWheel>", self.on_mousewheel)
-        
-        # 初始化最小滚动位置
-        self.min_scroll = 0.0
-
-    def on_scroll_change(self, *args):
-        """处理滚动条位置变化"""
-        # 确保不会滚动超过顶部
-        if float(args[0]) < self.min_scroll:
-            self.chat_canvas.yview_moveto(self.min_scroll)
-        else:
-            self.scrollbar.set(*args)
-
-    def on_mousewheel(self, event):
-        """鼠标滚轮事件"""
-        if len(self.message_frame.winfo_children()) > 0:
-            # 计算新的滚动位置
-            delta = -1 * (event.delta / 120)
-            current_pos = self.chat_canvas.yview()[0]
-            new_pos = current_pos + (delta * 0.05)  # 0.05是滚动步长
-            
-            # 限制最小滚动位置
-            if new_pos >= self.min_scroll:
-                self.chat_canvas.yview_scroll(int(delta), "units")
-
-    def on_frame_configure(self, event=None):
-        """当消息框架大小改变时，更新画布滚动区域"""
-        self.chat_canvas.configure(scrollregion=self.chat_canvas.bbox("all"))
-        
-        # 计算最小滚动位置（防止滚动超过第一条消息）
-        if len(self.message_frame.winfo_children()) > 0:
-            canvas_height = self.chat_canvas.winfo_height()
-            frame_height = self.message_frame.winfo_height()
-            if frame_height > canvas_height:
-                self.min_scroll = 0.0
-            else:
-                self.min_scroll = 0.0
-        else:
-            self.min_scroll = 0.0
-
-    def on_canvas_configure(self, event):
-        """当画布大小改变时，调整消息框架宽度"""
-        width = event.width - 4  # 减去一点空间给滚动条
-        self.chat_canvas.itemconfig(self.chat_canvas.find_withtag("all")[0], width=width)
 
     def create_input_area(self):
         """创建输入区域"""
@@ -501,7 +4477,7 @@ class EasyChat:
             text_container,  # 放在白色容器中
             height=4,
             wrap=tk.WORD,
-            font=('Microsoft YaHei UI', 10),
+            font=self.input_font,
             bg='#ffffff',
             fg='#2c3e50',
             relief='groove',
@@ -528,6 +4504,16 @@ class EasyChat:
             style='Send.TButton'
         )
         self.send_button.pack(fill=tk.BOTH, expand=True)  # 使用pack布局填充容器
+        
+        # 停止按钮，有消息等待回复时可用
+        self.stop_button = ttk.Button(
+            button_container,
+            text="⏹ " + self.get_text("stop"),
+            command=self.stop_sending,
+            style='Clear.TButton',
+            state=tk.DISABLED
+        )
+        self.stop_button.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
 
     def create_status_bar(self):
         """创建状态栏"""
@@ -535,26 +4521,68 @@ class EasyChat:
         
         # 使用grid布局来确保状态栏元素的正确位置
         self.status_frame.grid_columnconfigure(0, weight=1)  # 状态文本可以占据剩余空间
-        self.status_frame.grid_columnconfigure(1, weight=0)  # 连接状态固定宽度
+        self.status_frame.grid_columnconfigure(1, weight=0)  # 上下文信息固定宽度
+        self.status_frame.grid_columnconfigure(2, weight=0)  # 请求耗时固定宽度
+        self.status_frame.grid_columnconfigure(3, weight=0)  # 缓存统计固定宽度
+        self.status_frame.grid_columnconfigure(4, weight=0)  # 缓存开关固定宽度
+        self.status_frame.grid_columnconfigure(5, weight=0)  # 连接状态固定宽度
         
         self.status_label = ttk.Label(
             self.status_frame,
             text=self.get_text("ready"),
-            font=('Microsoft YaHei UI', 9),
+            font=self.status_font,
             background='#ffffff',
             foreground='#6c757d'
         )
         self.status_label.grid(row=0, column=0, sticky="w")
         
+        # 上下文窗口信息：本次发送的轮数、token数以及被压缩的轮数
+        self.context_label = ttk.Label(
+            self.status_frame,
+            text="",
+            font=self.status_font,
+            background='#ffffff',
+            foreground='#6c757d'
+        )
+        self.context_label.grid(row=0, column=1, sticky="e", padx=(10, 0))
+        
+        # 最近一次请求的耗时分解：排队、连接、首字节、总耗时和token用量
+        self.timing_label = ttk.Label(
+            self.status_frame,
+            text="",
+            font=self.status_font,
+            background='#ffffff',
+            foreground='#6c757d'
+        )
+        self.timing_label.grid(row=0, column=2, sticky="e", padx=(10, 0))
+        
+        # 回复缓存的命中统计，以及当前对话是否跳过缓存（仅在启用缓存时显示）
+        self.cache_label = ttk.Label(
+            self.status_frame,
+            text=self.get_text("cache_status").format(hits=0, misses=0),
+            font=self.status_font,
+            background='#ffffff',
+            foreground='#6c757d'
+        )
+        self.cache_label.grid(row=0, column=3, sticky="e", padx=(10, 0))
+        self.bypass_check = ttk.Checkbutton(
+            self.status_frame,
+            text=self.get_text("bypass_cache"),
+            variable=self.bypass_cache,
+            command=self.on_bypass_cache_toggle
+        )
+        self.bypass_check.grid(row=0, column=4, sticky="e", padx=(10, 0))
+        self.update_cache_widgets()
+        
         # 连接状态指示器
         self.connection_status = ttk.Label(
             self.status_frame,
             text="● " + self.get_text("not_connected"),
-            font=('Microsoft YaHei UI', 9),
+            font=self.status_font,
             background='#ffffff',
             foreground='#dc3545'
         )
-        self.connection_status.grid(row=0, column=1, sticky="e", padx=(10, 0))
+        self.connection_status.grid(row=0, column=5, sticky="e", padx=(10, 0))
 
     def setup_layout(self):
         """设置布局"""
@@ -586,16 +4614,17 @@ class EasyChat:
         """设置事件绑定"""
         # Ctrl+Enter 发送消息
         self.input_text.bind('<Control-Return>', lambda e: self.send_message())
+        # Ctrl+F 搜索对话记录
+        self.root.bind('<Control-f>', lambda e: self.open_search())
+        # Esc 停止排队中和正在接收的回复
+        self.root.bind('<Escape>', lambda e: self.stop_sending())
         # Enter 换行
         self.input_text.bind('<Return>', lambda e: None)
         # 窗口关闭事件
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         
     def send_message(self):
-        """发送消息"""
-        if self.is_sending:
-            return
-            
+        """发送消息（正在等待回复时新消息进入队列）"""
         message = self.input_text.get("1.0", tk.END).strip()
         if not message:
             return
@@ -608,211 +4637,836 @@ class EasyChat:
         # 清空输入框
         self.input_text.delete("1.0", tk.END)
         
-        # 显示用户消息
-        self.add_message("user", message)
+        # 显示用户消息，发送前标记为排队中
+        view_index = self.add_message("user", message)
+        self.chat_view.set_status(view_index, self.get_text("queued"))
         
-        # 开始发送
-        self.is_sending = True
-        self.send_button.configure(state='disabled', text=self.get_text("sending"))
-        self.progress_bar.pack(side=tk.LEFT, padx=(0, 20))  # 显示进度条
-        self.progress_bar.start()
-        self.status_label.configure(text=self.get_text("sending"))
+        seq = self.next_seq
+        self.next_seq += 1
+        self.pending_turns[seq] = {"message": message, "model": self.model_name.get(), "view_index": view_index,
+                                   "reply": None, "done": False, "sent_at": time.time(), "stats": None}
+        self.update_send_state()
         
-        # 在新线程中调用API
-        threading.Thread(target=self.call_api, args=(message,), daemon=True).start()
+        # 交给调度器，并发数和速率限制允许时再发送
+        self.send_scheduler.submit({"seq": seq, "message": message, "model": self.model_name.get(),
+                                    "queued_at": time.perf_counter()})
         
-    def call_api(self, message):
-        """调用AI API"""
-        try:
-            # 检查请求频率
-            current_time = time.time()
-            self.request_timestamps.append(current_time)
-            
-            # 如果在1分钟内的请求数超过3个，则等待
-            if len(self.request_timestamps) >= 3:
-                time_diff = current_time - self.request_timestamps[0]
-                if time_diff < 60:  # 小于60秒
-                    wait_time = 60 - time_diff
-                    self.root.after(0, lambda: self.status_label.configure(text=self.get_text("wait_time") + str(int(wait_time))))
-                    time.sleep(wait_time)
-
-            # 准备请求数据
-            self.conversation_history.append({"role": "user", "content": message})
-            
-            headers = {
-                "Authorization": f"Bearer {self.api_key.get()}",
-                "Content-Type": "application/json"
-            }
+    def prepare_job(self, job):
+        """发送前按模型的token预算裁剪历史，较早的对话以摘要代替"""
+        messages, context_stats = self.engine.build_context(job["message"], job["model"])
+        job["messages"] = messages
+        job["context_stats"] = context_stats
+        job["tokens"] = self.engine.request_tokens(context_stats)
+        
+        # 相同的模型、历史和参数已有回复时直接使用缓存：这里只查内存，磁盘缓存由工作线程在发送前查询
+        job["cache_key"] = job["cached"] = None
+        if self.engine.config.cache_enabled and not self.bypass_cache.get():
+            job["cache_key"], job["cached"] = self.engine.cache_lookup(messages, job["model"], memory_only=True)
+            self.update_cache_status()
+        
+    def dispatch_job(self, job):
+        """速率限制允许后发送消息"""
+        turn = self.pending_turns.get(job["seq"])
+        if turn is not None:
+            self.chat_view.set_status(turn["view_index"], self.get_text("sending_short"))
+        self.update_context_status(job["context_stats"])
+        self.update_send_state()
+        self.active_requests[job["seq"]] = cancel = CancelToken()
+        
+        if job["cached"] is not None:
+            self.ui.post(self.on_api_success, job["seq"], job["cached"], True)
+            return
+        
+        # 在线程池中调用API，工作线程只拿到这份请求快照
+        request = ChatRequest(
+            seq=job["seq"],
+            messages=tuple(dict(message) for message in job["messages"]),
+            model=job["model"],
+            stream=self.engine.config.stream,
+            cache_key=job["cache_key"],
+            queued_at=job["queued_at"],
+            cancel=cancel
+        )
+        self.workers.submit(self.call_api, request)
+        
+    def on_rate_wait(self, job, seconds):
+        """等待速率限制时显示倒计时"""
+        self.render.configure(self.status_label, text=self.get_text("wait_time").format(seconds=math.ceil(seconds)))
+        
+    def stop_sending(self):
+        """停止所有排队中和已发出的请求：已收到的部分回复保留并标记为已截断，还没有回复的消息放回输入框"""
+        jobs = self.send_scheduler.cancel_all()
+        active = list(self.active_requests.items())
+        if not jobs and not active:
+            return
+        self.active_requests.clear()
+        self.render.flush()  # 先把已收到的文本写入消息，之后到达的片段不再显示
+        
+        restored = []
+        for seq, cancel in active:
+            cancel.set()  # 关闭连接，工作线程随即结束
+            turn = self.pending_turns.get(seq)
+            index = self.streaming_rows.pop(seq, None)
+            if turn is None:
+                continue
+            partial = self.chat_view.row(index).text if index is not None else ""
+            if partial.strip():
+                self.complete_turn(seq, partial, {"truncated": True})
+                self.chat_view.set_status(index, self.get_text("truncated"))
+            else:
+                del self.pending_turns[seq]
+                self.chat_view.set_status(turn["view_index"], self.get_text("cancelled"))
+                restored.append((seq, turn["message"]))
+        for job in jobs:
+            turn = self.pending_turns.pop(job["seq"], None)
+            if turn is not None:
+                self.chat_view.set_status(turn["view_index"], self.get_text("cancelled"))
+                restored.append((job["seq"], job["message"]))
+        self.flush_turns()
+        for _ in active:
+            self.send_scheduler.done()
             
-            data = {
-                "model": self.model_name.get(),
-                "messages": self.conversation_history,
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
+        if restored and not self.input_text.get("1.0", "end-1c").strip():
+            self.input_text.insert("1.0", "\n\n".join(message for _, message in sorted(restored)))
+        self.finish_sending(self.get_text("send_cancelled"))
+        
+    def complete_turn(self, seq, reply, stats=None):
+        """请求结束：按发送顺序把完成的对话写入历史，reply为None表示失败，stats为回复的耗时统计"""
+        turn = self.pending_turns.get(seq)
+        if turn is not None:
+            turn["reply"] = reply
+            turn["done"] = True
+            turn["stats"] = dict(stats or {}, elapsed=time.time() - turn["sent_at"])
+            self.chat_view.set_status(turn["view_index"], None if reply is not None else self.get_text("send_fail"))
+            self.flush_turns()
             
-            # 发送请求
-            response = requests.post(
-                self.api_url.get(),
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                assistant_message = result['choices'][0]['message']['content']
-                self.conversation_history.append({"role": "assistant", "content": assistant_message})
-                self.root.after(0, self.on_api_success, assistant_message)
-            elif response.status_code == 429:
-                error_response = response.json()
-                retry_after = int(response.headers.get('Retry-After', 60))
-                error_msg = self.get_text("rate_limit").format(seconds=retry_after)
-                if 'error' in error_response:
-                    error_msg += f"\n{self.get_text('api_error_details').format(message=error_response['error'].get('message', ''))}"
-                self.root.after(0, self.on_api_error, error_msg)
-            else:
-                try:
-                    error_response = response.json()
-                    error_msg = self.get_text("api_error_status").format(status_code=response.status_code)
-                    if 'error' in error_response:
-                        error_msg += f"\n{self.get_text('api_error_details').format(message=error_response['error'].get('message', ''))}"
-                except:
-                    error_msg = self.get_text("api_error_status").format(status_code=response.status_code)
-                self.root.after(0, self.on_api_error, error_msg)
-                
-        except requests.exceptions.Timeout:
-            self.root.after(0, self.on_api_error, self.get_text("request_timeout"))
-        except requests.exceptions.ConnectionError:
-            self.root.after(0, self.on_api_error, self.get_text("connection_failed"))
-        except Exception as e:
-            self.root.after(0, self.on_api_error, self.get_text("error_occurred").format(error=str(e)))
+    def flush_turns(self):
+        """把已完成的对话按发送顺序写入历史，前面的消息还没有回复时先等待，保证历史顺序与发送顺序一致"""
+        while self.pending_turns:
+            first_seq, first = next(iter(self.pending_turns.items()))
+            if not first["done"]:
+                break
+            del self.pending_turns[first_seq]
+            if first["reply"] is not None:
+                self.engine.commit(first["message"], first["reply"])
+            self.persist_turn(first)
+            
+    def persist_turn(self, turn):
+        """把完成的一轮对话写入存储；存储还没打开或对话正在新建时先排队，之后按顺序写入"""
+        self.unsaved_turns.append(turn)
+        self.save_turns()
+        
+    def save_turns(self):
+        """写入排队的轮次，当前对话还没有记录时先在工作线程中新建"""
+        if self.store is None or not self.unsaved_turns:
+            return
+        if self.conversation_id is not None:
+            for turn in self.unsaved_turns:
+                self.write_turn(self.conversation_id, turn)
+            self.unsaved_turns.clear()
+        elif not self.creating_conversation:
+            self.creating_conversation = True
+            self.start_conversation(self.unsaved_turns, self.history_generation)
+            
+    def write_turn(self, conversation_id, turn):
+        """把完成的一轮对话加入写入队列，失败的消息也会保存但不计入上下文"""
+        if turn["reply"] is not None:
+            self.store.append_message(conversation_id, "user", turn["message"], turn["model"],
+                                      created_at=turn["sent_at"])
+            self.store.append_message(conversation_id, "assistant", turn["reply"], turn["model"],
+                                      stats=turn["stats"])
+        else:
+            self.store.append_message(conversation_id, "user", turn["message"], turn["model"], in_context=False,
+                                      created_at=turn["sent_at"])
+            self.store.append_message(conversation_id, "system", turn.get("error", ""), turn["model"], in_context=False)
+            
+    def start_conversation(self, turns, generation):
+        """为 turns 所属的对话新建记录，完成后写入 turns。generation 为当前对话的视图代数，
+        对话已被清空时为None；关闭窗口时工作线程已经退出，直接在界面线程中新建"""
+        title = " ".join(turns[0]["message"].split())[:30]
+        if self.closing:
+            self.on_conversation_created(self.insert_conversation(title), turns, generation)
+        else:
+            self.workers.submit(self.create_conversation, title, turns, generation)
+            
+    def create_conversation(self, title, turns, generation):
+        # 工作线程
+        self.ui.post(self.on_conversation_created, self.insert_conversation(title), turns, generation)
+        
+    def insert_conversation(self, title):
+        """在存储中新建对话，失败时返回None"""
+        try:
+            return self.store.create_conversation(title)
+        except sqlite3.Error:
+            report_error("Storage error")
+            return None
+            
+    def on_conversation_created(self, conversation_id, turns, generation):
+        """对话记录已新建：写入期间排队的轮次，仍是当前对话时开始直接写入"""
+        current = generation == self.history_generation
+        if current:
+            self.creating_conversation = False
+        if conversation_id is None:
+            return  # 留在队列中，下一轮对话完成时再试
+        for turn in turns:
+            self.write_turn(conversation_id, turn)
+        turns.clear()
+        if current:
+            self.conversation_id = conversation_id
+            if self.bypass_cache.get():
+                self.cache_bypass_ids.add(conversation_id)
+        self.refresh_conversation_list()
+        
+    def update_send_state(self):
+        """根据待回复的消息数更新进度条、停止按钮和状态栏"""
+        pending = len(self.pending_turns)
+        if pending:
+            self.progress_bar.pack(side=tk.LEFT, padx=(0, 20))  # 显示进度条
+            self.progress_bar.start()
+            self.render.configure(self.stop_button, state=tk.NORMAL)
+            self.render.configure(self.status_label, text=self.get_text("pending_messages").format(count=pending))
+        
+    def call_api(self, request):
+        """在工作线程中调用AI API，结果经界面分发队列交给界面线程；先查磁盘缓存，命中时不发送请求"""
+        seq = request.seq
+        if request.cache_key is not None:
+            cached = self.engine.cached_reply(request.cache_key)
+            if not self.engine.config.cache_enabled:
+                self.ui.post(self.on_cache_unavailable)
+            if cached is not None:
+                self.engine.router.cancel_reservation(request.model)  # 为这次请求预留的额度用不上了
+                self.ui.post(self.on_api_success, seq, cached, True)
+                return
+            self.ui.post(self.update_cache_status)
+        result = self.engine.send(
+            list(request.messages),
+            request.model,
+            stream=request.stream,
+            cache_key=request.cache_key,
+            queued_at=request.queued_at,
+            stop=request.cancel,
+            on_start=lambda: self.ui.post(self.on_stream_start, seq),
+            on_delta=lambda delta: self.ui.post(self.on_stream_delta, seq, delta),
+            on_retry=lambda attempt, delay, error: self.ui.post(self.on_api_retry, seq, attempt, delay, error)
+        )
+        if not result.ok:
+            self.ui.post(self.on_api_error, seq, result.error, result.stats)
+        elif result.streamed:
+            self.ui.post(self.on_stream_done, seq, result.content, result.stats)
+        else:
+            self.ui.post(self.on_api_success, seq, result.content, False, result.stats)
             
-    def on_api_success(self, message):
-        """API调用成功"""
-        self.add_message("assistant", message)
+    def on_stream_start(self, seq):
+        """收到第一个token时创建助手消息气泡"""
+        if seq not in self.active_requests:
+            return  # 已停止或对话已被清空
+        self.streaming_rows[seq] = self.add_message("assistant", "")
+        self.render.configure(self.status_label, text=self.get_text("receiving"))
+        
+    def on_stream_delta(self, seq, delta):
+        """将新到达的文本追加到助手消息气泡（按帧合并）"""
+        index = self.streaming_rows.get(seq)
+        if index is None:
+            return
+        self.render.append_text(index, delta)
+        
+    def on_stream_done(self, seq, message, stats):
+        """流式回复结束"""
+        if self.active_requests.pop(seq, None) is None:
+            return  # 已停止，停止时已处理
+        self.streaming_rows.pop(seq, None)
+        self.complete_turn(seq, message, stats)
+        self.show_timing(stats)
+        self.finish_sending(self.get_text("send_success"))
+        self.render.configure(self.connection_status, text="● " + self.get_text("connected"), foreground='#28a745')
+        self.send_scheduler.done()
+        
+    def show_timing(self, stats):
+        """在状态栏显示最近一次请求各阶段的耗时和token用量"""
+        if not stats:
+            return
+        self.last_timing = stats
+        text = self.get_text("timing_status").format(
+            queue=stats["queue"], connect=stats["connect"], ttfb=stats["ttfb"] or 0.0, total=stats["total"])
+        if stats["ttft"] is not None:
+            text += self.get_text("timing_ttft").format(ttft=stats["ttft"])
+        if stats["completion_tokens"]:
+            text += self.get_text("timing_tokens").format(prompt=stats["prompt_tokens"] if stats["prompt_tokens"] is not None else "?",
+                                                         completion=stats["completion_tokens"],
+                                                         tps=stats["tokens_per_sec"] or 0.0)
+        if len(self.engine.router.endpoints) > 1:
+            text += f" · {stats['endpoint']}"
+        self.render.configure(self.timing_label, text=text)
+        
+    def update_context_status(self, stats):
+        """在状态栏显示本次发送的上下文信息"""
+        text = self.get_text("context_status").format(**stats)
+        if stats["dropped"]:
+            text += self.get_text("context_pending").format(**stats)
+        self.render.configure(self.context_label, text=text)
+        
+    def on_api_success(self, seq, message, cached=False, stats=None):
+        """API调用成功（cached为True表示回复来自缓存）"""
+        if self.active_requests.pop(seq, None) is None:
+            return  # 已停止，停止时已处理
+        if seq in self.pending_turns:
+            index = self.add_message("assistant", message)
+            if cached:
+                self.chat_view.set_status(index, self.get_text("cached_reply"))
+        self.complete_turn(seq, message, {"cached": True} if cached else stats)
+        self.show_timing(stats)
         self.finish_sending(self.get_text("send_success"))
-        self.connection_status.configure(text="● " + self.get_text("connected"), foreground='#28a745')
+        self.render.configure(self.connection_status, text="● " + self.get_text("connected"), foreground='#28a745')
+        self.send_scheduler.done()
+        
+    def describe_error(self, error):
+        """把聊天核心返回的错误转换为当前语言的提示文字"""
+        if error.kind == 'timeout':
+            return self.get_text("request_timeout")
+        if error.kind == 'connection':
+            return self.get_text("connection_failed")
+        if error.kind == 'rate_limit':
+            error_msg = self.get_text("rate_limit").format(seconds=math.ceil(error.retry_after))
+        elif error.kind == 'status':
+            error_msg = self.get_text("api_error_status").format(status_code=error.status_code)
+        else:
+            return self.get_text("error_occurred").format(error=error.details)
+        if error.details is not None:
+            error_msg += f"\n{self.get_text('api_error_details').format(message=error.details)}"
+        return error_msg
+        
+    def on_api_retry(self, seq, attempt, delay, error):
+        """请求失败后等待重试"""
+        turn = self.pending_turns.get(seq)
+        if turn is None or seq not in self.active_requests:
+            return
+        reason = f"HTTP {error.status_code}" if error.status_code else self.get_text("reason_" + error.kind)
+        self.chat_view.set_status(turn["view_index"], self.get_text("retrying_short").format(attempt=attempt + 1))
+        self.render.configure(self.status_label, text=self.get_text("retrying").format(
+            reason=reason, seconds=delay, attempt=attempt))
         
-    def on_api_error(self, error_msg):
+    def on_api_error(self, seq, error, stats=None):
         """API调用失败"""
-        self.add_message("system", f"{self.get_text('error')}: {error_msg}")
-        self.finish_sending(self.get_text("send_fail"))
-        self.connection_status.configure(text="● " + self.get_text("connection_fail") + self.get_text("connection_lost"), foreground='#dc3545')
+        if self.active_requests.pop(seq, None) is None:
+            return  # 已停止，停止时已处理
+        error_msg = self.describe_error(error)
+        self.show_timing(stats)
+        self.streaming_rows.pop(seq, None)
+        status_text = self.get_text("send_fail")
+        if seq in self.pending_turns:
+            self.pending_turns[seq]["error"] = f"{self.get_text('error')}: {error_msg}"
+            self.add_message("system", self.pending_turns[seq]["error"])
+            # 输入框为空时把发送失败的消息放回去，不必重新输入
+            if not self.input_text.get("1.0", tk.END).strip():
+                self.input_text.insert("1.0", self.pending_turns[seq]["message"])
+                status_text = self.get_text("input_restored")
+        self.complete_turn(seq, None)
+        self.finish_sending(status_text)
+        self.render.configure(self.connection_status, text="● " + self.get_text("connection_fail") + self.get_text("connection_lost"), foreground='#dc3545')
+        self.send_scheduler.done()
         
     def finish_sending(self, status_text):
-        """完成发送"""
-        self.is_sending = False
-        self.send_button.configure(state='normal', text=self.get_text("send"))
+        """完成发送（仍有消息等待回复时保持进度条）"""
+        if self.pending_turns:
+            self.update_send_state()
+            return
         self.progress_bar.stop()
         self.progress_bar.pack_forget()  # 隐藏进度条
-        self.status_label.configure(text=status_text)
+        self.render.configure(self.stop_button, state=tk.DISABLED)
+        self.render.configure(self.status_label, text=status_text)
         
     def add_message(self, sender, message):
-        """添加消息到聊天显示区"""
-        # 创建消息框架
-        msg_container = ttk.Frame(self.message_frame, style='Chat.TFrame')
-        msg_container.pack(fill=tk.X, padx=10, pady=5)
-        
-        # 添加时间戳（如果是新的一组消息）
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        if not hasattr(self, 'last_message_time') or \
-           self.last_message_time is None or \
-           (datetime.now() - self.last_message_time).seconds > 300:
-            time_label = ttk.Label(
-                self.message_frame,
-                text=timestamp,
-                font=('Microsoft YaHei UI', 8),
-                foreground='#999999',
-                background='#f0f0f0'
-            )
-            time_label.pack(pady=(5, 0))
-            self.last_message_time = datetime.now()
-        
-        # 根据发送者决定消息框的样式和位置
-        is_user = sender.lower() == "user"
-        if is_user:
-            msg_container.pack(anchor="e")  # 靠右对齐
-            bubble_color = "#95ec69"  # 微信绿色
-        else:
-            msg_container.pack(anchor="w")  # 靠左对齐
-            bubble_color = "#ffffff"  # 白色
-        
-        # 创建消息气泡
-        bubble_frame = tk.Frame(
-            msg_container,
-            bg=bubble_color,
-            relief="flat",
-            borderwidth=1
-        )
-        bubble_frame.pack(side=tk.RIGHT if is_user else tk.LEFT)
-        
-        # 消息文本
-        msg_text = tk.Text(
-            bubble_frame,
-            wrap=tk.WORD,
-            font=('Microsoft YaHei UI', self.chat_font_size.get()),  # 使用配置的字体大小
-            bg=bubble_color,
-            relief="flat",
-            height=1,
-            width=1,
-            padx=10,
-            pady=5
-        )
-        msg_text.pack(expand=True, fill=tk.BOTH)
-        msg_text.insert("1.0", message)
-        
-        # 计算文本高度
-        msg_text.update_idletasks()
-        lines = int(msg_text.index('end-1c').split('.')[0])
-        text_width = min(len(message) * 10 + 20, 400)  # 限制最大宽度
-        msg_text.configure(
-            width=text_width // 7,  # 估算字符宽度
-            height=lines,
-            state='disabled'  # 设置为只读
-        )
+        """添加消息到聊天显示区，返回消息在视图中的序号"""
+        index = self.chat_view.append(sender, message)
         
         # 滚动到底部
-        self.chat_canvas.update_idletasks()
-        self.chat_canvas.yview_moveto(1.0)
+        self.render.scroll_to_bottom()
+        return index
 
     def clear_conversation(self):
-        """清空对话"""
+        """清空对话（已保存的对话仍可在历史对话列表中找到）"""
         if messagebox.askyesno(self.get_text("clear"), self.get_text("confirm_clear")):
-            # 清空消息框架
-            for widget in self.message_frame.winfo_children():
-                widget.destroy()
-            self.conversation_history.clear()
-            self.last_message_time = None
-            self.status_label.configure(text=self.get_text("cleared"))
+            self.new_conversation()
+            self.render.configure(self.status_label, text=self.get_text("cleared"))
+            
+    def reset_conversation_view(self):
+        """清空消息列表、历史和等待中的请求，已发出的请求被停止"""
+        self.send_scheduler.cancel_all()
+        for cancel in self.active_requests.values():
+            cancel.set()
+            self.send_scheduler.done()
+        self.active_requests.clear()
+        self.render.discard_text()
+        self.chat_view.clear()
+        self.engine.reset()
+        self.pending_turns.clear()
+        if self.unsaved_turns and not self.creating_conversation:
+            # 已完成但还没写入的轮次仍归属于被清空的对话（正在新建的对话写入时自己会带上它们）
+            if self.store is None:
+                self.detached_turns.append(self.unsaved_turns)
+            else:
+                self.start_conversation(self.unsaved_turns, None)
+        self.unsaved_turns = []
+        self.creating_conversation = False
+        self.streaming_rows.clear()
+        self.progress_bar.stop()
+        self.progress_bar.pack_forget()
+        self.render.configure(self.stop_button, state=tk.DISABLED)
+        self.render.configure(self.context_label, text="")
+        self.render.configure(self.timing_label, text="")
+        self.last_timing = None
+        self.oldest_loaded_id = None
+        self.has_more_history = False
+        self.history_generation += 1  # 之前发出的读取结果不再使用
+        self.loading_history = False
+        self.message_rows.clear()
+        self.bypass_cache.set(False)
+        
+    def new_conversation(self):
+        """开始一个新对话，首条消息发送后才写入存储"""
+        self.reset_conversation_view()
+        self.conversation_id = None
+        self.conversation_combo.set("")
+        self.render.configure(self.status_label, text=self.get_text("ready"))
+        
+    def open_store(self):
+        """在工作线程中打开对话存储并读取对话列表，打开后在界面线程中加载最近的对话"""
+        self.workers.submit(self.connect_store)
+        
+    def connect_store(self):
+        # 工作线程：建表、补建索引等都不在界面线程中进行
+        try:
+            store = ConversationStore(self.database_file)
+            conversations = store.list_conversations()
+        except sqlite3.Error:
+            report_error("Storage error")
+            return
+        self.ui.post(self.on_store_opened, store, conversations)
+        
+    def on_store_opened(self, store, conversations):
+        """存储已打开：保存打开之前完成的对话，没有开始新对话时加载最近的对话"""
+        self.store = store
+        self.show_conversation_list(self.list_seq, conversations)
+        for turns in self.detached_turns:
+            self.start_conversation(turns, None)
+        self.detached_turns.clear()
+        if self.unsaved_turns:
+            self.save_turns()
+        elif (self.conversation_ids and self.conversation_id is None and not self.pending_turns
+              and not self.engine.history):
+            # 存储在窗口显示之后才打开，这期间已经开始的对话不被替换
+            self.load_conversation(self.conversation_ids[0])
+            
+    def refresh_conversation_list(self):
+        """在工作线程中读取对话列表，读完后刷新历史对话下拉框"""
+        if self.store is None:
+            return
+        self.list_seq += 1
+        self.workers.submit(self.read_conversation_list, self.list_seq)
+        
+    def read_conversation_list(self, seq):
+        # 工作线程：只读数据库，结果交给界面线程
+        self.ui.post(self.show_conversation_list, seq, self.store.list_conversations())
+        
+    def show_conversation_list(self, seq, conversations):
+        """刷新历史对话下拉框，比最近一次请求早的结果不再使用"""
+        if seq != self.list_seq:
+            return
+        self.conversation_ids = [row[0] for row in conversations]
+        self.conversation_combo.configure(values=[
+            f"{title} · {datetime.fromtimestamp(updated_at).strftime('%m-%d %H:%M')}"
+            for _, title, updated_at in conversations])
+        if self.conversation_id in self.conversation_ids:
+            self.conversation_combo.current(self.conversation_ids.index(self.conversation_id))
+            
+    def on_conversation_selected(self, event=None):
+        """切换到下拉框中选中的对话"""
+        index = self.conversation_combo.current()
+        if index < 0 or self.conversation_ids[index] == self.conversation_id:
+            return
+        if self.pending_turns:
+            self.render.configure(self.status_label, text=self.get_text("wait_for_replies"))
+            self.refresh_conversation_list()
+            return
+        self.load_conversation(self.conversation_ids[index])
+        
+    def load_conversation(self, conversation_id, message_id=None):
+        """切换到一个对话：先清空视图，消息在工作线程中读取。只读取最新的一页（或 message_id 之前少量上文
+        开始的所有消息，读完后滚动到该消息），更早的消息在滚动到顶部时再加载"""
+        self.reset_conversation_view()
+        self.conversation_id = conversation_id
+        self.bypass_cache.set(conversation_id in self.cache_bypass_ids)
+        self.loading_history = True
+        self.workers.submit(self.read_conversation, self.history_generation, conversation_id, message_id)
+        self.refresh_conversation_list()
+        
+    def read_conversation(self, generation, conversation_id, message_id):
+        # 工作线程：等排队的写入完成后读取，结果交给界面线程
+        rows, has_more = [], False
+        try:
+            self.store.flush()
+            if message_id is None:
+                rows = self.store.load_page(conversation_id, limit=self.history_page_size)
+                has_more = len(rows) == self.history_page_size
+            else:
+                first_id = self.store.page_start(conversation_id, message_id)
+                rows = self.store.load_from(conversation_id, first_id)
+                has_more = bool(self.store.load_page(conversation_id, before_id=first_id, limit=1))
+        except sqlite3.Error:
+            report_error("Storage error")
+        self.ui.post(self.show_history, generation, rows, has_more, message_id)
+        
+    def load_older_messages(self):
+        """在工作线程中读取一页更早的消息（同一时间只读一页）"""
+        if (not self.has_more_history or self.loading_history or self.conversation_id is None
+                or self.oldest_loaded_id is None):
+            return
+        self.loading_history = True
+        self.workers.submit(self.read_older_messages, self.history_generation, self.conversation_id,
+                            self.oldest_loaded_id)
+        
+    def read_older_messages(self, generation, conversation_id, before_id):
+        # 工作线程
+        rows = []
+        try:
+            rows = self.store.load_page(conversation_id, before_id=before_id, limit=self.history_page_size)
+        except sqlite3.Error:
+            report_error("Storage error")
+        self.ui.post(self.show_history, generation, rows, len(rows) == self.history_page_size)
+        
+    def show_history(self, generation, rows, has_more, message_id=None):
+        """把读出的消息放到视图最前面并加入历史；期间已切换对话时丢弃。message_id 为要滚动到并高亮的消息"""
+        if generation != self.history_generation:
+            return
+        self.loading_history = False
+        self.has_more_history = has_more
+        if rows:
+            self.oldest_loaded_id = rows[0][0]
+            messages = [(role, content, datetime.fromtimestamp(created_at)) for _, role, content, created_at, _, _ in rows]
+            if self.chat_view.rows:
+                first_index = self.chat_view.prepend(messages)  # 更早的一页，或读取期间已发送了新消息
+            else:
+                first_index = None
+                for message in messages:
+                    index = self.chat_view.append(*message)
+                    first_index = index if first_index is None else first_index
+                self.chat_view.scroll_to_bottom()
+            for offset, row in enumerate(rows):
+                self.message_rows[row[0]] = first_index + offset
+            self.engine.history[:0] = [{"role": role, "content": content}
+                                       for _, role, content, _, _, in_context in rows if in_context]
+        index = self.message_rows.get(message_id)
+        if index is not None:
+            self.chat_view.scroll_to(index)
+            self.chat_view.flash(index)
+            
+    def open_response_cache(self):
+        """在工作线程中打开回复缓存（读入最近用过的回复），界面线程之后只查询内存"""
+        self.engine.get_response_cache()
+        if not self.engine.config.cache_enabled:
+            self.ui.post(self.on_cache_unavailable)
+            
+    def on_cache_unavailable(self):
+        """缓存数据库打开失败，关闭缓存"""
+        self.use_cache.set(False)
+        self.update_cache_widgets()
+        
+    def update_cache_widgets(self):
+        """启用缓存时在状态栏显示命中统计和跳过缓存的开关"""
+        if self.use_cache.get():
+            self.cache_label.grid()
+            self.bypass_check.grid()
+        else:
+            self.cache_label.grid_remove()
+            self.bypass_check.grid_remove()
+            
+    def update_cache_status(self):
+        """刷新缓存命中统计"""
+        cache = self.engine.response_cache
+        self.render.configure(self.cache_label, text=self.get_text("cache_status").format(
+            hits=cache.hits if cache else 0, misses=cache.misses if cache else 0))
+        
+    def on_bypass_cache_toggle(self):
+        """记录当前对话是否跳过缓存（新对话在创建时记录）"""
+        if self.conversation_id is None:
+            return
+        if self.bypass_cache.get():
+            self.cache_bypass_ids.add(self.conversation_id)
+        else:
+            self.cache_bypass_ids.discard(self.conversation_id)
+            
+    def open_search(self):
+        """打开搜索面板：在所有对话中全文搜索，双击结果跳转到对应消息"""
+        if self.store is None or not self.store.fts_enabled:
+            messagebox.showinfo(self.get_text("search"), self.get_text("search_unavailable"))
+            return
+        if getattr(self, 'search_window', None) is not None and self.search_window.winfo_exists():
+            self.search_window.lift()
+            return
+            
+        window = tk.Toplevel(self.root)
+        window.title(self.get_text("search_title"))
+        window.geometry("640x460")
+        window.configure(bg='#f8f9fa')
+        window.transient(self.root)
+        self.search_window = window
+        
+        frame = ttk.Frame(window, padding="10")
+        frame.pack(fill=tk.BOTH, expand=True)
+        
+        query_var = tk.StringVar()
+        entry = ttk.Entry(frame, textvariable=query_var, font=self.input_font)
+        entry.pack(fill=tk.X)
+        entry.focus_set()
+        
+        info_label = ttk.Label(frame, text="", foreground='#6c757d')
+        info_label.pack(fill=tk.X, pady=(5, 5))
+        
+        list_frame = ttk.Frame(frame)
+        list_frame.pack(fill=tk.BOTH, expand=True)
+        results = tk.Listbox(list_frame, font=self.list_font, activestyle='none', relief='flat')
+        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", command=results.yview)
+        results.configure(yscrollcommand=scrollbar.set)
+        results.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        hits = []
+        pending = [None]
+        search_seq = [0]  # 只显示最近一次搜索的结果
+        role_names = {"user": self.get_text("user"), "assistant": self.get_text("assistant")}
+        
+        def run_search():
+            pending[0] = None
+            search_seq[0] += 1
+            self.workers.submit(search_worker, search_seq[0], query_var.get().strip())
+            
+        def search_worker(seq, query):
+            # 工作线程：等排队的写入完成后查询，结果交给界面线程
+            start = time.perf_counter()
+            rows = []
+            if query:
+                try:
+                    self.store.flush()
+                    rows = self.store.search(query)
+                except sqlite3.Error:
+                    report_error("Storage error")
+            self.ui.post(show_results, seq, query, rows, (time.perf_counter() - start) * 1000)
+            
+        def show_results(seq, query, rows, elapsed):
+            if seq != search_seq[0] or not window.winfo_exists():
+                return
+            hits[:] = rows
+            results.delete(0, tk.END)
+            for message_id, conversation_id, title, role, content, created_at in hits:
+                date = datetime.fromtimestamp(created_at).strftime('%Y-%m-%d')
+                role_name = role_names.get(role, self.get_text("system"))
+                results.insert(tk.END, f"{date} [{title}] {role_name}: {make_snippet(content, query)}")
+            info_label.configure(text=self.get_text("search_results").format(count=len(hits), ms=elapsed) if query else "")
+            
+        def on_query_change(*args):
+            # 输入停顿后再搜索，避免每个按键都查询
+            if pending[0] is not None:
+                window.after_cancel(pending[0])
+            pending[0] = window.after(150, run_search)
+            
+        def jump(event=None):
+            selection = results.curselection()
+            if not selection and hits:
+                selection = (0,)
+            if selection:
+                message_id, conversation_id = hits[selection[0]][0], hits[selection[0]][1]
+                self.jump_to_message(conversation_id, message_id)
+                
+        query_var.trace_add("write", on_query_change)
+        entry.bind('<Return>', jump)
+        results.bind('<Double-Button-1>', jump)
+        results.bind('<Return>', jump)
+        window.bind('<Escape>', lambda e: window.destroy())
+        
+    def jump_to_message(self, conversation_id, message_id):
+        """切换到消息所在的对话并滚动到该消息"""
+        if conversation_id != self.conversation_id and self.pending_turns:
+            self.render.configure(self.status_label, text=self.get_text("wait_for_replies"))
+            return
+        if conversation_id != self.conversation_id or message_id not in self.message_rows:
+            self.load_conversation(conversation_id, message_id)  # 读完后滚动到该消息
+            return
+        index = self.message_rows[message_id]
+        self.chat_view.scroll_to(index)
+        self.chat_view.flash(index)
             
     def export_conversation(self):
-        """导出对话记录"""
-        if not self.conversation_history:
+        """导出对话记录：选择格式和范围后在后台逐条写入文件"""
+        if self.export_stop is not None:
+            messagebox.showinfo(self.get_text("export"), self.get_text("export_running"))
+            return
+        if self.store is None and not self.engine.history:
             messagebox.showinfo(self.get_text("export"), self.get_text("no_conversation"))
             return
             
+        window = tk.Toplevel(self.root)
+        window.title(self.get_text("export_title"))
+        window.resizable(False, False)
+        window.configure(bg='#f8f9fa')
+        window.transient(self.root)
+        window.grab_set()
+        
+        frame = ttk.Frame(window, padding="20")
+        frame.pack(fill=tk.BOTH, expand=True)
+        
+        format_var = tk.StringVar(value='markdown')
+        format_frame = ttk.LabelFrame(frame, text=self.get_text("export_format"), padding="10")
+        format_frame.pack(fill=tk.X, pady=(0, 10))
+        for key, exporter_class in EXPORT_FORMATS.items():
+            ttk.Radiobutton(format_frame, text=f"{exporter_class.label} ({exporter_class.extension})",
+                            variable=format_var, value=key).pack(anchor=tk.W)
+            
+        # 未启用存储时只能导出内存中的当前对话
+        scope_var = tk.StringVar(value='current')
+        scope_frame = ttk.LabelFrame(frame, text=self.get_text("export_scope"), padding="10")
+        scope_frame.pack(fill=tk.X, pady=(0, 10))
+        ttk.Radiobutton(scope_frame, text=self.get_text("export_current"), variable=scope_var, value='current',
+                        state='normal' if self.conversation_id is not None or self.store is None else 'disabled'
+                        ).pack(anchor=tk.W)
+        ttk.Radiobutton(scope_frame, text=self.get_text("export_all"), variable=scope_var, value='all',
+                        state='normal' if self.store is not None else 'disabled').pack(anchor=tk.W)
+        if self.store is not None and self.conversation_id is None:
+            scope_var.set('all')
+            
+        def start():
+            window.destroy()
+            self.start_export(EXPORT_FORMATS[format_var.get()], scope_var.get() == 'all')
+            
+        button_frame = ttk.Frame(frame)
+        button_frame.pack(fill=tk.X, pady=(10, 0))
+        ttk.Button(button_frame, text=self.get_text("export"), command=start).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(button_frame, text=self.get_text("cancel"), command=window.destroy).pack(side=tk.RIGHT)
+        window.bind('<Escape>', lambda e: window.destroy())
+        
+    def start_export(self, exporter_class, export_all):
+        """选择保存位置后交给工作线程导出"""
         filename = filedialog.asksaveasfilename(
-            defaultextension=".txt",
-            filetypes=[(self.get_text("text_file"), "*.txt"), (self.get_text("all_files"), "*.*")],
+            defaultextension=exporter_class.extension,
+            filetypes=[(exporter_class.label, "*" + exporter_class.extension), (self.get_text("all_files"), "*.*")],
             title=self.get_text("export_title")
         )
+        if not filename:
+            return
+        history = None
+        if self.store is None:
+            # 没有存储时导出内存中的历史（在界面线程中复制一份）
+            now = time.time()
+            history = ({"id": None, "title": self.get_text("conversation_header"), "created_at": now, "updated_at": now},
+                       [dict(message, created_at=None) for message in self.engine.history])
+        conversation_ids = None if export_all else [self.conversation_id]
+        self.export_stop = threading.Event()
+        self.render.configure(self.status_label, text=self.get_text("export_progress").format(percent=0))
+        self.workers.submit(self.run_export, filename, exporter_class, conversation_ids, history, self.export_stop)
         
-        if filename:
-            try:
-                with open(filename, 'w', encoding='utf-8') as f:
-                    f.write(self.get_text("conversation_header") + "\n")
-                    f.write("=" * 50 + "\n\n")
-                    
-                    for msg in self.conversation_history:
-                        role = self.get_text("user") if msg["role"] == "user" else self.get_text("assistant")
-                        f.write(f"{role}: {msg['content']}\n\n")
-                        
-                messagebox.showinfo(self.get_text("export"), self.get_text("export_success") + filename)
-                self.status_label.configure(text=self.get_text("export_success") + filename)
-            except Exception as e:
-                messagebox.showerror(self.get_text("export"), self.get_text("export_fail") + str(e))
+    def run_export(self, filename, exporter_class, conversation_ids, history, stop):
+        """在工作线程中导出，用单独的数据库连接分批读取消息"""
+        def progress(done, total):
+            self.ui.post(self.on_export_progress, done, total)
+            
+        try:
+            if history is not None:
+                count = export_conversations([history], filename, exporter_class, len(history[1]), progress, stop)
+            else:
+                self.store.flush()
+                conn = self.store.connect()
+                try:
+                    count = export_conversations(self.store.iter_conversations(conn, conversation_ids), filename,
+                                                 exporter_class, self.store.count_messages(conn, conversation_ids),
+                                                 progress, stop)
+                finally:
+                    conn.close()
+        except InterruptedError:
+            self.ui.post(self.on_export_done, filename, None, None)
+        except (OSError, sqlite3.Error) as e:
+            self.ui.post(self.on_export_done, filename, None, e)
+        else:
+            self.ui.post(self.on_export_done, filename, count, None)
+            
+    def on_export_progress(self, done, total):
+        """在状态栏显示导出进度"""
+        percent = done * 100 // total if total else 100
+        self.render.configure(self.status_label, text=self.get_text("export_progress").format(percent=percent))
+        
+    def on_export_done(self, filename, count, error):
+        """导出结束；count为None表示已取消或失败"""
+        self.export_stop = None
+        if error is not None:
+            self.render.configure(self.status_label, text=self.get_text("export_fail") + str(error))
+            messagebox.showerror(self.get_text("export"), self.get_text("export_fail") + str(error))
+        elif count is not None:
+            self.render.configure(self.status_label, text=self.get_text("export_success") + filename)
+        else:
+            self.render.configure(self.status_label, text=self.get_text("ready"))
                 
+    def import_conversations(self):
+        """导入对话记录：在后台边读边写入存储，完成后打开最后导入的对话"""
+        if self.store is None:
+            messagebox.showinfo(self.get_text("import"), self.get_text("import_unavailable"))
+            return
+        if self.import_stop is not None:
+            messagebox.showinfo(self.get_text("import"), self.get_text("import_running"))
+            return
+        filename = filedialog.askopenfilename(
+            filetypes=[(self.get_text("import_files"), " ".join("*" + ext for ext in IMPORT_FORMATS)),
+                       (self.get_text("all_files"), "*.*")],
+            title=self.get_text("import_title")
+        )
+        if not filename:
+            return
+        reader = IMPORT_FORMATS.get(os.path.splitext(filename)[1].lower(), iter_jsonl_import)
+        self.import_stop = threading.Event()
+        self.render.configure(self.status_label, text=self.get_text("import_progress").format(percent=0))
+        self.workers.submit(self.run_import, filename, reader, self.import_stop)
+        
+    def run_import(self, filename, reader, stop):
+        """在工作线程中导入，按文件读取位置报告进度"""
+        size = os.path.getsize(filename) or 1
+        title = os.path.splitext(os.path.basename(filename))[0]
+        imported = []
+        try:
+            conn = self.store.connect()
+            try:
+                with open(filename, 'rb') as f:
+                    progress = lambda: self.ui.post(self.on_import_progress, f.tell(), size)
+                    for conversation, messages in reader(f, title):
+                        conversation_id = self.store.insert_conversation(conn, conversation, messages,
+                                                                         progress=progress, stop=stop)
+                        if conversation_id is not None:
+                            imported.append(conversation_id)
+            finally:
+                conn.close()
+        except InterruptedError:
+            self.ui.post(self.on_import_done, imported, None)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.ui.post(self.on_import_done, imported, e)
+        else:
+            self.ui.post(self.on_import_done, imported, None)
+            
+    def on_import_progress(self, position, size):
+        """在状态栏显示导入进度"""
+        self.render.configure(self.status_label,
+                              text=self.get_text("import_progress").format(percent=position * 100 // size))
+        
+    def on_import_done(self, imported, error):
+        """导入结束：刷新对话列表，并打开最后导入的对话（只渲染最新的一页）"""
+        self.import_stop = None
+        if error is not None:
+            self.render.configure(self.status_label, text=self.get_text("import_fail") + str(error))
+            messagebox.showerror(self.get_text("import"), self.get_text("import_fail") + str(error))
+        elif not imported:
+            self.render.configure(self.status_label, text=self.get_text("import_empty"))
+        else:
+            self.render.configure(self.status_label, text=self.get_text("import_success").format(count=len(imported)))
+        if imported and not self.pending_turns:
+            self.load_conversation(imported[-1])
+        else:
+            self.refresh_conversation_list()
+            
     def open_settings(self):
         """打开设置窗口"""
         # 保存当前设置值
@@ -820,6 +5474,9 @@ class EasyChat:
             'api_key': self.api_key.get(),
             'api_url': self.api_url.get(),
             'model_name': self.model_name.get(),
+            'stream_responses': self.stream_responses.get(),
+            'parallel_requests': self.parallel_requests.get(),
+            'use_cache': self.use_cache.get(),
             'language': self.language.get(),
             'chat_font_size': self.chat_font_size.get(),
             'input_font_size': self.input_font_size.get()
@@ -858,6 +5515,18 @@ class EasyChat:
         model_entry = ttk.Entry(api_frame, textvariable=self.model_name, width=50)
         model_entry.grid(row=5, column=0, columnspan=2, sticky=tk.EW)
         
+        stream_check = ttk.Checkbutton(api_frame, text=self.get_text("stream_responses"), variable=self.stream_responses)
+        stream_check.grid(row=6, column=0, sticky=tk.W, pady=(10, 0))
+        
+        # 并发请求数为1时消息依次发送，大于1时互不依赖的消息同时发送
+        parallel_frame = ttk.Frame(api_frame)
+        parallel_frame.grid(row=7, column=0, sticky=tk.W, pady=(10, 0))
+        ttk.Label(parallel_frame, text=self.get_text("parallel_requests")).pack(side=tk.LEFT)
+        ttk.Spinbox(parallel_frame, from_=1, to=8, width=5, textvariable=self.parallel_requests).pack(side=tk.LEFT, padx=(5, 0))
+        
+        cache_check = ttk.Checkbutton(api_frame, text=self.get_text("use_cache"), variable=self.use_cache)
+        cache_check.grid(row=8, column=0, sticky=tk.W, pady=(10, 0))
+        
         api_frame.columnconfigure(0, weight=1)
 
         # 界面设置
@@ -915,6 +5584,9 @@ class EasyChat:
             self.api_key.set(original_settings['api_key'])
             self.api_url.set(original_settings['api_url'])
             self.model_name.set(original_settings['model_name'])
+            self.stream_responses.set(original_settings['stream_responses'])
+            self.parallel_requests.set(original_settings['parallel_requests'])
+            self.use_cache.set(original_settings['use_cache'])
             self.language.set(original_settings['language'])
             self.chat_font_size.set(original_settings['chat_font_size'])
             self.input_font_size.set(original_settings['input_font_size'])
@@ -930,43 +5602,37 @@ class EasyChat:
             messagebox.showerror(self.get_text("settings"), self.get_text("no_api_key"))
             return
             
+        # 在界面线程中读取设置窗口里尚未保存的地址、密钥和模型
+        api_url, api_key, model = self.api_url.get(), self.api_key.get(), self.model_name.get()
+        
         def test_api():
             try:
-                headers = {
-                    "Authorization": f"Bearer {self.api_key.get()}",
-                    "Content-Type": "application/json"
-                }
-                
-                data = {
-                    "model": self.model_name.get(),
-                    "messages": [{"role": "user", "content": "Hello"}],
-                    "max_tokens": 10
-                }
+                status_code = self.engine.probe(api_url, api_key, model)
+                # 配置了多个服务时同时检查其他服务
+                health = self.engine.check_health() if len(self.engine.router.endpoints) > 1 else {}
+                details = "".join(
+                    "\n" + self.get_text("endpoint_down" if EndpointRouter.is_outage(status) else "endpoint_ok").format(
+                        name=name, status=status)
+                    for name, status in health.items() if name != 'default')
                 
-                response = requests.post(
-                    self.api_url.get(),
-                    headers=headers,
-                    json=data,
-                    timeout=10
-                )
-                
-                if response.status_code == 200:
-                    self.root.after(0, lambda: messagebox.showinfo(self.get_text("test_connection"), 
-                                                                 self.get_text("connection_success")))
-                    self.root.after(0, lambda: self.connection_status.configure(
+                if status_code == 200:
+                    self.ui.post(lambda: messagebox.showinfo(self.get_text("test_connection"), 
+                                                             self.get_text("connection_success") + details))
+                    self.ui.post(lambda: self.render.configure(self.connection_status, 
                         text="● " + self.get_text("connected"), 
                         foreground='#28a745'))
                 else:
-                    self.root.after(0, lambda: messagebox.showerror(
+                    self.ui.post(lambda: messagebox.showerror(
                         self.get_text("test_connection"), 
-                        self.get_text("connection_fail") + str(response.status_code)))
+                        self.get_text("connection_fail") + str(status_code) + details))
                     
             except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror(
+                error = str(e)
+                self.ui.post(lambda: messagebox.showerror(
                     self.get_text("test_connection"), 
-                    self.get_text("connection_error") + str(e)))
+                    self.get_text("connection_error") + error))
                 
-        threading.Thread(target=test_api, daemon=True).start()
+        self.workers.submit(test_api)
         
     def save_settings(self, window):
         """保存设置"""
@@ -975,6 +5641,11 @@ class EasyChat:
         old_input_font_size = self.config.getint('Settings', 'input_font_size', fallback=11)
         
         self.save_config()
+        self.send_scheduler.set_max_in_flight(self.parallel_requests.get())
+        self.workers.resize(self.worker_count(self.engine.config))
+        self.update_cache_widgets()
+        if self.engine.config.cache_enabled and self.engine.response_cache is None:
+            self.workers.submit(self.open_response_cache)
         
         # 如果字体大小改变，应用新的字体设置
         if (old_chat_font_size != self.chat_font_size.get() or 
@@ -996,21 +5667,29 @@ class EasyChat:
 
     def apply_font_settings(self):
         """应用字体设置"""
-        # 更新对话框中所有消息的字体大小
-        for widget in self.message_frame.winfo_children():
-            if isinstance(widget, ttk.Frame):
-                for child in widget.winfo_children():
-                    if isinstance(child, tk.Frame):  # 消息气泡
-                        for text_widget in child.winfo_children():
-                            if isinstance(text_widget, tk.Text):
-                                text_widget.configure(font=('Microsoft YaHei UI', self.chat_font_size.get()))
-        
-        # 更新输入框字体大小
-        self.input_text.configure(font=('Microsoft YaHei UI', self.input_font_size.get()))
+        # 所有气泡和输入框引用同一个命名字体，改一次字号即可，之后按新字号重新测量排版
+        self.chat_font.configure(size=self.chat_font_size.get())
+        self.input_font.configure(size=self.input_font_size.get())
+        self.chat_view.font_changed()
 
     def on_closing(self):
         """窗口关闭事件"""
         self.save_config()
+        if self.export_stop is not None:
+            self.export_stop.set()  # 放弃未完成的导出，临时文件会被删除
+        if self.import_stop is not None:
+            self.import_stop.set()  # 放弃未完成的导入，已写入的部分会被删除
+        for cancel in self.active_requests.values():
+            cancel.set()  # 关闭进行中的请求，工作线程不必等到回复结束
+        self.closing = True
+        # 等打开存储、新建对话等已提交的任务完成，再执行它们交回的回调，把排队的轮次写入存储
+        self.workers.shutdown(timeout=5)
+        self.ui.stop()
+        self.ui.drain()
+        self.save_turns()
+        self.engine.close()
+        if self.store is not None:
+            self.store.close()
         self.root.destroy()
 
     def create_context_menu(self, widget):
@@ -1033,11 +5712,54 @@ class EasyChat:
             
         widget.bind("<Button-3>", show_menu)
 
+def iter_sse_data(lines):
+    """解析SSE事件流，逐个返回每个事件的data内容"""
+    data_lines = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line:
+            # 空行表示一个事件结束
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+            continue
+        if line.startswith(':'):
+            continue  # 注释/心跳行
+        field, _, value = line.partition(':')
+        if field == 'data':
+            data_lines.append(value[1:] if value.startswith(' ') else value)
+    if data_lines:
+        yield "\n".join(data_lines)
+
+def parse_args(argv=None):
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="EasyChat")
+    parser.add_argument('--batch', metavar='FILE',
+                        help="send the prompts in a JSONL file ('-' for stdin) without starting the GUI")
+    parser.add_argument('-o', '--output', default='batch_results.jsonl',
+                        help="JSONL file the results are appended to (default: batch_results.jsonl)")
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help="maximum requests in flight (default: 4)")
+    parser.add_argument('--model', help="model for prompts that do not name one (default: model in the config)")
+    parser.add_argument('--config', default='easychat_config.ini', help="configuration file")
+    parser.add_argument('--no-resume', action='store_true', help="do not skip ids already in the output file")
+    parser.add_argument('--startup-timeline', action='store_true',
+                        help="print how long each startup phase took to stderr once the window is ready")
+    return parser.parse_args(argv)
+
 def main():
-    """主函数"""
+    """主函数：默认启动界面，--batch 时以命令行批处理模式运行"""
+    args = parse_args()
+    if args.batch:
+        sys.exit(run_batch(args))
+    timeline = StartupTimeline(IMPORT_STARTED, sys.stderr if args.startup_timeline else None)
+    timeline.mark('imports', IMPORT_FINISHED)
     root = tk.Tk()
-    app = EasyChat(root)
+    timeline.mark('tk')
+    app = EasyChat(root, timeline)
     root.mainloop()
 
+IMPORT_FINISHED = time.perf_counter()  # 模块中的类和函数都已定义
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,178 @@
+"""对聊天接口做并发压测：通过 EasyChat 自己的请求路径发送，统计吞吐量、延迟百分位数和错误率
+
+默认在进程内启动 mock_server 并使用其行为参数；--url 指向其他服务时只做压测：
+
+    python benchmarks/load_test.py -n 500 -c 16 --latency lognormal:0.2,0.4 --tokens-per-sec 100 --drop-rate 0.01
+    python benchmarks/load_test.py -n 200 -c 8 --url http://127.0.0.1:8000/v1/chat/completions -o load.json
+    python benchmarks/load_test.py -n 240 -c 16 --paths batch --rpm 60 --client-limits --keys 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from EASYCHAT_V1 import ChatConfig, ChatEngine, BatchRunner, message_tokens, percentile
+from mock_server import MockServer, MockSettings
+
+PATHS = ('stream', 'plain', 'batch')
+
+def make_engine(args):
+    """创建与界面相同配置方式的聊天核心；客户端速率限制默认放开，只测服务端"""
+    config = ChatConfig.load(args.config) if args.config else ChatConfig()
+    config.api_url = args.url
+    config.api_key = config.api_key or 'mock-key'
+    for number in range(2, args.keys + 1):
+        # 同一地址上的其他密钥，每个密钥有自己的速率限制
+        config.endpoints.append({'name': f'key-{number}', 'url': args.url, 'key': f'{config.api_key}-{number}',
+                                 'weight': 1.0, 'models': [], 'model_map': {}, 'rpm': config.default_rpm,
+                                 'tpm': config.default_tpm, 'rate_limits': dict(config.rate_limits), 'retry': {}})
+    config.model = args.model or config.model
+    config.timeout = args.timeout
+    config.network['pool_size'] = max(args.concurrency, config.network['pool_size'])
+    if not args.client_limits:
+        config.default_rpm = config.default_tpm = 10 ** 9
+        config.rate_limits = {}
+    config.cache_enabled = False
+    if args.max_attempts is not None:
+        config.retry['max_attempts'] = args.max_attempts
+    if args.hedge:
+        config.retry['hedge'] = True
+    return ChatEngine(config)
+
+def prompt(number):
+    """第 number 个请求的消息"""
+    return [{"role": "user", "content": f"Load test request {number}: please reply with a few words."}]
+
+def summarize(path, samples, elapsed):
+    """把 [(延迟, 错误类型或None, 首字延迟或None, token数)] 汇总为统计结果"""
+    latencies = sorted(latency for latency, error, _, _ in samples if error is None)
+    ttfts = sorted(ttft for _, error, ttft, _ in samples if error is None and ttft is not None)
+    errors = Counter(error for _, error, _, _ in samples if error is not None)
+    tokens = sum(count for _, error, _, count in samples if error is None)
+    result = {
+        "path": path,
+        "requests": len(samples),
+        "ok": len(latencies),
+        "errors": dict(errors),
+        "error_rate": round(sum(errors.values()) / len(samples), 4) if samples else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_sec": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "tokens_per_sec": round(tokens / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        result[f"latency_{name}_ms"] = round(percentile(latencies, fraction) * 1000, 1)
+    if ttfts:
+        result["ttft_p50_ms"] = round(percentile(ttfts, 0.5) * 1000, 1)
+        result["ttft_p95_ms"] = round(percentile(ttfts, 0.95) * 1000, 1)
+    return result
+
+def describe_error(error):
+    """把 ChatError 归类为统计用的键"""
+    return f"{error.kind}:{error.status_code}" if error.status_code else error.kind
+
+def run_send_path(engine, stream, args):
+    """界面发送路径：ChatEngine.send，stream 为 True 时逐块接收；与界面和批处理一样先用 acquire 等待速率限制额度，
+    等待的时间计入延迟和 queue"""
+    def one(number):
+        messages = prompt(number)
+        start = time.perf_counter()
+        engine.acquire(engine.config.model, sum(message_tokens(m) for m in messages) + engine.config.max_tokens)
+        result = engine.send(messages, stream=stream, on_delta=lambda text: None, queued_at=start)
+        latency = time.perf_counter() - start
+        if not result.ok:
+            return latency, describe_error(result.error), None, 0
+        stats = result.stats or {}
+        return latency, None, stats.get("ttft"), stats.get("completion_tokens") or len(result.content.split())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        samples = list(pool.map(one, range(args.requests)))
+    return summarize('stream' if stream else 'plain', samples, time.perf_counter() - start)
+
+def run_batch_path(engine, args):
+    """批处理路径：BatchRunner（等待速率限制额度，429时重试）"""
+    output = io.StringIO()
+    runner = BatchRunner(engine, output, concurrency=args.concurrency)
+    start = time.perf_counter()
+    runner.run({"id": number, "messages": prompt(number)} for number in range(args.requests))
+    elapsed = time.perf_counter() - start
+    samples = []
+    for line in output.getvalue().splitlines():
+        record = json.loads(line)
+        error = record.get("error")
+        if error is not None:
+            error = error.split(':')[0] + (f":{record['status']}" if record.get("status") else "")
+        samples.append((record["latency"], error, None, len(record.get("response", "").split())))
+    return summarize('batch', samples, elapsed)
+
+def print_table(results):
+    """以表格形式打印结果"""
+    print(f"{'path':<8}{'ok/total':>12}{'err%':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ttft p50':>10}")
+    for result in results:
+        print(f"{result['path']:<8}{result['ok']:>6}/{result['requests']:<5}{result['error_rate'] * 100:>8.1f}"
+              f"{result['requests_per_sec']:>9.1f}{result['latency_p50_ms']:>9.1f}{result['latency_p95_ms']:>9.1f}"
+              f"{result['latency_p99_ms']:>9.1f}{result.get('ttft_p50_ms', float('nan')):>10.1f}")
+        if result['errors']:
+            print(f"{'':<8}errors: {result['errors']}")
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="Concurrent load test of EasyChat's request paths")
+    parser.add_argument('-n', '--requests', type=int, default=200, help="requests per path")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="requests in flight at once")
+    parser.add_argument('--paths', default=','.join(PATHS), help="comma-separated: " + ", ".join(PATHS))
+    parser.add_argument('--url', help="endpoint to test instead of the in-process mock server")
+    parser.add_argument('--config', help="easychat_config.ini to take the API key and network settings from")
+    parser.add_argument('--model', help="model name sent with each request")
+    parser.add_argument('--timeout', type=float, default=30, help="request timeout in seconds")
+    parser.add_argument('--client-limits', action='store_true', help="keep the configured client-side rate limits")
+    parser.add_argument('--max-attempts', type=int, help="requests per prompt including retries, 1 to disable retries")
+    parser.add_argument('--hedge', action='store_true', help="send a duplicate request when the first byte is late")
+    parser.add_argument('--keys', type=int, default=1, help="API keys to spread requests over (mock server limits --rpm per key)")
+    parser.add_argument('-o', '--output', help="write the results as JSON")
+    MockSettings.add_arguments(parser)
+    args = parser.parse_args()
+    args.paths = [path.strip() for path in args.paths.split(',') if path.strip()]
+    unknown = set(args.paths) - set(PATHS)
+    if unknown:
+        parser.error(f"unknown paths: {', '.join(sorted(unknown))}")
+    return args
+
+def main():
+    """主函数"""
+    args = parse_args()
+    server = None
+    if args.url is None:
+        server = MockServer(MockSettings.from_args(args))
+        args.url = server.start()
+    results = []
+    try:
+        for path in args.paths:
+            engine = make_engine(args)  # 每条路径使用新的连接池和速率限制状态
+            try:
+                if path == 'batch':
+                    results.append(run_batch_path(engine, args))
+                else:
+                    results.append(run_send_path(engine, path == 'stream', args))
+            finally:
+                engine.close()
+    finally:
+        if server is not None:
+            server.stop()
+    print_table(results)
+    if server is not None:
+        print(f"server outcomes: {dict(server.outcomes)}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"url": args.url, "requests": args.requests, "concurrency": args.concurrency,
+                       "results": results, "server": dict(server.outcomes) if server else None}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""本地的 OpenAI 兼容聊天接口，用于压测和延迟测试，不消耗真实的API额度
+
+支持可配置的延迟分布、按固定速率逐token输出的SSE流、带 Retry-After 的429、
+周期性的5xx错误和断开连接。把 easychat_config.ini 中的 url 指向打印出的地址即可：
+
+    python benchmarks/mock_server.py --port 8000 --latency lognormal:0.3,0.5 --tokens-per-sec 40 --rpm 120
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import socket
+import sys
+import threading
+import time
+from collections import deque, defaultdict, Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = ("the quick brown fox jumps over lazy dog while 模型 正在 生成 回复 and streaming tokens "
+         "arrive one by one so that latency can be measured").split()
+
+def parse_distribution(spec):
+    """解析延迟分布（0.2、uniform:0.1,0.5、normal:均值,标准差、lognormal:中位数,sigma、exp:均值），返回采样函数"""
+    kind, _, params = spec.partition(':')
+    if not params:
+        kind, params = 'fixed', kind
+    values = [float(value) for value in params.split(',')]
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(rng.gauss(values[0], values[1]), 0.0)
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    if kind == 'exp':
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"unknown latency distribution: {spec}")
+
+class MockSettings:
+    """模拟服务端的行为参数"""
+    def __init__(self, latency='0', tokens_per_sec=0.0, reply_tokens=30, rpm=0, rate_limit_rate=0.0,
+                 retry_after=1, burst_every=0, burst_length=0, burst_status=503, drop_rate=0.0, seed=None):
+        self.latency = parse_distribution(latency) if isinstance(latency, str) else latency  # 首字节之前的等待
+        self.tokens_per_sec = tokens_per_sec  # 0 表示不限速
+        self.reply_tokens = reply_tokens
+        self.rpm = rpm  # 每个API密钥每分钟的请求数上限，超出返回429；0 表示不限制
+        self.rate_limit_rate = rate_limit_rate  # 随机返回429的概率
+        self.retry_after = retry_after
+        self.burst_every = burst_every  # 每隔多少个请求出现一次5xx错误
+        self.burst_length = burst_length  # 每次连续出错的请求数
+        self.burst_status = burst_status
+        self.drop_rate = drop_rate  # 断开连接的概率（一半在响应前，一半在流式输出中途）
+        self.seed = seed
+
+    @classmethod
+    def add_arguments(cls, parser):
+        """把行为参数加到命令行解析器中"""
+        group = parser.add_argument_group("mock server behaviour")
+        group.add_argument('--latency', default='0', help="delay before the first byte, e.g. 0.2, uniform:0.1,0.5, "
+                                                          "normal:0.3,0.1, lognormal:0.3,0.5 or exp:0.3 (seconds)")
+        group.add_argument('--tokens-per-sec', type=float, default=0.0, help="streaming rate, 0 for no delay")
+        group.add_argument('--reply-tokens', type=int, default=30, help="tokens per reply")
+        group.add_argument('--rpm', type=int, default=0, help="requests per minute per API key before answering 429")
+        group.add_argument('--rate-limit-rate', type=float, default=0.0, help="probability of a random 429")
+        group.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with random 429s")
+        group.add_argument('--burst-every', type=int, default=0, help="start a 5xx burst every N requests")
+        group.add_argument('--burst-length', type=int, default=0, help="requests per 5xx burst")
+        group.add_argument('--burst-status', type=int, default=503, help="status code used for bursts")
+        group.add_argument('--drop-rate', type=float, default=0.0, help="probability of dropping the connection")
+        group.add_argument('--seed', type=int, help="random seed for reproducible runs")
+
+    @classmethod
+    def from_args(cls, args):
+        """从命令行参数创建"""
+        return cls(args.latency, args.tokens_per_sec, args.reply_tokens, args.rpm, args.rate_limit_rate,
+                   args.retry_after, args.burst_every, args.burst_length, args.burst_status, args.drop_rate, args.seed)
+
+class MockHandler(BaseHTTPRequestHandler):
+    """处理 /v1/chat/completions 请求"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.send_json(400, {"error": {"message": "invalid JSON body"}})
+            return
+        self.server.mock.handle(self, data)
+
+    def send_json(self, status, payload, headers=None):
+        """发送一个JSON响应"""
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, text):
+        """以 chunked 编码发送一段数据"""
+        data = text.encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def drop(self):
+        """不发送（剩余的）响应直接断开连接"""
+        self.close_connection = True
+        self.wfile.flush()
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+class MockHTTPServer(ThreadingHTTPServer):
+    """每个连接一个线程，监听队列足够长以承受高并发"""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭或重置空闲的长连接是正常情况，不打印异常
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class MockServer:
+    """在后台线程中运行的模拟服务端，outcomes 统计各种结果出现的次数"""
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        self.settings = settings or MockSettings()
+        self.rng = random.Random(self.settings.seed)
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.recent = defaultdict(deque)  # API密钥 -> 最近一分钟内被接受的请求时间
+        self.outcomes = Counter()
+        self.httpd = MockHTTPServer((host, port), MockHandler)
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def start(self):
+        """启动服务线程，返回接口地址"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        """停止服务"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def decide(self, key=''):
+        """决定这个请求的结果，返回 (结果, 随机数生成器, 附加信息)；速率限制按 key（Authorization 头）分别计算"""
+        settings = self.settings
+        with self.lock:
+            number = next(self.counter)
+            rng = random.Random(self.rng.random())  # 每个请求一个独立的生成器，避免线程间竞争
+            if settings.burst_every and number % settings.burst_every >= settings.burst_every - settings.burst_length:
+                return 'burst', rng, None
+            now = time.monotonic()
+            recent = self.recent[key]
+            while recent and now - recent[0] >= 60:
+                recent.popleft()
+            if settings.rpm and len(recent) >= settings.rpm:
+                return 'rate_limit', rng, max(math.ceil(recent[0] + 60 - now), 1)
+            if rng.random() < settings.rate_limit_rate:
+                return 'rate_limit', rng, settings.retry_after
+            recent.append(now)
+            remaining = settings.rpm - len(recent) if settings.rpm else None
+        if rng.random() < settings.drop_rate:
+            return ('drop' if rng.random() < 0.5 else 'drop_stream'), rng, remaining
+        return 'ok', rng, remaining
+
+    def rate_headers(self, remaining):
+        """与 OpenAI 相同格式的速率限制响应头"""
+        if not self.settings.rpm:
+            return {}
+        return {'x-ratelimit-limit-requests': str(self.settings.rpm),
+                'x-ratelimit-remaining-requests': str(max(remaining, 0)),
+                'x-ratelimit-reset-requests': '60s'}
+
+    def handle(self, handler, data):
+        """按设定的行为回应一个聊天请求"""
+        outcome, rng, extra = self.decide(handler.headers.get('Authorization', ''))
+        settings = self.settings
+        time.sleep(settings.latency(rng))
+        with self.lock:
+            self.outcomes[outcome] += 1
+        if outcome == 'burst':
+            handler.send_json(settings.burst_status, {"error": {"message": "mock server error burst",
+                                                               "type": "server_error"}})
+            return
+        if outcome == 'rate_limit':
+            handler.send_json(429, {"error": {"message": "mock rate limit", "type": "rate_limit_exceeded"}},
+                              dict(self.rate_headers(0), **{'Retry-After': str(extra)}))
+            return
+        if outcome == 'drop':
+            handler.drop()
+            return
+
+        tokens = max(min(settings.reply_tokens, data.get('max_tokens') or settings.reply_tokens), 1)
+        words = [rng.choice(WORDS) + " " for _ in range(tokens)]
+        interval = 1 / settings.tokens_per_sec if settings.tokens_per_sec > 0 else 0
+        usage = {"prompt_tokens": sum(len(str(m.get('content', ''))) // 4 + 1 for m in data.get('messages', [])),
+                 "completion_tokens": tokens}
+        usage["total_tokens"] = usage["prompt_tokens"] + tokens
+        model = data.get('model', 'mock-model')
+
+        if not data.get('stream'):
+            time.sleep(interval * tokens)
+            handler.send_json(200, {"id": "chatcmpl-mock", "object": "chat.completion", "model": model,
+                                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                                                 "finish_reason": "stop"}],
+                                    "usage": usage}, self.rate_headers(extra))
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        for name, value in self.rate_headers(extra).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        cut = rng.randrange(tokens) if outcome == 'drop_stream' else None
+        for index, word in enumerate(words):
+            if index == cut:
+                handler.drop()
+                return
+            event = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            handler.send_chunk("data: " + json.dumps(event, ensure_ascii=False) + "\n\n")
+            if interval:
+                time.sleep(interval)
+        if (data.get('stream_options') or {}).get('include_usage'):
+            handler.send_chunk("data: " + json.dumps({"choices": [], "usage": usage}) + "\n\n")
+        handler.send_chunk("data: [DONE]\n\n")
+        handler.wfile.write(b"0\r\n\r\n")
+
+def main():
+    """命令行入口：在前台运行模拟服务端，Ctrl+C 退出时打印各种结果的次数"""
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    MockSettings.add_arguments(parser)
+    args = parser.parse_args()
+    server = MockServer(MockSettings.from_args(args), args.host, args.port)
+    print(f"Mock chat completions endpoint: {server.url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(dict(server.outcomes))
+
+if __name__ == "__main__":
+    main()
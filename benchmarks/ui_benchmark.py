@@ -0,0 +1,296 @@
+"""EasyChat 界面性能基准
+
+在虚拟X服务器（Xvfb）中驱动真实的Tk窗口，测量消息追加、滚动、窗口缩放、字号调整、
+启动到首次绘制的耗时，以及内存占用和控件数量。结果写成JSON，便于在版本之间比较：
+
+    python benchmarks/ui_benchmark.py -o bench_new.json
+    python benchmarks/ui_benchmark.py -o bench_new.json --compare bench_old.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+SAMPLE_MESSAGES = (
+    "你好，请帮我总结一下这篇文章的要点。",
+    "Sure! Here is a short summary of the main points of the article you shared.",
+    "这是一段比较长的回复，用来测试自动换行。" * 12,
+    "def fibonacci(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a",
+    "Mixed 中英文 text with a_very_long_identifier_that_cannot_be_broken_anywhere_in_the_middle and more words after it.",
+)
+
+def start_xvfb():
+    """没有可用的显示时启动Xvfb并设置DISPLAY，返回Xvfb进程（不需要时返回None）"""
+    if os.environ.get('DISPLAY') or not sys.platform.startswith('linux'):
+        return None
+    if shutil.which('Xvfb') is None:
+        raise SystemExit("No DISPLAY and Xvfb is not installed (apt install xvfb)")
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd), '-screen', '0', '1280x1024x24', '-nolisten', 'tcp'],
+                               pass_fds=(write_fd,), stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    # Xvfb 准备好接受连接后才会写出显示编号
+    with os.fdopen(read_fd, 'rb') as f:
+        display = f.readline().strip().decode()
+    if not display:
+        process.kill()
+        raise SystemExit("Xvfb failed to start")
+    os.environ['DISPLAY'] = ':' + display
+    return process
+
+def summarize(samples):
+    """把一组耗时（秒）汇总为毫秒统计"""
+    from EASYCHAT_V1 import percentile
+    values = sorted(samples)
+    return {
+        "n": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+def rss_mb():
+    """当前进程的常驻内存（MB）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576, 1)
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1048576 if sys.platform == 'darwin' else 1024), 1)  # 拿不到当前值时退而用峰值
+
+def count_widgets(widget):
+    """递归统计控件数量"""
+    return 1 + sum(count_widgets(child) for child in widget.winfo_children())
+
+def settle(app, root):
+    """立即刷新合并中的界面更新并处理完所有事件"""
+    app.render.flush()
+    root.update()
+
+def timed(app, root, action):
+    """执行一次操作并等待界面处理完毕，返回耗时"""
+    start = time.perf_counter()
+    action()
+    app.render.flush()
+    root.update_idletasks()
+    return time.perf_counter() - start
+
+def startup_probe():
+    """在子进程中运行：测量导入、创建窗口和首次绘制的时间以及应用自己记录的启动时间线
+    （phase_*_ms 为各阶段完成时的累计时间），以JSON输出到stdout"""
+    start = time.perf_counter()
+    import tkinter as tk
+    import EASYCHAT_V1 as easychat
+    imported = time.perf_counter()
+    timeline = easychat.StartupTimeline(start)
+    timeline.mark('imports', imported)
+    root = tk.Tk()
+    timeline.mark('tk')
+    painted = []
+    root.bind('<Expose>', lambda event: painted or painted.append(time.perf_counter()), '+')
+    app = easychat.EasyChat(root, timeline)
+    created = time.perf_counter()
+    deadline = created + 10
+    while (not painted or not app.started) and time.perf_counter() < deadline:
+        root.update()
+    result = {
+        "import_ms": round((imported - start) * 1000, 1),
+        "window_ms": round((created - imported) * 1000, 1),
+        "first_paint_ms": round((painted[0] - start) * 1000, 1) if painted else None,
+        "first_paint_wall": time.time() - (time.perf_counter() - painted[0]) if painted else None,
+    }
+    for phase, at in timeline.marks:
+        result[f"phase_{phase.replace(' ', '_')}_ms"] = round((at - start) * 1000, 1)
+    print(json.dumps(result))
+    app.on_closing()
+
+def bench_startup(workdir, runs):
+    """多次启动新进程测量启动时间，launch_ms 包含解释器启动"""
+    samples = []
+    for _ in range(runs):
+        launched = time.time()
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--startup-probe'], cwd=workdir,
+                                capture_output=True, text=True, timeout=60, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        painted = result.pop("first_paint_wall")
+        result["launch_ms"] = round((painted - launched) * 1000, 1) if painted is not None else None
+        samples.append(result)
+    medians = {}
+    for key in samples[0]:
+        values = sorted(sample[key] for sample in samples if sample.get(key) is not None)
+        medians[key] = values[len(values) // 2] if values else None
+    return medians
+
+def bench_add_message(app, root, sizes, samples):
+    """在消息数达到各个规模时测量追加一条消息的延迟，同时记录内存和控件数量"""
+    results = {}
+    messages = 0
+    for size in sizes:
+        count = min(samples, size)
+        while messages < size - count:
+            app.chat_view.append("user" if messages % 2 == 0 else "assistant",
+                                 SAMPLE_MESSAGES[messages % len(SAMPLE_MESSAGES)])
+            messages += 1
+        settle(app, root)
+        times = []
+        for _ in range(count):
+            text = SAMPLE_MESSAGES[messages % len(SAMPLE_MESSAGES)]
+            sender = "user" if messages % 2 == 0 else "assistant"
+            times.append(timed(app, root, lambda: app.add_message(sender, text)))
+            messages += 1
+        settle(app, root)
+        result = summarize(times)
+        result.update(rss_mb=rss_mb(), widgets=count_widgets(root))
+        results[str(size)] = result
+    return results
+
+def bench_scroll(app, root, steps):
+    """逐行滚动和拖动滚动条（随机跳转）的响应时间"""
+    view = app.chat_view
+    view.yview('moveto', 0)
+    settle(app, root)
+    units = [timed(app, root, lambda: view.scroll_units(3)) for _ in range(steps)]
+    rng = random.Random(0)
+    jumps = [timed(app, root, lambda: view.yview('moveto', rng.random())) for _ in range(steps)]
+    view.scroll_to_bottom()
+    settle(app, root)
+    return {"units": summarize(units), "jump": summarize(jumps)}
+
+def bench_resize(app, root, steps):
+    """改变窗口宽度后重新排版的耗时"""
+    geometries = ("1280x900", "800x600", "1000x700")
+    times = []
+    for step in range(steps):
+        root.geometry(geometries[step % len(geometries)])
+        start = time.perf_counter()
+        root.update()  # 处理 <Configure> 事件和随后的空闲排版
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+def bench_font(app, root, steps):
+    """apply_font_settings 的耗时（包含重新测量所有消息）"""
+    sizes = (14, 9, 12, 11)
+    times = []
+    for step in range(steps):
+        app.chat_font_size.set(sizes[step % len(sizes)])
+        times.append(timed(app, root, app.apply_font_settings))
+    return summarize(times)
+
+def run(args):
+    """在临时目录中创建窗口并依次运行各项测量"""
+    import tkinter as tk
+    import EASYCHAT_V1 as easychat
+    workdir = tempfile.mkdtemp(prefix='easychat-bench-')
+    results = {
+        "meta": {
+            "version": git_version(),
+            "python": platform.python_version(),
+            "tk": tk.Tcl().call('info', 'patchlevel'),
+            "platform": platform.platform(),
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "sizes": args.sizes,
+        },
+        "startup": bench_startup(workdir, args.startup_runs),
+    }
+
+    cwd = os.getcwd()
+    os.chdir(workdir)  # 配置文件和数据库都写在临时目录中
+    try:
+        root = tk.Tk()
+        root.geometry("1000x700")
+        app = easychat.EasyChat(root)
+        settle(app, root)
+        results["idle"] = {"rss_mb": rss_mb(), "widgets": count_widgets(root)}
+        results["add_message"] = bench_add_message(app, root, args.sizes, args.samples)
+        results["scroll"] = bench_scroll(app, root, args.samples)
+        results["resize"] = bench_resize(app, root, args.samples)
+        results["font"] = bench_font(app, root, max(args.samples // 4, 4))
+        results["final"] = {"rss_mb": rss_mb(), "widgets": count_widgets(root)}
+        app.on_closing()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def git_version():
+    """当前代码的git版本，不在仓库中时返回None"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix=''):
+    """把嵌套的结果展开为 {"add_message.1000.p50_ms": 值}"""
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def compare(results, baseline_path, threshold):
+    """与之前的结果比较，打印变化超过阈值的指标，返回变差的指标数"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = flatten(json.load(f))
+    regressions = 0
+    for key, value in flatten(results).items():
+        old = baseline.get(key)
+        if not old or key.endswith('.n') or key.startswith('meta.'):
+            continue
+        change = (value - old) / old
+        if abs(change) >= threshold:
+            worse = change > 0  # 所有指标都是越小越好
+            regressions += worse
+            print(f"{'REGRESSION' if worse else 'improved  '} {key}: {old} -> {value} ({change:+.0%})")
+    return regressions
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="EasyChat UI performance benchmark")
+    parser.add_argument('-o', '--output', default='ui_benchmark.json', help="where to write the JSON results")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="message counts at which add_message is measured")
+    parser.add_argument('--samples', type=int, default=40, help="samples per measurement")
+    parser.add_argument('--startup-runs', type=int, default=5, help="number of cold starts to time")
+    parser.add_argument('--compare', metavar='BASELINE', help="earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.15, help="relative change reported by --compare")
+    parser.add_argument('--startup-probe', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.sizes = sorted(int(size) for size in args.sizes.split(','))
+    return args
+
+def main():
+    """主函数"""
+    args = parse_args()
+    if args.startup_probe:
+        startup_probe()
+        return
+    xvfb = start_xvfb()
+    try:
+        results = run(args)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+    if args.compare:
+        sys.exit(1 if compare(results, args.compare, args.threshold) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from EASYCHAT_V1 import ChatConfig, ChatEngine
+from mock_server import MockServer, MockSettings
+
+
+@pytest.fixture
+def mock_server():
+    """进程内的模拟服务端，用完后停止"""
+    server = MockServer(MockSettings(reply_tokens=5, seed=1))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_engine():
+    """测试用聊天核心的工厂：make_engine(url=None, **overrides)。默认使用测试密钥、放开的客户端速率限制和较短的超时；
+    overrides 覆盖 ChatConfig 的属性，值为字典的属性（如 retry、network）只更新给出的键。创建的引擎在测试结束后关闭"""
+    engines = []
+
+    def make(url=None, **overrides):
+        config = ChatConfig()
+        if url is not None:
+            config.api_url = url
+        config.api_key = 'test-key'
+        config.default_rpm = 1000
+        config.default_tpm = 10 ** 7
+        config.timeout = 5
+        for name, value in overrides.items():
+            if isinstance(getattr(config, name, None), dict) and isinstance(value, dict):
+                getattr(config, name).update(value)
+            else:
+                setattr(config, name, value)
+        engine = ChatEngine(config)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        engine.close()
@@ -0,0 +1,47 @@
+import io
+import json
+
+from EASYCHAT_V1 import BatchRunner, read_batch_items
+
+
+def test_batch_runner_against_mock_server(mock_server, make_engine):
+    engine = make_engine(mock_server.url)
+    output = io.StringIO()
+    lines = [json.dumps({"id": f"p{number}", "prompt": f"question {number}"}) for number in range(6)]
+    try:
+        stats = BatchRunner(engine, output, concurrency=3).run(read_batch_items(lines))
+    finally:
+        engine.close()
+
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert stats["completed"] == 6 and stats["failed"] == 0
+    assert sorted(result["id"] for result in results) == [f"p{number}" for number in range(6)]
+    assert all(result["response"] and "error" not in result for result in results)
+    assert sum(engine.router.endpoints[0].reserved.values()) == 0
+
+
+def test_read_batch_items_reports_bad_lines():
+    lines = ['{"prompt": "ok", "system": "be brief"}', '{not json', '', '[1, 2]', '{"id": "x", "model": "m"}',
+             '"plain prompt"']
+    items = list(read_batch_items(lines))
+    assert items[0]["id"] == 1 and items[0]["messages"][0] == {"role": "system", "content": "be brief"}
+    assert items[1]["id"] == 2 and items[1]["error"].startswith("invalid_json")
+    assert items[2] == {"id": 4, "error": "invalid_item: expected an object or a string"}
+    assert items[3] == {"id": "x", "error": "invalid_item: missing prompt or messages"}
+    assert items[4]["messages"] == [{"role": "user", "content": "plain prompt"}]
+
+
+def test_bad_lines_do_not_stop_the_batch(mock_server, make_engine):
+    engine = make_engine(mock_server.url)
+    output = io.StringIO()
+    lines = ['{"id": "a", "prompt": "first"}', 'not json at all', '{"id": "b"}', '{"id": "c", "prompt": "last"}']
+    try:
+        stats = BatchRunner(engine, output, concurrency=2).run(read_batch_items(lines))
+    finally:
+        engine.close()
+
+    results = {result["id"]: result for result in map(json.loads, output.getvalue().splitlines())}
+    assert stats["completed"] == 2 and stats["failed"] == 2
+    assert results["a"]["response"] and results["c"]["response"]
+    assert results[2]["error"].startswith("invalid_json") and set(results[2]) == {"id", "error"}
+    assert results["b"]["error"] == "invalid_item: missing prompt or messages"
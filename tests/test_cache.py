@@ -0,0 +1,69 @@
+import time
+
+from EASYCHAT_V1 import ResponseCache
+
+
+def test_make_key_ignores_transport_fields():
+    data = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0.7}
+    key = ResponseCache.make_key("url", data)
+    assert key == ResponseCache.make_key("url", dict(data, stream=True, stream_options={"include_usage": True}))
+    assert key != ResponseCache.make_key("url", dict(data, temperature=0.2))
+    assert key != ResponseCache.make_key("other-url", data)
+
+
+def test_get_put_and_peek(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"))
+    assert cache.get("a") is None
+    cache.put("a", "reply")
+    assert cache.peek("a") == "reply"
+    assert cache.get("a") == "reply"
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache.close()
+
+
+def test_reopen_preloads_recent_replies_into_memory(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(path)
+    for number in range(3):
+        cache.put(f"k{number}", f"reply {number}")
+    cache.close()
+
+    cache = ResponseCache(path, memory_entries=2)
+    assert list(cache.memory) == ["k1", "k2"]
+    assert cache.peek("k0") is None  # 只在磁盘上
+    assert cache.get("k0") == "reply 0"
+    cache.close()
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=60)
+    cache.put("a", "reply")
+    cache.memory["a"] = (time.time() - 120, "reply")
+    assert cache.peek("a") is None
+    assert cache.get("a") is None
+    cache.close()
+
+
+def test_trim_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_bytes=100)
+    cache.put("old", "x" * 40)
+    cache.put("new", "y" * 40)
+    cache.put("newest", "z" * 40)
+    assert "old" not in cache.memory
+    assert cache.get("old") is None
+    assert cache.get("newest") == "z" * 40
+    assert cache.disk_bytes <= 90
+    cache.close()
+
+
+def test_memory_only_lookup_does_not_open_the_database(tmp_path, make_engine):
+    engine = make_engine(cache_enabled=True, cache_file=str(tmp_path / "cache.db"))
+    messages = [{"role": "user", "content": "hi"}]
+
+    key, reply = engine.cache_lookup(messages, memory_only=True)
+    assert key is not None and reply is None
+    assert engine.response_cache is None
+
+    engine.get_response_cache().put(key, "cached reply")
+    assert engine.cache_lookup(messages, memory_only=True) == (key, "cached reply")
+    assert engine.cached_reply(key) == "cached reply"
@@ -0,0 +1,110 @@
+import threading
+
+from EASYCHAT_V1 import ContextWindow, estimate_tokens, message_tokens
+
+
+def conversation(turns, size=40):
+    messages = [{"role": "system", "content": "be helpful"}]
+    for number in range(turns):
+        messages.append({"role": "user", "content": f"question {number} " + "x" * size})
+        messages.append({"role": "assistant", "content": f"answer {number} " + "y" * size})
+    return messages
+
+
+def run_now(func):
+    func()
+
+
+def test_token_estimates():
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("你好世界") == 4
+    assert message_tokens({"role": "user", "content": "abcd"}) == 5
+
+
+def test_everything_fits_in_a_large_budget():
+    window = ContextWindow(default_budget=100000)
+    history = conversation(5)
+    messages, stats = window.build(history, "unknown-model")
+    assert messages == history
+    assert stats == {"turns": 5, "tokens": sum(map(message_tokens, history)), "compacted": 0, "dropped": 0}
+
+
+def test_budget_per_model():
+    window = ContextWindow(default_budget=100, budgets={"custom": 50})
+    assert window.budget_for("custom") == 50
+    assert window.budget_for("GPT-4") == ContextWindow.DEFAULT_BUDGETS["gpt-4"]
+    assert window.budget_for("other") == 100
+
+
+def test_old_turns_are_dropped_without_a_summarizer():
+    window = ContextWindow(default_budget=120, summary_tokens=0)
+    history = conversation(6)
+    messages, stats = window.build(history, "m")
+    assert messages[0] == history[0]
+    assert messages[-2:] == history[-2:]
+    assert stats["dropped"] > 0 and stats["turns"] + stats["dropped"] == 6
+    assert stats["tokens"] <= 120
+
+
+def test_latest_turn_is_kept_even_when_over_budget():
+    window = ContextWindow(default_budget=10)
+    history = conversation(2, size=400)
+    messages, stats = window.build(history, "m")
+    assert messages == [history[0]] + history[-2:]
+    assert stats["turns"] == 1
+
+
+def test_summary_replaces_older_turns_once_ready():
+    calls = []
+
+    def summarizer(messages, previous):
+        calls.append((len(messages), previous))
+        return "they talked about questions"
+
+    summaries = []
+    window = ContextWindow(default_budget=150, summary_tokens=30, summarizer=summarizer,
+                           on_summary=summaries.append, runner=run_now)
+    history = conversation(6)
+    window.build(history, "m")
+    assert len(calls) == 1 and calls[0][1] is None and summaries
+
+    messages, stats = window.build(history, "m")
+    assert messages[1]["content"] == ContextWindow.SUMMARY_PREFIX + "they talked about questions"
+    assert stats["compacted"] > 0 and stats["dropped"] == 0
+    assert messages[-2:] == history[-2:]
+    assert len(calls) == 1  # 同一段对话只生成一次摘要
+
+
+def test_summary_is_requested_once_while_pending():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def summarizer(messages, previous):
+        calls.append(True)
+        started.set()
+        release.wait(5)
+        return "summary"
+
+    window = ContextWindow(default_budget=120, summary_tokens=20, summarizer=summarizer)
+    history = conversation(6)
+    window.build(history, "m")
+    assert started.wait(5)
+    window.build(history, "m")
+    release.set()
+    assert len(calls) == 1
+
+
+def test_summarizer_errors_are_reported_and_retried(capfd):
+    attempts = []
+
+    def summarizer(messages, previous):
+        attempts.append(True)
+        raise RuntimeError("model unavailable")
+
+    window = ContextWindow(default_budget=120, summary_tokens=20, summarizer=summarizer, runner=run_now)
+    history = conversation(6)
+    window.build(history, "m")
+    window.build(history, "m")
+    assert len(attempts) == 2 and not window.pending
+    assert "Summary error" in capfd.readouterr().err
@@ -0,0 +1,90 @@
+import pytest
+
+from EASYCHAT_V1 import CancelToken
+from mock_server import MockSettings
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def engine(mock_server, make_engine):
+    return make_engine(mock_server.url, retry={'base_delay': 0.01})
+
+
+def send(engine, **options):
+    assert engine.acquire(engine.config.model, 100)
+    return engine.send(MESSAGES, **options)
+
+
+def assert_released(engine):
+    endpoint = engine.router.endpoints[0]
+    assert endpoint.in_flight == 0
+    assert sum(endpoint.reserved.values()) == 0
+
+
+def test_non_streaming_reply(engine):
+    result = send(engine, stream=False)
+    assert result.ok and not result.streamed
+    assert len(result.content.split()) == 5
+    assert result.stats["status"] == 200 and result.stats["completion_tokens"] == 5
+    assert result.stats["ttft"] is None and result.stats["total"] >= result.stats["ttfb"]
+    assert_released(engine)
+
+
+def test_streaming_reply_reports_deltas(engine):
+    started, deltas = [], []
+    result = send(engine, stream=True, on_start=lambda: started.append(True), on_delta=deltas.append)
+    assert result.ok and result.streamed
+    assert started == [True]
+    assert "".join(deltas) == result.content and len(deltas) == 5
+    assert result.stats["ttft"] is not None and result.stats["completion_tokens"] == 5
+    assert_released(engine)
+
+
+def test_connection_is_reused_between_requests(engine):
+    assert send(engine, stream=False).ok
+    second = send(engine, stream=True, on_delta=lambda text: None)
+    assert second.ok and second.stats["connect"] == 0.0
+
+
+def test_server_error_is_retried(engine, mock_server):
+    mock_server.settings = MockSettings(reply_tokens=3, burst_every=2, burst_length=1)
+    assert send(engine, stream=False).ok  # 第1个请求正常，第2个返回503
+    retries = []
+    result = send(engine, stream=False, on_retry=lambda attempt, wait, error: retries.append((attempt, error)))
+    assert result.ok and result.stats["attempt"] == 2
+    assert [(attempt, error.status_code) for attempt, error in retries] == [(1, 503)]
+    assert_released(engine)
+
+
+def test_long_retry_after_is_not_retried(engine, mock_server):
+    mock_server.settings = MockSettings(rate_limit_rate=1.0, retry_after=120)
+    result = send(engine, stream=False)
+    assert result.error.kind == 'rate_limit' and result.error.status_code == 429
+    assert result.error.retry_after == 120
+    assert_released(engine)
+
+
+def test_cancel_mid_stream_keeps_partial_reply(engine, mock_server):
+    mock_server.settings = MockSettings(reply_tokens=200, tokens_per_sec=50)
+    cancel = CancelToken()
+    deltas = []
+
+    def on_delta(text):
+        deltas.append(text)
+        if len(deltas) == 3:
+            cancel.set()
+
+    result = send(engine, stream=True, on_delta=on_delta, stop=cancel)
+    assert result.error.kind == 'cancelled'
+    assert result.content == "".join(deltas) and 3 <= len(deltas) < 200
+    assert_released(engine)
+
+
+def test_cached_reply_is_stored_after_a_send(engine, tmp_path):
+    engine.config.cache_enabled = True
+    engine.config.cache_file = str(tmp_path / "cache.db")
+    key, cached = engine.cache_lookup(MESSAGES)
+    assert cached is None
+    result = send(engine, stream=False, cache_key=key)
+    assert engine.cache_lookup(MESSAGES) == (key, result.content)
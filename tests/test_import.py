@@ -0,0 +1,102 @@
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from EASYCHAT_V1 import JsonStream, import_message, import_time, iter_json_import, iter_jsonl_import
+
+
+def collect(conversations):
+    return [(conversation, list(messages)) for conversation, messages in conversations]
+
+
+@pytest.mark.parametrize("value, expected", [
+    (1700000000, 1700000000.0),
+    (1700000000.5, 1700000000.5),
+    ("1700000000.25", 1700000000.25),
+    ("2024-05-01T12:00:00Z", datetime(2024, 5, 1, 12, tzinfo=timezone.utc).timestamp()),
+    ("2024-05-01T12:00:00+02:00", datetime(2024, 5, 1, 10, tzinfo=timezone.utc).timestamp()),
+])
+def test_import_time_accepts_numbers_and_iso_strings(value, expected):
+    assert import_time(value) == expected
+
+
+@pytest.mark.parametrize("value", [None, "", "yesterday", True, float("nan"), 1e300, 1700000000000000, [1], {}])
+def test_import_time_falls_back_to_default(value):
+    assert import_time(value, 42.0) == 42.0
+
+
+def test_import_message_normalizes_created_at():
+    message = import_message({"role": "user", "content": "hi", "created_at": "2024-05-01T12:00:00Z"})
+    assert message["created_at"] == datetime(2024, 5, 1, 12, tzinfo=timezone.utc).timestamp()
+    message = import_message({"role": "user", "content": "hi", "created_at": "not a date"}, default_time=123.0)
+    assert message["created_at"] == 123.0
+    message = import_message({"role": "user", "content": "hi", "create_time": "1700000000"})
+    assert message["created_at"] == 1700000000.0
+    datetime.fromtimestamp(import_message({"role": "user", "content": "hi", "created_at": [1]})["created_at"])
+
+
+def test_import_message_shapes():
+    chatgpt = {"author": {"role": "assistant"}, "content": {"content_type": "text", "parts": ["a", "b"]},
+               "metadata": {"model_slug": "gpt-4"}}
+    assert import_message(chatgpt)["content"] == "a\nb"
+    assert import_message(chatgpt)["model"] == "gpt-4"
+    parts = {"role": "user", "content": [{"type": "text", "text": "x"}, "y"]}
+    assert import_message(parts)["content"] == "x\ny"
+    assert import_message({"role": "tool", "content": "ignored"}) is None
+    assert import_message({"role": "user", "content": ""}) is None
+
+
+def test_json_stream_reads_across_chunk_boundaries(monkeypatch):
+    monkeypatch.setattr(JsonStream, "CHUNK_SIZE", 7)
+    values = [{"n": number, "text": "数据" * number} for number in range(20)] + [12345678901, "end"]
+    stream = JsonStream(io.BytesIO(json.dumps(values, ensure_ascii=False).encode("utf-8")))
+    assert list(stream.items()) == values
+
+
+def test_json_stream_members():
+    stream = JsonStream(io.BytesIO(b'{"title": "t", "messages": [1, 2], "extra": null}'))
+    seen = {}
+    for key in stream.members():
+        seen[key] = list(stream.items()) if key == "messages" else stream.value()
+    assert seen == {"title": "t", "messages": [1, 2], "extra": None}
+
+
+def test_json_import_chatgpt_export_with_iso_times():
+    export = [{
+        "title": "exported",
+        "create_time": "2024-05-01T12:00:00Z",
+        "current_node": "b",
+        "mapping": {
+            "a": {"message": {"author": {"role": "user"}, "content": {"parts": ["question"]},
+                              "create_time": "1714564800"}, "parent": None},
+            "b": {"message": {"author": {"role": "assistant"}, "content": {"parts": ["answer"]},
+                              "create_time": "garbage"}, "parent": "a"},
+        },
+    }]
+    [(conversation, messages)] = collect(iter_json_import(io.BytesIO(json.dumps(export).encode()), "default"))
+    assert conversation == {"title": "exported", "created_at": 1714564800.0}
+    assert [message["content"] for message in messages] == ["question", "answer"]
+    assert messages[1]["created_at"] == conversation["created_at"]
+
+
+def test_json_import_streams_messages_object():
+    data = {"title": "t", "created_at": 1700000000, "messages": [{"role": "user", "content": "hi"},
+                                                                 {"role": "assistant", "content": "hello"}]}
+    [(conversation, messages)] = collect(iter_json_import(io.BytesIO(json.dumps(data).encode()), "default"))
+    assert conversation["created_at"] == 1700000000.0
+    assert [message["role"] for message in messages] == ["user", "assistant"]
+
+
+def test_jsonl_import_groups_by_conversation():
+    lines = [
+        {"conversation_id": 1, "conversation_title": "one", "role": "user", "content": "a", "created_at": 1.7e9},
+        {"conversation_id": 1, "conversation_title": "one", "role": "assistant", "content": "b"},
+        {"conversation_id": 2, "conversation_title": "two", "role": "user", "content": "c", "created_at": "bad"},
+    ]
+    text = io.StringIO("\n".join(json.dumps(line) for line in lines) + "\n\n")
+    conversations = collect(iter_jsonl_import(text, "default"))
+    assert [conversation["title"] for conversation, _ in conversations] == ["one", "two"]
+    assert [message["content"] for message in conversations[0][1]] == ["a", "b"]
+    assert isinstance(conversations[1][1][0]["created_at"], float)
@@ -0,0 +1,39 @@
+import sys
+
+import pytest
+
+import load_test
+
+
+def parse(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['load_test.py', *argv])
+    return load_test.parse_args()
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_client_limits_slow_the_send_paths(monkeypatch, mock_server, stream):
+    args = parse(monkeypatch, '-n', '5', '-c', '5', '--client-limits')
+    args.url = mock_server.url
+    engine = load_test.make_engine(args)
+    limiter = engine.router.endpoints[0].limiter
+    limiter.default_rpm = 600  # 每0.1秒一个请求
+    limiter.get_buckets(engine.config.model)[0].tokens = 0
+    try:
+        result = load_test.run_send_path(engine, stream, args)
+    finally:
+        engine.close()
+    assert result["ok"] == 5
+    assert result["elapsed_s"] >= 0.4
+    endpoint = engine.router.endpoints[0]
+    assert endpoint.in_flight == 0 and sum(endpoint.reserved.values()) == 0
+
+
+def test_send_paths_are_unthrottled_without_client_limits(monkeypatch, mock_server):
+    args = parse(monkeypatch, '-n', '20', '-c', '4')
+    args.url = mock_server.url
+    engine = load_test.make_engine(args)
+    try:
+        result = load_test.run_send_path(engine, False, args)
+    finally:
+        engine.close()
+    assert result["ok"] == 20 and result["elapsed_s"] < 5
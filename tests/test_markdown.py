@@ -0,0 +1,130 @@
+import queue
+
+from EASYCHAT_V1 import HIGHLIGHT_LANGUAGES, MarkdownRenderer, WorkerPool, highlight_code
+
+
+class Posted:
+    """代替 UiDispatcher：记录工作线程交回的回调，由测试在当前线程中执行"""
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def post(self, func, *args):
+        self.queue.put((func, args))
+
+    def run_one(self, timeout=5):
+        func, args = self.queue.get(timeout=timeout)
+        func(*args)
+
+
+def make_renderer():
+    posted = Posted()
+    pool = WorkerPool(1)
+    return MarkdownRenderer(posted.post, pool), posted, pool
+
+
+def test_inline_and_block_markup():
+    renderer, _, pool = make_renderer()
+    rendered = renderer.render("# Title\n\nSome **bold** and `code`.\n\n- item\n")
+    assert rendered.text == "Title\n\nSome bold and code.\n\n• item\n"
+    tags = {(rendered.text[start:end], tag) for start, end, tag in rendered.runs}
+    assert {("Title", "heading"), ("bold", "bold"), ("code", "code")} <= tags
+    assert renderer.render("# Title\n\nSome **bold** and `code`.\n\n- item\n") is rendered
+    pool.shutdown(timeout=5)
+
+
+def test_code_blocks_are_highlighted_on_the_shared_pool():
+    renderer, posted, pool = make_renderer()
+    highlighted = []
+    renderer.on_highlight = lambda: highlighted.append(True)
+    rendered = renderer.render("```python\ndef f():\n    return 1\n```\n")
+    assert rendered.code == [(0, "python", "def f():\n    return 1\n", True)]
+    assert renderer.cached_highlight("python", "def f():\n    return 1\n") is None
+
+    posted.run_one()
+    runs = renderer.cached_highlight("python", "def f():\n    return 1\n")
+    assert ("def", "hl_keyword") in {("def f():\n    return 1\n"[start:end], tag) for start, end, tag in runs}
+    assert highlighted and renderer.workers is pool
+    pool.shutdown(timeout=5)
+
+
+def test_open_code_block_is_not_highlighted_while_streaming():
+    renderer, posted, pool = make_renderer()
+    renderer.render("```python\nx = 1\n", partial=True)
+    assert not renderer.pending
+    renderer.render("```python\nx = 1\n```\n", partial=True)
+    assert renderer.pending
+    posted.run_one()
+    pool.shutdown(timeout=5)
+
+
+STREAMED = ("# Plan\n\nFirst a paragraph with **bold** text\nthat spans lines.\n\n"
+            "| a | b |\n|---|---|\n| 1 | 22 |\n\n```python\nfor i in range(3):\n    print(i)\n```\n"
+            "- one\n- two\n\n> quoted `code`\n\nDone.")
+
+
+def fields(rendered):
+    return rendered.text, rendered.runs, rendered.fonts, rendered.code, rendered.tail
+
+
+def test_streaming_matches_full_render_at_every_step():
+    renderer, _, pool = make_renderer()
+    full = MarkdownRenderer(lambda *args: None, pool)
+    for end in range(1, len(STREAMED) + 1):
+        text = STREAMED[:end]
+        assert fields(renderer.render(text, partial=True)) == fields(full.render_blocks(full.split_blocks(text)))
+    pool.shutdown(timeout=5)
+
+
+def test_streaming_only_splits_text_after_finished_blocks():
+    renderer, _, pool = make_renderer()
+    split = []
+    original = renderer.split_blocks
+    renderer.split_blocks = lambda text: split.append(text) or original(text)
+    text = ""
+    for chunk in STREAMED.split(" "):
+        text += chunk + " "
+        renderer.render(text, partial=True)
+    end, done = renderer.streams[text]
+    assert split[-1] == "> quoted `code`\n\nDone. "  # 上一次刷新时引用是最后一块
+    assert text[end:] == "Done. "
+    assert done.text.startswith("Plan\n") and done.text.endswith("▎ quoted code\n\n")
+
+    renderer.render(text)
+    assert text not in renderer.streams
+    pool.shutdown(timeout=5)
+
+
+def test_interleaved_streams_keep_separate_state():
+    renderer, _, pool = make_renderer()
+    first, second = "para one\n\n", "other\n\n"
+    for extra in ("a", "ab", "abc"):
+        assert renderer.render(first + extra, partial=True).text == "para one\n\n" + extra
+        assert renderer.render(second + extra, partial=True).text == "other\n\n" + extra
+    assert len(renderer.streams) == 2
+    pool.shutdown(timeout=5)
+
+
+def highlighted(code, language, tag):
+    return [code[start:end] for start, end, found in highlight_code(code, language) if found == tag]
+
+
+def test_highlight_languages_use_their_own_rules():
+    assert {language: HIGHLIGHT_LANGUAGES[language] for language in ('ruby', 'rb', 'lua', 'yaml', 'yml', 'toml',
+                                                                      'ini', 'sql', 'sh', 'py')} == {
+        'ruby': 'ruby', 'rb': 'ruby', 'lua': 'lua', 'yaml': 'data', 'yml': 'data', 'toml': 'data', 'ini': 'data',
+        'sql': 'sql', 'sh': 'shell', 'py': 'python'}
+
+    lua = "local function count(from)\n  -- select sum\n  return from\nend\n"
+    assert highlighted(lua, 'lua', 'hl_keyword') == ['local', 'function', 'return', 'end']
+    assert highlighted(lua, 'lua', 'hl_comment') == ['-- select sum']
+    assert highlighted("LOCAL x", 'lua', 'hl_keyword') == []  # 不区分大小写的只有SQL
+
+    ruby = "def greet(name)\n  puts \"hi\" unless name.empty? # lambda\nend\n"
+    assert highlighted(ruby, 'rb', 'hl_keyword') == ['def', 'puts', 'unless', 'end']
+    assert highlighted(ruby, 'rb', 'hl_comment') == ['# lambda']
+
+    yaml = "if: do\nin: echo  # note\nport: 8080\nname: 'x'\n"
+    assert [tag for _, _, tag in highlight_code(yaml, 'yaml')] == ['hl_comment', 'hl_number', 'hl_string']
+    ini = "[section]\n; comment\nkey = value ; not a comment\n"
+    assert highlighted(ini, 'ini', 'hl_comment') == ['; comment']
+    assert all(end > start for start, end, _ in highlight_code(ini, 'toml'))
@@ -0,0 +1,88 @@
+import pytest
+
+from EASYCHAT_V1 import RateLimiter, TokenBucket, parse_reset_time, parse_retry_after
+
+
+def test_bucket_refills_at_a_steady_rate():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0.0
+    bucket.consume(60, now)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, now + 1.0) == 0.0
+    bucket.refill(now + 1000)
+    assert bucket.tokens == 60
+
+
+def test_requests_larger_than_capacity_pass_when_full():
+    bucket = TokenBucket(10)
+    now = bucket.updated
+    assert bucket.wait_time(50, now) == 0.0
+    bucket.consume(50, now)
+    assert bucket.tokens == 0
+
+
+def test_capacity_sync_and_block():
+    bucket = TokenBucket(100)
+    now = bucket.updated
+    bucket.set_capacity(10)
+    assert (bucket.capacity, bucket.tokens) == (10, 10)
+    bucket.sync(0, 5.0, now)
+    assert bucket.wait_time(1, now) == pytest.approx(5.0)
+    bucket.block(8.0, now)
+    assert bucket.wait_time(1, now + 1) == pytest.approx(7.0)
+
+
+def test_limiter_reserves_per_model():
+    limiter = RateLimiter(default_rpm=2, default_tpm=1000, limits={"big": (1, 100)})
+    assert limiter.reserve("m", 100) == 0.0
+    assert limiter.reserve("m", 100) == 0.0
+    assert limiter.reserve("m", 100) > 0
+    assert limiter.reserve("big", 50) == 0.0
+    assert limiter.reserve("big", 50) > 0
+    assert limiter.reserve("other", 1000) == 0.0
+    assert limiter.reserve("other", 1) > 0  # token 桶已空
+
+
+def test_failed_reservation_consumes_nothing():
+    limiter = RateLimiter(default_rpm=10, default_tpm=100)
+    assert limiter.reserve("m", 100) == 0.0
+    requests_bucket, _ = limiter.get_buckets("m")
+    before = requests_bucket.tokens
+    assert limiter.reserve("m", 50) > 0
+    assert requests_bucket.tokens == pytest.approx(before, abs=0.01)
+
+
+def test_limiter_learns_from_headers():
+    limiter = RateLimiter(default_rpm=3, default_tpm=40000)
+    limiter.update_from_headers("m", {
+        "x-ratelimit-limit-requests": "500", "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "2s", "x-ratelimit-limit-tokens": "not a number",
+    })
+    requests_bucket, tokens_bucket = limiter.get_buckets("m")
+    assert requests_bucket.capacity == 500 and tokens_bucket.capacity == 40000
+    assert 1.5 < limiter.reserve("m", 1) <= 2.0
+
+    limiter.update_from_headers("n", {"Retry-After": "30"})
+    assert limiter.reserve("n", 1) == pytest.approx(30, abs=0.5)
+
+
+@pytest.mark.parametrize("value, seconds", [("1s", 1), ("6m0s", 360), ("20ms", 0.02), ("1.5", 1.5), ("", None),
+                                            ("soon", None)])
+def test_parse_reset_time(value, seconds):
+    assert parse_reset_time(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("12") == 12.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0  # 已过去的时间
+    assert parse_retry_after("later") is None
+
+
+def test_refill_ignores_times_before_the_last_update():
+    bucket = TokenBucket(100)
+    bucket.refill(bucket.updated - 1.0)
+    assert bucket.tokens == 100
+    assert bucket.wait_time(100, bucket.updated - 1.0) == 0.0
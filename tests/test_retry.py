@@ -0,0 +1,51 @@
+from EASYCHAT_V1 import ChatError, RequestMetrics, RetryPolicy
+from mock_server import MockSettings
+
+
+def test_retryable_errors():
+    policy = RetryPolicy(max_retry_after=30)
+    assert policy.retryable(ChatError('timeout'))
+    assert policy.retryable(ChatError('connection'))
+    assert policy.retryable(ChatError('status', status_code=503))
+    assert policy.retryable(ChatError('rate_limit', status_code=429, retry_after=10))
+    assert not policy.retryable(ChatError('rate_limit', status_code=429, retry_after=120))
+    assert not policy.retryable(ChatError('status', status_code=400))
+    assert not policy.retryable(ChatError('cancelled'))
+
+
+def test_delay_backs_off_and_respects_retry_after():
+    policy = RetryPolicy(max_attempts=4, base_delay=1.0, max_delay=3.0)
+    policy.rng.seed(0)
+    for attempt, cap in ((1, 1.0), (2, 2.0), (3, 3.0)):
+        assert 0 <= policy.delay(attempt, ChatError('timeout')) <= cap
+    assert policy.delay(4, ChatError('timeout')) is None
+    assert policy.delay(1, ChatError('rate_limit', retry_after=5.0)) >= 5.0
+
+
+def test_hedge_delay_needs_enough_samples():
+    metrics = RequestMetrics()
+    policy = RetryPolicy(hedge=True, hedge_percentile=0.5, hedge_min_samples=3, hedge_min_delay=0.1)
+    assert RetryPolicy().hedge_delay(metrics) is None
+    for ttfb in (0.2, 0.4):
+        metrics.record({"model": "m", "status": 200, "ttfb": ttfb})
+    assert policy.hedge_delay(metrics, model="m") is None
+    metrics.record({"model": "m", "status": 200, "ttfb": 0.6})
+    assert policy.hedge_delay(metrics, model="m") == 0.4
+
+
+def test_hedged_request_runs_on_the_engine_pool(mock_server, make_engine):
+    mock_server.settings = MockSettings(latency='0.2', reply_tokens=3)
+    engine = make_engine(mock_server.url, network={'pool_size': 2})
+    config = engine.config
+    endpoint = engine.router.endpoints[0]
+    timing = {"hedged": False}
+    try:
+        response, winner = engine.open_response(endpoint, engine.build_request([{"role": "user", "content": "hi"}]),
+                                                config.model, False, 10, 0.05, timing, 0.0)
+        assert response.status_code == 200
+        response.close()
+        assert timing["hedged"] and winner is endpoint
+        assert engine.attempt_pool is not None and engine.attempt_pool.size == 2
+    finally:
+        engine.close()
+    assert engine.attempt_pool is None
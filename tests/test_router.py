@@ -0,0 +1,85 @@
+from collections import Counter
+
+from EASYCHAT_V1 import CancelToken, Endpoint, EndpointRouter, RateLimiter
+
+
+def test_cancel_before_send_releases_reservation(make_engine):
+    engine = make_engine()
+    endpoint = engine.router.endpoints[0]
+    assert engine.acquire('gpt-3.5-turbo', 10)
+    assert endpoint.reserved == {'gpt-3.5-turbo': 1}
+
+    cancel = CancelToken()
+    cancel.set()
+    result = engine.send([{"role": "user", "content": "hi"}], 'gpt-3.5-turbo', stop=cancel)
+
+    assert result.error.kind == 'cancelled'
+    assert not endpoint.reserved
+    assert endpoint.in_flight == 0
+
+
+def make_router(*weights, rpm=100):
+    endpoints = [Endpoint(f"e{number}", f"http://e{number}", "key", weight=weight,
+                          limiter=RateLimiter(default_rpm=rpm, default_tpm=10 ** 6))
+                 for number, weight in enumerate(weights)]
+    return EndpointRouter(endpoints, failure_threshold=2), endpoints
+
+
+def test_reserve_then_acquire_uses_the_reserving_endpoint():
+    router, (first, second) = make_router(1, 1)
+    first.in_flight = 1
+    assert router.reserve("m", 10) == 0.0
+    assert second.reserved == {"m": 1}
+    assert router.acquire("m") is second
+    assert second.reserved["m"] == 0 and second.in_flight == 1
+    router.release("e1", 200)
+    assert second.in_flight == 0
+
+
+def test_reserve_waits_when_every_endpoint_is_out_of_quota():
+    router, endpoints = make_router(1, 1, rpm=1)
+    assert router.reserve("m", 10) == 0.0
+    assert router.reserve("m", 10) == 0.0
+    assert router.reserve("m", 10) > 0
+    assert [sum(endpoint.reserved.values()) for endpoint in endpoints] == [1, 1]
+
+
+def test_acquire_spreads_by_weight():
+    router, (light, heavy) = make_router(1, 3)
+    picked = Counter()
+    for _ in range(8):
+        endpoint = router.acquire("m")
+        picked[endpoint.name] += 1
+        router.release(endpoint.name, 200)
+    assert picked == {"e0": 2, "e1": 6}
+
+
+def test_cancel_reservation_releases_the_slot():
+    router, (first, second) = make_router(1, 1)
+    assert router.reserve("m", 10) == 0.0
+    router.cancel_reservation("m")
+    assert not first.reserved and not second.reserved
+    router.cancel_reservation("m")  # 没有预留时什么也不做
+    assert router.load(first) == router.load(second) == (0.0, 0.0)
+
+
+def test_outages_mark_endpoint_unhealthy_until_success():
+    router, (first, second) = make_router(1, 1)
+    for status in ("timeout", 503):
+        router.acquire("m", avoid=second)
+        router.release("e0", status)
+    assert not first.healthy
+    assert router.candidates("m") == [second]
+    router.mark_probe(first, 200)
+    assert first.healthy and first.failures == 0
+    router.release("e0", 400)  # 客户端错误不影响健康状态
+    assert first.healthy and first.failures == 0
+
+
+def test_models_restrict_candidates():
+    router, (general, special) = make_router(1, 1)
+    special.models = {"special"}
+    special.model_map = {"special": "upstream-special"}
+    assert router.candidates("m") == [general]
+    assert set(router.candidates("special")) == {general, special}
+    assert special.upstream_model("special") == "upstream-special"
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from EASYCHAT_V1 import ConversationStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConversationStore(str(tmp_path / "history.db"))
+    yield store
+    store.close()
+
+
+def test_append_flush_and_pages(store):
+    conversation_id = store.create_conversation("first")
+    for number in range(5):
+        store.append_message(conversation_id, "user", f"message {number}", created_at=1000.0 + number)
+    store.flush()
+
+    page = store.load_page(conversation_id, limit=2)
+    assert [row[2] for row in page] == ["message 3", "message 4"]
+    older = store.load_page(conversation_id, before_id=page[0][0], limit=2)
+    assert [row[2] for row in older] == ["message 1", "message 2"]
+
+    first_id = store.page_start(conversation_id, page[0][0], before=1)
+    assert [row[2] for row in store.load_from(conversation_id, first_id)] == \
+        ["message 2", "message 3", "message 4"]
+    assert store.list_conversations()[0] == (conversation_id, "first", 1004.0)
+
+
+def test_list_orders_by_last_update(store):
+    old = store.create_conversation("old")
+    new = store.create_conversation("new")
+    store.append_message(old, "user", "later", created_at=4102444800.0)
+    store.flush()
+    assert [row[0] for row in store.list_conversations()] == [old, new]
+
+
+def test_search_matches_english_and_chinese(store):
+    if not store.fts_enabled:
+        pytest.skip("SQLite without FTS5")
+    conversation_id = store.create_conversation("search")
+    store.append_message(conversation_id, "user", "How do I reverse a list in Python?")
+    store.append_message(conversation_id, "assistant", "今天天气很好，适合出去散步")
+    store.flush()
+
+    assert [row[4] for row in store.search("python")] == ["How do I reverse a list in Python?"]
+    hits = store.search("天气")
+    assert len(hits) == 1 and hits[0][1:3] == (conversation_id, "search")
+    assert store.search("散步 天气")[0][4] == "今天天气很好，适合出去散步"
+    assert store.search("下雨") == []
+    assert store.search("   ") == []
+
+
+def test_reads_from_worker_threads_use_their_own_connection(store):
+    conversation_id = store.create_conversation("threads")
+    store.append_message(conversation_id, "user", "hi")
+    store.flush()
+    results = []
+
+    def read():
+        results.append((store.reader(), store.load_page(conversation_id)))
+
+    worker = threading.Thread(target=read)
+    worker.start()
+    worker.join()
+    conn, rows = results[0]
+    assert conn is not store.reader()
+    assert [row[2] for row in rows] == ["hi"]
+    assert len(store.connections) == 2
+
+
+def test_insert_conversation_is_searchable(store):
+    conn = store.connect()
+    messages = [{"role": "user", "content": f"imported {number}", "created_at": 1000.0 + number}
+                for number in range(3)]
+    conversation_id = store.insert_conversation(conn, {"title": "imported"}, messages, chunk=2)
+    conn.close()
+
+    assert [row[2] for row in store.load_page(conversation_id)] == ["imported 0", "imported 1", "imported 2"]
+    if store.fts_enabled:
+        assert len(store.search("imported")) == 3
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from EASYCHAT_V1 import WorkerPool
+
+
+def test_shutdown_waits_for_submitted_tasks():
+    pool = WorkerPool(2)
+    done = []
+    for number in range(4):
+        pool.submit(lambda number=number: (time.sleep(0.05), done.append(number)))
+    pool.shutdown(timeout=5)
+    assert sorted(done) == [0, 1, 2, 3]
+    assert pool.size == 0 and not pool.threads
+
+
+def test_shutdown_timeout_bounds_the_wait():
+    pool = WorkerPool(1)
+    release = threading.Event()
+    pool.submit(release.wait)
+    start = time.monotonic()
+    pool.shutdown(timeout=0.1)
+    assert time.monotonic() - start < 1
+    release.set()
+
+
+def test_resize_drops_finished_threads():
+    pool = WorkerPool(3)
+    pool.resize(1)
+    deadline = time.monotonic() + 5
+    while sum(thread.is_alive() for thread in pool.threads) > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.resize(2)
+    assert len(pool.threads) == 2
+    pool.shutdown(timeout=5)
+
+
+def test_task_errors_go_to_stderr_with_traceback(capfd):
+    pool = WorkerPool(1)
+
+    def fail():
+        raise RuntimeError("boom")
+
+    pool.submit(fail)
+    pool.shutdown(timeout=5)
+    out, err = capfd.readouterr()
+    assert out == ""
+    assert "Worker error:" in err and "Traceback" in err and "RuntimeError: boom" in err